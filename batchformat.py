@@ -0,0 +1,190 @@
+"""
+Batch upload format.
+
+Many upload messages of one hub go in one request body, sent raw with
+the BATCH_CONTENT_TYPE content type:
+
+    'SHB' | version (1 byte) | zlib (header length (4) | header | columns)
+
+The header is JSON: the device, the sample count, the first timestamp,
+the data and quality lengths of every sample, the first value of every
+column and, per sample, the message fields left (bus, node, seq, delta,
+typed values...). The registers of the samples are stored by column,
+register 0 of every sample first, each value as its difference with the
+same register of the previous sample, as big endian int32; so are the
+timestamps, in milliseconds, and the quality triples. A slowly moving
+sensor makes a run of zeros, which zlib shrinks to almost nothing.
+
+A column with a difference out of the int32 range, e.g. the timestamps
+across a clock jump of more than 24 days, is stored as int64 instead;
+the header lists these wide columns and the batch is version 2, so
+version 1 readers still take every batch without them.
+
+decode_batch() gives back the messages, timestamps rounded to the
+millisecond.
+"""
+
+import json
+import zlib
+import struct
+
+MAGIC = b'SHB'
+VERSION = 1
+# Version of the batches holding int64 columns
+WIDE_VERSION = 2
+BATCH_CONTENT_TYPE = 'application/x-sensorhub-batch'
+
+# Message fields stored by column, and the width of their items
+_COLUMNS = (('data', 1), ('quality', 3))
+_LENGTH = struct.Struct('>I')
+_INTS = (int, type(2 ** 64))  # long on Python 2
+
+
+class FormatError(ValueError):
+    pass
+
+
+def _flat(value, width):
+    """Flat ints of a column field, None when it does not fit"""
+    if not isinstance(value, (list, tuple)):
+        return None
+    if width == 1:
+        flat = list(value)
+    else:
+        flat = []
+        for item in value:
+            if not isinstance(item, (list, tuple)) or len(item) != width:
+                return None
+            flat.extend(item)
+    for v in flat:
+        if type(v) not in _INTS or not -2 ** 31 <= v < 2 ** 31:
+            return None
+    return flat
+
+
+def _deltas(column):
+    return [b - a for a, b in zip(column, column[1:])]
+
+
+def _pack(values, wide, index):
+    """
+    Packed deltas of the column number index, as int64 and listed in wide
+    when they do not all fit int32
+    """
+    if not values or (min(values) >= -2 ** 31 and max(values) < 2 ** 31):
+        return struct.pack('>%di' % len(values), *values)
+    wide.append(index)
+    return struct.pack('>%dq' % len(values), *values)
+
+
+def encode_batch(messages, level=9):
+    """Body of a batch request holding the upload messages"""
+    if not messages:
+        raise ValueError('empty batch')
+    device = messages[0].get('device')
+    t0 = messages[0].get('timestamp', 0)
+    stamps = [int(round((m.get('timestamp', 0) - t0) * 1000))
+              for m in messages]
+    meta = []
+    lengths = {}
+    first = {}
+    wide = []
+    columns = [_pack(_deltas(stamps), wide, 0)]
+    flats = dict((name, []) for name, width in _COLUMNS)
+    for m in messages:
+        rest = dict(m)
+        rest.pop('timestamp', None)
+        if rest.get('device') == device:
+            del rest['device']
+        for name, width in _COLUMNS:
+            flat = _flat(m[name], width) if name in m else None
+            if flat is None:
+                flats[name].append(())
+            else:
+                flats[name].append(flat)
+                del rest[name]
+        meta.append(rest)
+    for name, width in _COLUMNS:
+        rows = flats[name]
+        lengths[name] = [len(row) for row in rows]
+        first[name] = []
+        size = max(lengths[name])
+        for i in range(size):
+            column = [row[i] for row in rows if len(row) > i]
+            first[name].append(column[0])
+            columns.append(_pack(_deltas(column), wide, len(columns)))
+    # absent column fields are told apart from empty ones
+    absent = dict((name, [i for i, m in enumerate(meta)
+                          if name in m or name not in messages[i]])
+                  for name, width in _COLUMNS)
+    header = {'device': device, 'count': len(messages), 't0': t0,
+              'lengths': lengths, 'first': first, 'absent': absent,
+              'meta': meta}
+    version = VERSION
+    if wide:
+        header['wide'] = wide
+        version = WIDE_VERSION
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    body = _LENGTH.pack(len(header)) + header + b''.join(columns)
+    return MAGIC + struct.pack('B', version) + zlib.compress(body, level)
+
+
+def _unpack(data, pos, count, wide=False):
+    size, code = (8, 'q') if wide else (4, 'i')
+    end = pos + size * count
+    if end > len(data):
+        raise FormatError('truncated batch')
+    return list(struct.unpack('>%d%s' % (count, code), data[pos:end])), end
+
+
+def _running(start, deltas):
+    column = [start]
+    for d in deltas:
+        start += d
+        column.append(start)
+    return column
+
+
+def decode_batch(body):
+    """Upload messages of a batch request body"""
+    if body[:3] != MAGIC or len(body) < 4:
+        raise FormatError('not a sensorhub batch')
+    version = struct.unpack('B', body[3:4])[0]
+    if version not in (VERSION, WIDE_VERSION):
+        raise FormatError('batch version %d is not supported' % version)
+    try:
+        data = zlib.decompress(body[4:])
+    except zlib.error as e:
+        raise FormatError('corrupt batch: %s' % e)
+    size = _LENGTH.unpack_from(data)[0]
+    pos = _LENGTH.size + size
+    header = json.loads(data[_LENGTH.size:pos].decode('utf-8'))
+    count = header['count']
+    wide = set(header.get('wide', ()))
+    deltas, pos = _unpack(data, pos, count - 1, 0 in wide)
+    index = 1
+    stamps = _running(0, deltas)
+    messages = []
+    for i, rest in enumerate(header['meta']):
+        m = dict(rest)
+        m.setdefault('device', header['device'])
+        m['timestamp'] = header['t0'] + stamps[i] / 1000.0
+        messages.append(m)
+    for name, width in _COLUMNS:
+        lengths = header['lengths'][name]
+        rows = [[] for _ in range(count)]
+        for i, start in enumerate(header['first'][name]):
+            owners = [j for j in range(count) if lengths[j] > i]
+            deltas, pos = _unpack(data, pos, len(owners) - 1,
+                                  index in wide)
+            index += 1
+            for j, value in zip(owners, _running(start, deltas)):
+                rows[j].append(value)
+        absent = set(header['absent'][name])
+        for j, row in enumerate(rows):
+            if j in absent:
+                continue
+            if width > 1:
+                row = [row[k:k + width] for k in range(0, len(row), width)]
+            messages[j][name] = row
+    return messages
@@ -0,0 +1,1668 @@
+#!/usr/bin/env python
+'''
+Sensor hub benchmarks, run on any Linux box.
+
+    python benchmark.py [<options>] <benchmark> [<benchmark> ...]
+    python benchmark.py --list
+'''
+
+from __future__ import division, print_function
+
+import io
+import os
+import sys
+import json
+import time
+import fcntl
+import select
+import shutil
+import binascii
+import resource
+import tempfile
+import random
+import socket
+import struct
+import threading
+from optparse import OptionParser
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def report(name, **values):
+    items = ', '.join('%s=%s' % (k, ('%.3f' % v) if isinstance(v, float)
+                      else v) for k, v in sorted(values.items()))
+    print('%-24s %s' % (name, items))
+
+
+def percentile(data, pct):
+    if not data:
+        return 0.0
+    data = sorted(data)
+    return data[min(len(data) - 1, int(round(pct / 100.0 * (len(data) - 1))))]
+
+
+def usage():
+    '''(cpu seconds, rss bytes) of this process'''
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    rss = ru.ru_maxrss * 1024
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return ru.ru_utime + ru.ru_stime, rss
+
+
+def synthetic_sensormap(nodes):
+    '''Two sensors per simulated node, adjacent in the node registers'''
+    sensormap = []
+    reg = 0
+    for i in range(nodes):
+        bus, node = i % 2 + 1, i // 2 + 1
+        for addr, size in ((0, 2), (2, 4)):
+            sensormap.append([reg, 'sensor %d' % reg, bus, node, addr, size])
+            reg += size
+    return sensormap
+
+
+def simulated_manager(options, sim, server=None, unit=1, base=0, slave=None):
+    '''SensorManager talking to the simulator, with the snapshot engine'''
+    import modserver
+
+    modserver.options.modbus_engine = 'snapshot'
+    modserver.options.modbus_address = '127.0.0.1'
+    modserver.options.modbus_port = 0
+    sm = modserver.SensorManager(sim.port, 115200)
+    sm.link_spacing = 0
+    sm.start_uart()
+    sm.read_cpuid()
+    sm.sensormap = synthetic_sensormap(options.nodes)
+    sm._reg_size = sum(row[5] for row in sm.sensormap)
+    sm.start_service(server, unit, base, slave)
+    return sm
+
+
+def synthetic_frames(count, registers=6, noise=True):
+    '''Ext board responses as they appear on the uart'''
+    rnd = random.Random(count)
+    frames = []
+    for i in range(count):
+        msg = {'data': [rnd.randint(0, 0xffff) for _ in range(registers)]}
+        frame = json.dumps(msg).encode()
+        if noise and i % 5 == 0:
+            frame += b'\r\n'
+        frames.append(frame)
+    return b''.join(frames)
+
+
+def chunked(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+@benchmark('framer')
+def bench_framer(options):
+    '''Incremental JSON framer against the legacy whole-buffer decode'''
+    from jsonframe import JSONFramer
+
+    if options.file:
+        with open(options.file, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_frames(options.count)
+
+    for size in (16, 64, 256, 4096):
+        chunks = chunked(stream, size)
+
+        framer = JSONFramer()
+        start = time.time()
+        for chunk in chunks:
+            framer.feed(chunk)
+        elapsed = time.time() - start
+        report('framer chunk=%d' % size,
+               mbps=len(stream) / elapsed / 1e6,
+               frames_per_s=framer.frames / elapsed,
+               frames=framer.frames, dropped=framer.dropped)
+
+        # what SensorManager.on_uart_read used to do
+        frames = dropped = 0
+        buf = b''
+        start = time.time()
+        for chunk in chunks:
+            buf += chunk
+            try:
+                json.loads(buf.decode())
+                frames += 1
+            except ValueError:
+                dropped += 1
+            buf = b''
+        elapsed = time.time() - start
+        report('legacy chunk=%d' % size,
+               mbps=len(stream) / elapsed / 1e6,
+               frames_per_s=frames / elapsed,
+               frames=frames, dropped=dropped)
+
+
+@benchmark('modbus')
+def bench_modbus(options):
+    '''Snapshot modbus TCP server: FC3 requests/s and latency under load'''
+    from mbserver import SnapshotSlave, SnapshotServer
+
+    size = 256
+    slave = SnapshotSlave(size)
+    server = SnapshotServer(slave, address='127.0.0.1', port=0)
+    server.start()
+    running = [True]
+
+    def poller():
+        # what do_polling does: write a few registers and publish
+        n = 0
+        while running[0]:
+            slave.set_values('0', (n * 8) % size, [n & 0xffff] * 8)
+            slave.publish()
+            n += 1
+            time.sleep(0.001)
+
+    def client(latencies):
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tid = 0
+        deadline = time.time() + options.duration
+        while time.time() < deadline:
+            tid = (tid + 1) & 0xffff
+            req = struct.pack('>HHHBBHH', tid, 0, 6, 1, 3, 0, 64)
+            start = time.time()
+            sock.sendall(req)
+            resp = b''
+            while len(resp) < 9 + 128:
+                data = sock.recv(4096)
+                if not data:
+                    return
+                resp += data
+            latencies.append(time.time() - start)
+        sock.close()
+
+    for clients in (1, 8, options.clients):
+        results = [[] for _ in range(clients)]
+        threads = [threading.Thread(target=client, args=(r,))
+                   for r in results]
+        writer = threading.Thread(target=poller)
+        writer.start()
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        running[0] = False
+        writer.join()
+        running[0] = True
+        latencies = [l for r in results for l in r]
+        report('modbus clients=%d' % clients,
+               rps=len(latencies) / elapsed,
+               p50_ms=percentile(latencies, 50) * 1000,
+               p99_ms=percentile(latencies, 99) * 1000,
+               publishes=slave.publishes)
+    server.stop()
+
+
+@benchmark('decode')
+def bench_decode(options):
+    '''Typed decoding of 120 register responses, batch against per value'''
+    from readplan import ReadPlanner
+    from typedecode import CommandDecoder
+
+    types = [('uint16', 2, 1, 0), ('int16', 2, 0.1, 0), ('int32', 4, 1, 0),
+             ('uint32_sw', 4, 1, 0), ('float32', 4, 1, -40.0),
+             ('float32_sw', 4, 0.5, 0)]
+    sensormap = []
+    reg = 0
+    while reg + 4 <= 120:
+        name, size, scale, offset = types[len(sensormap) % len(types)]
+        sensormap.append([reg, 'sensor %d' % reg, 1, 1, reg, size, None,
+                          None, None, name, scale, offset])
+        reg += size
+    cmd = ReadPlanner(sensormap, max_size=125).commands[0]
+    rnd = random.Random(1)
+    responses = [[rnd.randint(0, 0xffff) for _ in range(cmd.size)]
+                 for _ in range(256)]
+
+    def per_value(row, regs):
+        # what a value by value conversion does
+        name, scale, offset = row[9], row[10], row[11]
+        values = []
+        width = 1 if name.endswith('16') else 2
+        for i in range(0, len(regs), width):
+            if width == 1:
+                v = regs[i]
+                if name == 'int16' and v >= 0x8000:
+                    v -= 0x10000
+            else:
+                hi, lo = regs[i], regs[i + 1]
+                if name.endswith('_sw'):
+                    hi, lo = lo, hi
+                if name.startswith('float'):
+                    v = struct.unpack('>f', struct.pack('>HH', hi, lo))[0]
+                else:
+                    v = (hi << 16) | lo
+                    if name.startswith('int') and v >= 0x80000000:
+                        v -= 0x100000000
+            values.append(v * scale + offset)
+        return values
+
+    decoder = CommandDecoder(cmd)
+    mismatches = 0
+    for data in responses:
+        for (reg, raw, typed), row in zip(decoder.decode(data), cmd.rows):
+            expected = per_value(row, raw)
+            mismatches += any(abs(x - y) > 1e-6 * max(1, abs(y)) and
+                              not (x != x and y != y)
+                              for x, y in zip(typed, expected))
+    report('decode cross-check', responses=len(responses),
+           mismatches=mismatches)
+    count = max(1, options.count // 10)
+    for label, decode in (
+            ('batch', decoder.decode),
+            ('per-value', lambda data: [
+                (reg, data[offset:offset + size],
+                 per_value(row, data[offset:offset + size]))
+                for (reg, offset, size), row in zip(cmd.segments, cmd.rows)])):
+        start = time.time()
+        for i in range(count):
+            decode(responses[i % len(responses)])
+        elapsed = time.time() - start
+        report('decode %s' % label, sensors=len(cmd.rows),
+               registers=cmd.size, us_per_response=elapsed / count * 1e6,
+               registers_per_s=cmd.size * count / elapsed)
+
+
+@benchmark('polling')
+def bench_polling(options):
+    '''End-to-end polling cycles against the ext board simulator'''
+    from simulator import ExtBoardSimulator
+
+    sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency,
+                            failure_rate=options.failure_rate, seed=1)
+    sim.start()
+    sm = simulated_manager(options, sim)
+    try:
+        cycles = []
+        reads = 0
+        cpu, _ = usage()
+        start = time.time()
+        for _ in range(options.cycles):
+            t = time.time()
+            reads += sm.do_polling(timeout=options.timeout)
+            cycles.append(time.time() - t)
+        elapsed = time.time() - start
+        cpu = usage()[0] - cpu
+        latency = sm.read_latency()
+        report('polling nodes=%d' % options.nodes,
+               sensors=len(sm.sensormap), reads=len(sm.planner.commands),
+               cycle_ms=sum(cycles) / len(cycles) * 1000,
+               cycle_p99_ms=percentile(cycles, 99) * 1000,
+               reads_per_s=reads / elapsed,
+               read_p50_ms=(latency['p50'] or 0) * 1000,
+               read_p99_ms=(latency['p99'] or 0) * 1000,
+               timeouts=latency['timeouts'],
+               cpu_pct=cpu / elapsed * 100,
+               rss_mb=usage()[1] / 1e6)
+    finally:
+        sm.stop_service()
+        sim.stop()
+
+
+@benchmark('framing')
+def bench_framing(options):
+    '''Wire bytes and reads per second of JSON and binary frames'''
+    import modserver
+    import binframe
+    from jsonframe import JSONFramer
+    from simulator import ExtBoardSimulator
+
+    for framing in ('json', 'binary'):
+        modserver.options.framing = framing
+        sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency,
+                                failure_rate=options.failure_rate, seed=1)
+        sim.start()
+        sm = simulated_manager(options, sim)
+        try:
+            sm.negotiate_framing()
+            sim.reads = sim.bytes_in = sim.bytes_out = 0
+            reads = 0
+            cpu, _ = usage()
+            start = time.time()
+            for _ in range(options.cycles):
+                reads += sm.do_polling(timeout=options.timeout)
+            elapsed = time.time() - start
+            cpu = usage()[0] - cpu
+            latency = sm.read_latency()
+            report('framing %s' % framing, negotiated=sm.binary,
+                   reads=sim.reads,
+                   bytes_out=sim.bytes_in / max(sim.reads, 1),
+                   bytes_in=sim.bytes_out / max(sim.reads, 1),
+                   reads_per_s=reads / elapsed,
+                   read_p50_ms=(latency['p50'] or 0) * 1000,
+                   cpu_ms_per_read=cpu / max(reads, 1) * 1000)
+        finally:
+            sm.stop_service()
+            sim.stop()
+    modserver.options.framing = 'binary'
+
+    # decode cost of the answers alone, 6 registers each
+    rnd = random.Random(1)
+    answers = [[rnd.randint(0, 0xffff) for _ in range(6)]
+               for _ in range(options.count)]
+    streams = {
+        'json': b''.join(json.dumps({'data': a}).encode() for a in answers),
+        'binary': b''.join(binframe.encode_data(i, a)
+                           for i, a in enumerate(answers)),
+    }
+    for framing, stream in sorted(streams.items()):
+        framer = JSONFramer()
+        frames = binframe.FrameReader()
+        start = time.time()
+        for chunk in chunked(stream, 64):
+            if framing == 'json':
+                framer.feed(chunk)
+            else:
+                for ftype, seq, payload in frames.feed(chunk):
+                    binframe.decode(ftype, seq, payload)
+        elapsed = time.time() - start
+        report('framing decode %s' % framing,
+               bytes_per_answer=len(stream) / len(answers),
+               us_per_answer=elapsed / len(answers) * 1e6)
+
+
+@benchmark('metrics')
+def bench_metrics(options):
+    '''Cost of recording metrics and of a scrape after polling'''
+    import metrics
+    from simulator import ExtBoardSimulator
+    try:
+        from urllib2 import urlopen
+    except ImportError:
+        from urllib.request import urlopen
+
+    registry = metrics.Registry()
+    counter = registry.counter('bench_total', 'bench', ('board',)).labels(0)
+    histogram = registry.histogram('bench_seconds', 'bench',
+                                   ('board',)).labels(0)
+    family = registry.counter('bench_nodes_total', 'bench', ('bus', 'node'))
+    samples = [random.random() * 0.2 for _ in range(1000)]
+    count = max(options.count // 1000, 1) * 1000
+
+    def empty():
+        for v in samples:
+            pass
+
+    def inc():
+        for v in samples:
+            counter.inc()
+
+    def observe():
+        for v in samples:
+            histogram.observe(v)
+
+    def lookup():
+        for v in samples:
+            family.labels(1, 3).inc()
+
+    base = None
+    for name, func in (('loop', empty), ('counter', inc),
+                       ('histogram', observe), ('labels+counter', lookup)):
+        start = time.time()
+        for _ in range(count // 1000):
+            func()
+        elapsed = (time.time() - start) / count
+        if base is None:
+            base = elapsed
+            continue
+        report('metrics %s' % name, ns_per_event=(elapsed - base) * 1e9)
+
+    sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency,
+                            failure_rate=options.failure_rate, seed=1)
+    sim.start()
+    sm = simulated_manager(options, sim)
+    server = metrics.MetricsServer(port=0)
+    server.start()
+    try:
+        for _ in range(options.cycles):
+            sm.do_polling(timeout=options.timeout)
+        start = time.time()
+        body = urlopen('http://127.0.0.1:%d/metrics' % server.port).read()
+        elapsed = time.time() - start
+        report('metrics scrape', bytes=len(body), ms=elapsed * 1000,
+               series=len([l for l in body.splitlines()
+                           if not l.startswith(b'#')]))
+    finally:
+        server.stop()
+        sm.stop_service()
+        sim.stop()
+
+
+@benchmark('logging')
+def bench_logging(options):
+    '''Cost of logging calls, synchronous against the async pipeline'''
+    import logging
+    import logpipe
+
+    count = options.count
+    data = b'{"data": [1000, 1001, 1002, 1003, 1004, 1005]}'
+    logger = logging.getLogger('benchmark')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    start = time.time()
+    for _ in range(count):
+        logger.debug('<recv>: %s' % data)
+    eager = time.time() - start
+    start = time.time()
+    for _ in range(count):
+        logger.debug('<recv>: %r', data)
+    lazy = time.time() - start
+    report('logging debug off', eager_us=eager / count * 1e6,
+           lazy_us=lazy / count * 1e6)
+
+    class SlowFileHandler(logging.FileHandler):
+        '''Every write waits like on a busy SD card'''
+        stall = 0
+
+        def flush(self):
+            logging.FileHandler.flush(self)
+            time.sleep(self.stall)
+
+    path = tempfile.mkdtemp()
+    try:
+        for mode, stall in (('sync', 0), ('async', 0),
+                            ('sync', 0.0005), ('async', 0.0005)):
+            handler = SlowFileHandler(os.path.join(path, mode))
+            handler.stall = stall
+            count = options.count // 10 if stall else options.count
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)-8s %(message)s'))
+            pipe = None
+            if mode == 'async':
+                pipe = logpipe.AsyncLogging([handler], queue_size=count)
+                pipe.start()
+                handler = pipe.handler
+            logger.addHandler(handler)
+            calls = []
+            start = time.time()
+            for i in range(count):
+                t = time.time()
+                logger.info('failed to read bus %d, node %d', 1, i % 20)
+                calls.append(time.time() - t)
+            elapsed = time.time() - start
+            if pipe:
+                pipe.stop()
+            drained = time.time() - start
+            logger.removeHandler(handler)
+            handler.close()
+            report('logging info %s stall=%.1fms' % (mode, stall * 1000),
+                   call_us=elapsed / count * 1e6,
+                   call_p99_us=percentile(calls, 99) * 1e6,
+                   max_call_ms=max(calls) * 1000, written_s=drained)
+
+        count = options.count
+        pipe = logpipe.AsyncLogging([logging.NullHandler()])
+        pipe.start()
+        logger.addHandler(pipe.handler)
+        for i in range(count):
+            logger.info('failed to read bus %d, node %d', 1, i % 20,
+                        extra={'ratelimit': i % 20})
+        pipe.stop()
+        logger.removeHandler(pipe.handler)
+        report('logging ratelimit', calls=count, written=pipe.written,
+               suppressed=pipe.limiter.suppressed)
+    finally:
+        shutil.rmtree(path)
+
+
+@benchmark('multiport')
+def bench_multiport(options):
+    '''Polling several simulated ext boards sharing one modbus server'''
+    import modserver
+    from simulator import ExtBoardSimulator
+
+    counts = sorted(set([1, 2, options.boards]))
+    single = None
+    for boards in counts:
+        sims = [ExtBoardSimulator(nodes=options.nodes, latency=options.latency,
+                                  failure_rate=options.failure_rate, seed=i)
+                for i in range(boards)]
+        for sim in sims:
+            sim.start()
+        modserver.options.modbus_engine = 'snapshot'
+        modserver.options.modbus_address = '127.0.0.1'
+        modserver.options.modbus_port = 0
+        server = modserver.modbus_server()
+        for i in range(boards):
+            server.add_slave(i + 1)
+        sms = [simulated_manager(options, sim, server, unit=i + 1)
+               for i, sim in enumerate(sims)]
+        reads = [0] * boards
+        try:
+            def poll(i):
+                for _ in range(options.cycles):
+                    reads[i] += sms[i].do_polling(timeout=options.timeout)
+
+            threads = [threading.Thread(target=poll, args=(i,))
+                       for i in range(boards)]
+            cpu, _ = usage()
+            start = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            cpu = usage()[0] - cpu
+            rate = sum(reads) / elapsed
+            if single is None:
+                single = rate
+            report('multiport boards=%d' % boards,
+                   reads_per_s=rate, scaling=rate / single,
+                   cpu_pct=cpu / elapsed * 100, rss_mb=usage()[1] / 1e6,
+                   publishes=sum(slave.publishes
+                                 for slave in server.slaves.values()))
+        finally:
+            for sm in sms:
+                sm.stop_service()
+            server.stop()
+            for sim in sims:
+                sim.stop()
+
+
+def upload_load(running):
+    '''CPU an uploader spends formatting messages, until running is clear'''
+    msg = {'device': '0123456789ab', 'bus': 1, 'node': 1, 'command': 'read',
+           'data': list(range(256)), 'status': 0}
+    while running.is_set():
+        json.loads(json.dumps(dict(msg, timestamp=time.time())))
+        str(msg)
+
+
+def modbus_load(port, running):
+    '''A modbus client reading 64 registers back to back'''
+    sock = socket.create_connection(('127.0.0.1', port))
+    req = struct.pack('>HHHBBHH', 1, 0, 6, 1, 3, 0, 64)
+    while running.is_set():
+        sock.sendall(req)
+        resp = b''
+        while len(resp) < 9 + 128:
+            data = sock.recv(4096)
+            if not data:
+                return
+            resp += data
+    sock.close()
+
+
+def scheduled_acquisition(options, sm, duration):
+    '''
+    Run the poll jobs of sm for duration, returns the jitter, the seconds
+    every run of a job was off its interval after the previous one.
+    '''
+    from scheduler import PollScheduler
+
+    scheduler = PollScheduler(spacing=0, report_interval=0)
+    sm.schedule(scheduler, timeout=options.timeout)
+    starts = dict((name, []) for name in scheduler.jobs)
+
+    def timed(name, func):
+        def run():
+            starts[name].append(time.time())
+            return func()
+        return run
+
+    for name, job in scheduler.jobs.items():
+        job.func = timed(name, job.func)
+    timer = threading.Timer(duration, scheduler.stop)
+    timer.start()
+    scheduler.run()
+    jitter = []
+    for name, times in starts.items():
+        interval = scheduler.jobs[name].interval
+        # the first runs warm up
+        jitter.extend(abs(b - a - interval)
+                      for a, b in zip(times[2:], times[3:]))
+    return jitter
+
+
+@benchmark('processes')
+def bench_processes(options):
+    '''Acquisition jitter under modbus and upload load, one process or three'''
+    import multiprocessing
+    from mbserver import SnapshotServer
+    from shmimage import SharedImage, SharedSlave, SharedReader
+    from simulator import ExtBoardSimulator
+    from supervisor import Supervisor
+    from modserver import SERVER_NICE, UPLOADER_NICE
+
+    def simulate(sim):
+        sim.start()
+        while True:
+            time.sleep(1)
+
+    def acquire(sim, path, results):
+        sm = simulated_manager(options, sim, slave=SharedSlave(
+            SharedImage(path, create=True)))
+        sm.interval = 0.5
+        sm.update_plan()
+        results.put(scheduled_acquisition(options, sm, options.duration))
+        sm.stop_service()
+
+    def serve(port):
+        server = SnapshotServer(SharedReader([path]), address='127.0.0.1',
+                                port=port)
+        server.start()
+        while True:
+            time.sleep(1)
+
+    # the board lives in its own process in both layouts
+    sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency,
+                            failure_rate=options.failure_rate, seed=1)
+    board = multiprocessing.Process(target=simulate, args=(sim,))
+    board.daemon = True
+    board.start()
+    path = os.path.join(tempfile.gettempdir(), 'sensorhub-bench.shm')
+    try:
+        for layout in ('single', 'processes'):
+            for loaded in (False, True):
+                running = threading.Event()
+                running.set()
+                threads = []
+                if layout == 'single':
+                    sm = simulated_manager(options, sim)
+                    sm.interval = 0.5
+                    sm.update_plan()
+                    port = sm._mdbus.port
+                    if loaded:
+                        threads.append(threading.Thread(target=upload_load,
+                                                        args=(running,)))
+                else:
+                    # laid out like modserver --processes
+                    sock = socket.socket()
+                    sock.bind(('127.0.0.1', 0))
+                    port = sock.getsockname()[1]
+                    sock.close()
+                    results = multiprocessing.Queue()
+                    stop = multiprocessing.Event()
+                    stop.set()
+                    supervisor = Supervisor()
+                    supervisor.add('acquisition', acquire,
+                                   (sim, path, results))
+                    supervisor.add('modbus', serve, (port,), SERVER_NICE)
+                    if loaded:
+                        supervisor.add('upload', upload_load, (stop,),
+                                       UPLOADER_NICE)
+                    supervisor.start()
+                    time.sleep(0.5)
+                if loaded:
+                    threads.extend(threading.Thread(target=modbus_load,
+                                                    args=(port, running))
+                                   for _ in range(options.clients))
+                    for t in threads:
+                        t.daemon = True
+                        t.start()
+                if layout == 'single':
+                    jitter = scheduled_acquisition(options, sm,
+                                                   options.duration)
+                    sm.stop_service()
+                else:
+                    jitter = results.get()
+                    stop.clear()
+                    supervisor.stop()
+                running.clear()
+                for t in threads:
+                    t.join()
+                report('processes %s load=%s' % (layout, loaded and
+                       '%d clients+upload' % options.clients or 'none'),
+                       runs=len(jitter),
+                       jitter_p50_ms=percentile(jitter, 50) * 1000,
+                       jitter_p99_ms=percentile(jitter, 99) * 1000,
+                       jitter_max_ms=max(jitter or [0]) * 1000)
+    finally:
+        board.terminate()
+        sim.stop()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@benchmark('upload')
+def bench_upload(options):
+    '''Queue and drain samples to a local stand-in for uploaddata.do'''
+    import modserver
+    from uploader import HTTPUploader
+    from uploadqueue import SegmentQueue, UploadFlusher
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        from urllib2 import urlopen, Request
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from urllib.request import urlopen, Request
+
+    failures = random.Random(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # one segment per response like a real server, no Nagle delay
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(options.latency)  # server and 4G round trip
+            failed = failures.random() < options.failure_rate
+            self.send_response(500 if failed else 200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    httpd = Server(('127.0.0.1', 0), Handler)
+    server = threading.Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+    url = 'http://127.0.0.1:%d/ZhiHuiNongYe/uploaddata.do' % \
+        httpd.server_address[1]
+
+    def legacy():
+        '''One urlopen per message, as upload() used to do'''
+        latencies = []
+
+        def send(msgs):
+            for count, msg in enumerate(msgs):
+                start = time.time()
+                try:
+                    urlopen(Request(url, modserver.upload_body(msg)),
+                            timeout=2).read()
+                except Exception:
+                    return count
+                latencies.append(time.time() - start)
+            return len(msgs)
+        return send, lambda: {'p50': percentile(latencies, 50),
+                              'p99': percentile(latencies, 99),
+                              'connections': len(latencies)}
+
+    def pooled(window):
+        def make():
+            uploader = HTTPUploader(url, window=window, retry_min=0.05,
+                                    headers=modserver.headers)
+            return uploader, uploader.stats
+        return make
+
+    msg = {'device': '0123456789ab', 'timestamp': time.time(),
+           'bus': 1, 'node': 1, 'command': 'read',
+           'data': tuple(range(256)), 'status': 0}
+    payload = str(msg).encode()
+    try:
+        for name, make in (('legacy', legacy), ('pooled window=1', pooled(1)),
+                           ('pooled window=4', pooled(4))):
+            spool = tempfile.mkdtemp(prefix='sensorhub-spool-')
+            try:
+                queue = SegmentQueue(spool)
+                start = time.time()
+                for _ in range(options.count):
+                    queue.put(payload)
+                put_us = (time.time() - start) / options.count * 1e6
+                send, stats = make()
+                flusher = UploadFlusher(queue, send, retry_min=0.05)
+                cpu, _ = usage()
+                start = time.time()
+                flusher.start()
+                while queue.depth:
+                    time.sleep(0.01)
+                elapsed = time.time() - start
+                flusher.stop()
+                cpu = usage()[0] - cpu
+                if hasattr(send, 'close'):
+                    send.close()
+                stats = stats()
+                report('upload %s' % name, samples=options.count,
+                       put_us=put_us, uploads_per_s=options.count / elapsed,
+                       p50_ms=(stats['p50'] or 0) * 1000,
+                       p99_ms=(stats['p99'] or 0) * 1000,
+                       connections=stats['connections'],
+                       batch_retries=flusher.failures,
+                       cpu_pct=cpu / elapsed * 100)
+            finally:
+                shutil.rmtree(spool)
+    finally:
+        httpd.shutdown()
+
+
+def sample_series(sensormap, count, interval, rand, change_only=False):
+    '''Upload messages of count polls of slowly moving sensors'''
+    import modserver
+    from deadband import DeadbandFilter
+    from quality import QualityTable
+    from typedecode import is_typed, typed_values
+
+    size = max(row[0] + row[5] for row in sensormap)
+    data = [rand.randint(200, 800) for _ in range(size)]
+    quality = QualityTable(sensormap)
+    deadband = DeadbandFilter(sensormap, deadband=2) if change_only else None
+    now = 1700000000.0
+    messages = []
+    for _ in range(count):
+        now += interval + rand.uniform(-0.01, 0.01)
+        for reg in range(size):
+            if rand.random() < 0.3:
+                data[reg] = max(0, data[reg] + rand.randint(-3, 3))
+        for row in sensormap:
+            quality.update(row[0], rand.random() > 0.02, now)
+        values = [[row[0], typed_values(row, data[row[0]:row[0] + row[5]])]
+                  for row in sensormap if is_typed(row)]
+        msg = modserver.image_message('0123456789abcdef01234567', list(data),
+                                      quality.as_upload(), values)
+        msg['timestamp'] = now
+        if deadband:
+            msg = deadband.encode(msg, msg['data'], now)
+            if msg is None:
+                continue
+        messages.append(msg)
+    return messages
+
+
+@benchmark('batchformat')
+def bench_batchformat(options):
+    '''Bytes per sample uploaded as form posts and as batch bodies'''
+    import modserver
+    from batchformat import encode_batch, decode_batch
+
+    typed = [row + [None, None, None, 'float32', 0.1, -40]
+             if row[5] % 2 == 0 and row[0] % 4 == 0 else row
+             for row in synthetic_sensormap(options.nodes)]
+    maps = (('default map', modserver.SENSORMAP, False),
+            ('%d nodes' % options.nodes, synthetic_sensormap(options.nodes),
+             False),
+            ('%d nodes typed' % options.nodes, typed, False),
+            ('%d nodes change-only' % options.nodes,
+             synthetic_sensormap(options.nodes), True))
+    batch = 50  # records a flusher sends at once
+    for name, sensormap, change_only in maps:
+        messages = sample_series(sensormap, options.count // 10 or batch,
+                                 modserver.UPLOAD_INTERVAL, random.Random(1),
+                                 change_only)
+        form = sum(len(modserver.upload_body(msg)) for msg in messages)
+        start = time.time()
+        bodies = [encode_batch(messages[i:i + batch])
+                  for i in range(0, len(messages), batch)]
+        encode_us = (time.time() - start) / len(messages) * 1e6
+        size = sum(len(body) for body in bodies)
+        start = time.time()
+        decoded = []
+        for body in bodies:
+            decoded.extend(decode_batch(body))
+        decode_us = (time.time() - start) / len(messages) * 1e6
+        for msg, out in zip(messages, decoded):
+            assert abs(out.pop('timestamp') - msg['timestamp']) < 0.001
+            expected = json.loads(json.dumps(msg))
+            expected.pop('timestamp')
+            assert out == expected, 'batch round trip differs'
+        report('batchformat %s' % name, samples=len(messages),
+               form_bytes=form / len(messages),
+               batch_bytes=size / len(messages),
+               ratio=form / size, encode_us=encode_us, decode_us=decode_us)
+
+
+def ymodem_transfer(sim, transport, data, size, window=1):
+    '''(seconds, block round trips) of a YMODEM send to the bootloader'''
+    from xmodem import YMODEM
+
+    fd, image = tempfile.mkstemp(prefix='sensorhub-image-')
+    os.write(fd, data[:size])
+    os.close(fd)
+    blocks = []
+    last = [time.time()]
+
+    def callback(total, success, errors):
+        now = time.time()
+        blocks.append(now - last[0])
+        last[0] = now
+
+    images = len(sim.images)
+    try:
+        sim.reset()
+        transport.getc(len(b'\r\nBootloader is started\r\n'), 2)
+        transport.putc(b'1')
+        start = last[0] = time.time()
+        modem = YMODEM(transport.getc, transport.putc)
+        modem.log.disabled = True
+        ok = modem.send([image], callback=callback, window=window)
+        elapsed = time.time() - start
+        # a YMODEM-g sender does not wait for the end of batch to be seen
+        deadline = time.time() + 2
+        while ok and len(sim.images) == images and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        os.unlink(image)
+    # a send telling success has to leave the board the image byte for byte
+    assert not ok or (len(sim.images) > images and
+                      sim.images[-1] == data[:size]), \
+        'ymodem send succeeded, the board did not get the image'
+    return (elapsed if ok else None), blocks
+
+
+class SleepPollTransport(object):
+    '''getc and putc of modserver before SerialTransport'''
+
+    def __init__(self, port):
+        self.port = port
+
+    def getc(self, size, timeout=1):
+        while timeout >= 0:
+            time.sleep(0.2)
+            count = self.port.inWaiting()
+            if count >= size:
+                data = self.port.read(size)
+                return data
+            timeout -= 0.2
+        return None
+
+    def putc(self, data, timeout=1):
+        return self.port.write(data) or None
+
+
+@benchmark('upgrade')
+def bench_upgrade(options):
+    '''YMODEM upgrade of the simulated ext board'''
+    import serial
+    import modserver
+    from simulator import ExtBoardSimulator
+    from xmodem import SerialTransport
+
+    sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency)
+    sim.start()
+    data = os.urandom(options.image_size)
+    port = serial.Serial(sim.port, 115200, timeout=1)
+    try:
+        # the legacy transport pays 200ms+ a block, keep its image small
+        for name, transport, size in (
+                ('sleep-poll', SleepPollTransport(port), 8 * 1024),
+                ('serial', SerialTransport(port), 8 * 1024),
+                ('serial', SerialTransport(port), len(data))):
+            elapsed, blocks = ymodem_transfer(sim, transport, data, size)
+            report('upgrade transfer %s bytes=%d' % (name, size),
+                   ok=elapsed is not None, seconds=elapsed or 0.0,
+                   kb_per_s=size / 1024 / elapsed if elapsed else 0.0,
+                   block_p50_ms=percentile(blocks, 50) * 1000,
+                   block_p99_ms=percentile(blocks, 99) * 1000)
+    finally:
+        port.close()
+        sim.stop()
+
+    if not hasattr(modserver.GPIO, 'add_output_callback'):
+        raise SystemExit('upgrade benchmark needs the GPIO stub')
+    sim = ExtBoardSimulator(nodes=options.nodes, latency=options.latency)
+    sim.attach_gpio(modserver.GPIO, modserver.EXT_BOARD_RST)
+    sim.start()
+    sm = simulated_manager(options, sim)
+    fd, image = tempfile.mkstemp(prefix='sensorhub-image-')
+    os.write(fd, data)
+    os.close(fd)
+    try:
+        modserver.GPIO.setup(modserver.EXT_BOARD_RST, modserver.GPIO.OUT)
+        modserver.GPIO.output(modserver.EXT_BOARD_RST, True)
+        sm._updating = True
+        cpu, _ = usage()
+        start = time.time()
+        ok = sm.do_upgrade(image)
+        elapsed = time.time() - start
+        cpu = usage()[0] - cpu
+        sm._updating = False
+        report('upgrade bytes=%d' % len(data),
+               ok=bool(ok and sim.images and sim.images[-1] == data),
+               seconds=elapsed, cpu_pct=cpu / elapsed * 100,
+               rss_mb=usage()[1] / 1e6)
+    finally:
+        os.unlink(image)
+        sm.stop_service()
+        sim.stop()
+
+
+@benchmark('streaming')
+def bench_streaming(options):
+    '''YMODEM stop-and-wait, windowed and -g sends at latencies and errors'''
+    import serial
+    from simulator import ExtBoardSimulator
+    from xmodem import SerialTransport
+
+    data = os.urandom(options.image_size)
+    modes = (('stop-and-wait', 1, False), ('window=4', 4, False),
+             ('window=8', 8, False), ('ymodem-g', 1, True))
+    for latency in (0.0, options.latency, 0.1):
+        for errors in (0.0, 0.01, 0.05):
+            for name, window, streaming in modes:
+                sim = ExtBoardSimulator(nodes=1, seed=1,
+                                        reply_latency=latency,
+                                        block_error_rate=errors,
+                                        ymodem_g=streaming)
+                sim.start()
+                port = serial.Serial(sim.port, 115200, timeout=1)
+                try:
+                    elapsed, blocks = ymodem_transfer(
+                        sim, SerialTransport(port), data, len(data), window)
+                finally:
+                    port.close()
+                    sim.stop()
+                report('streaming %s latency=%g errors=%g' % (name, latency,
+                                                             errors),
+                       ok=elapsed is not None, block_errors=sim.block_errors,
+                       kb_per_s=len(data) / 1024 / elapsed
+                       if elapsed else 0.0)
+
+
+class FdTransport(object):
+    '''getc and putc over file descriptors'''
+
+    def __init__(self, rfd, wfd):
+        self.rfd = rfd
+        self.wfd = wfd
+        self._buf = b''
+
+    def getc(self, size, timeout=1):
+        deadline = time.time() + timeout
+        while len(self._buf) < size:
+            rlist, _, _ = select.select([self.rfd], [], [],
+                                        max(0, deadline - time.time()))
+            if not rlist:
+                return None
+            chunk = os.read(self.rfd, 4096)
+            if not chunk:
+                return None
+            self._buf += chunk
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def putc(self, data, timeout=1):
+        data = bytes(data)
+        while data:
+            data = data[os.write(self.wfd, data):]
+        return True
+
+
+class FaultyLine(object):
+    '''
+    Serial line between two local ends, near and far, over pipes of a
+    uart fifo size. Bytes take line time at baudrate, arrive latency
+    seconds later and are flipped at error_rate. The far end is the
+    far_fd file descriptor, a pty, when given. After cut bytes sent by
+    the near end, the line hangs up.
+    '''
+
+    def __init__(self, baudrate=115200, latency=0.0, error_rate=0.0,
+                 seed=1, far_fd=None, cut=None):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.cut = cut
+        self.sent = 0
+        self.corrupted = 0
+        self._random = random.Random(seed)
+        self._next_error = self._error_gap()
+        self._running = True
+        self._fds = []
+        self._threads = []
+        near_out, line_in = self._pipe()
+        near_in, line_out = self._pipe()
+        self.near = FdTransport(near_in, line_in)
+        if far_fd is None:
+            far_out, far_line_in = self._pipe()
+            far_in, far_line_out = self._pipe()
+            self.far = FdTransport(far_in, far_line_in)
+        else:
+            far_out = far_line_out = far_fd
+        self._relay(near_out, far_line_out, True)
+        self._relay(far_out, line_out, False)
+
+    def _pipe(self):
+        rfd, wfd = os.pipe()
+        try:
+            fcntl.fcntl(wfd, 1031, 4096)  # F_SETPIPE_SZ, Linux only
+        except IOError:
+            pass
+        self._fds += [rfd, wfd]
+        return rfd, wfd
+
+    def _error_gap(self):
+        '''Bytes before the next flipped one'''
+        if not self.error_rate:
+            return None
+        return int(self._random.expovariate(self.error_rate))
+
+    def _corrupt(self, data):
+        if self._next_error is None or self._next_error >= len(data):
+            if self._next_error is not None:
+                self._next_error -= len(data)
+            return data
+        data = bytearray(data)
+        while self._next_error < len(data):
+            data[self._next_error] ^= 1 << self._random.randrange(8)
+            self.corrupted += 1
+            self._next_error += 1 + self._error_gap()
+        self._next_error -= len(data)
+        return bytes(data)
+
+    def _relay(self, src, dst, outbound):
+        deliveries = queue.Queue()
+
+        def read():
+            free = time.time()
+            while self._running:
+                rlist, _, _ = select.select([src], [], [], 0.1)
+                if not rlist:
+                    continue
+                data = os.read(src, 256)
+                if not data:
+                    break
+                now = time.time()
+                free = max(free, now) + len(data) * 10 / self.baudrate
+                time.sleep(free - now)  # line time, the fifo fills meanwhile
+                if self.cut is not None and self.sent >= self.cut:
+                    continue  # hung up
+                if outbound:
+                    self.sent += len(data)
+                deliveries.put((free + self.latency, self._corrupt(data)))
+            deliveries.put(None)
+
+        def write():
+            while True:
+                item = deliveries.get()
+                if item is None:
+                    return
+                due, data = item
+                time.sleep(max(0, due - time.time()))
+                while data and self._running:
+                    _, wlist, _ = select.select([], [dst], [], 0.1)
+                    if wlist:
+                        data = data[os.write(dst, data):]
+
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        for fd in self._fds:
+            os.close(fd)
+
+
+def zmodem_transfer(line, image, out, resume=False, retry=16, timeout=10):
+    '''(seconds, bytes sent again) of a ZMODEM send over line into out'''
+    from xmodem import ZMODEM
+
+    received = []
+    receiver = ZMODEM(line.far.getc, line.far.putc)
+    receiver.log.disabled = True
+    thread = threading.Thread(target=lambda: received.append(
+        receiver.recv(out, retry=retry, timeout=timeout, resume=resume)))
+    thread.daemon = True
+    thread.start()
+    sender = ZMODEM(line.near.getc, line.near.putc)
+    sender.log.disabled = True
+    start = time.time()
+    ok = sender.send([image], retry=retry, timeout=timeout, resume=resume)
+    elapsed = time.time() - start
+    thread.join()
+    return (elapsed if ok and received[0] is not None else None), \
+        sender.resent
+
+
+@benchmark('zmodem')
+def bench_zmodem(options):
+    '''ZMODEM against YMODEM over a faulty local line, and ZMODEM resume'''
+    from simulator import ExtBoardSimulator
+
+    data = os.urandom(options.image_size)
+    fd, image = tempfile.mkstemp(prefix='sensorhub-image-')
+    os.write(fd, data)
+    os.close(fd)
+
+    def ymodem(latency, errors, window=1):
+        sim = ExtBoardSimulator(nodes=1, seed=1, baudrate=0)
+        sim.start()
+        port = os.open(sim.port, os.O_RDWR | os.O_NOCTTY)
+        line = FaultyLine(latency=latency, error_rate=errors, far_fd=port)
+        try:
+            elapsed, blocks = ymodem_transfer(sim, line.near, data,
+                                              len(data), window)
+        finally:
+            line.close()
+            os.close(port)
+            sim.stop()
+        return elapsed, line
+
+    def zmodem(latency, errors, out, resume=False, cut=None, **kwargs):
+        line = FaultyLine(latency=latency, error_rate=errors, cut=cut)
+        try:
+            elapsed, resent = zmodem_transfer(line, image, out, resume,
+                                              **kwargs)
+        finally:
+            line.close()
+        assert elapsed is None or out.getvalue() == data, \
+            'zmodem send succeeded, the receiver did not get the image'
+        return elapsed, resent, line
+
+    try:
+        for latency in (0.0, options.latency, 0.1):
+            for errors in (0.0, 1e-5, 1e-4):
+                name = 'latency=%g errors=%g' % (latency, errors)
+                for window in (1, 8):
+                    elapsed, line = ymodem(latency, errors, window)
+                    report('zmodem ymodem window=%d %s' % (window, name),
+                           ok=elapsed is not None, corrupted=line.corrupted,
+                           kb_per_s=len(data) / 1024 / elapsed
+                           if elapsed else 0.0)
+                elapsed, resent, line = zmodem(latency, errors, io.BytesIO())
+                report('zmodem zmodem %s' % name, ok=elapsed is not None,
+                       corrupted=line.corrupted, resent=resent,
+                       kb_per_s=len(data) / 1024 / elapsed
+                       if elapsed else 0.0)
+
+        # the line hangs up half way, the receiver keeps what it checked
+        out = io.BytesIO()
+        cut = len(data) // 2
+        zmodem(options.latency, 0.0, out, cut=cut, retry=2, timeout=1)
+        kept = len(out.getvalue())
+        elapsed, resent, line = zmodem(options.latency, 0.0, out,
+                                       resume=True)
+        report('zmodem resume after %d bytes' % cut, ok=elapsed is not None,
+               resumed_from=kept, line_bytes=line.sent,
+               seconds=elapsed or 0.0)
+        elapsed, line = ymodem(options.latency, 0.0)
+        report('zmodem ymodem again after %d bytes' % cut,
+               ok=elapsed is not None, line_bytes=line.sent,
+               seconds=elapsed or 0.0)
+        lrzsz_transfers(data)
+    finally:
+        os.unlink(image)
+
+
+# Hex headers as lrzsz sz and rz send them
+LRZSZ_HEADERS = (
+    ('ZRQINIT', b'**\x18B00000000000000\r\x8a\x11'),
+    ('ZRINIT', b'**\x18B0100000023be50\r\x8a\x11'),  # CANFDX CANOVIO CANFC32
+    ('ZFIN', b'**\x18B0800000000022d\r\x8a'),
+)
+
+
+def which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+
+def lrzsz_transfers(data):
+    '''
+    xmodem.py --mode zmodem send and recv against the lrzsz sz and rz, from
+    scratch and resumed from half a file
+    '''
+    import subprocess
+    import xmodem
+
+    frames = []
+    modem = xmodem.ZMODEM(None, frames.append)
+    modem._send_hex_header(xmodem.ZRQINIT, xmodem._zpos(0))
+    modem._send_hex_header(xmodem.ZRINIT, xmodem._zflags(
+        xmodem.CANFDX | xmodem.CANOVIO | xmodem.CANFC32))
+    modem._send_hex_header(xmodem.ZFIN, xmodem._zpos(0))
+    for (name, expected), frame in zip(LRZSZ_HEADERS, frames):
+        report('zmodem lrzsz header %s' % name, ok=frame == expected)
+
+    if not (which('sz') and which('rz')):
+        report('zmodem lrzsz', ok=False, skipped='sz and rz not installed')
+        return
+    script = os.path.abspath(xmodem.__file__).replace('.pyc', '.py')
+    tmp = tempfile.mkdtemp(prefix='sensorhub-lrzsz-')
+    src = os.path.join(tmp, 'image.bin')
+    with open(src, 'wb') as f:
+        f.write(data)
+    half = data[:len(data) // 2]
+    try:
+        for command, resume in (('send', False), ('send', True),
+                                ('recv', False), ('recv', True)):
+            out = os.path.join(tmp, 'out')
+            if os.path.isdir(out):
+                shutil.rmtree(out)
+            os.mkdir(out)
+            # rz writes the image in its directory, recv writes into dst
+            dst = os.path.join(out, 'image.bin')
+            if resume:
+                with open(dst, 'wb') as f:
+                    f.write(half)
+            args = [sys.executable, script, '--mode', 'zmodem']
+            if resume:
+                args.append('--resume')
+            args += ['send', src] if command == 'send' \
+                else ['recv', dst, src]
+            start = time.time()
+            with open(os.devnull, 'wb') as devnull:
+                status = subprocess.call(args, cwd=out, stdout=devnull,
+                                         stderr=devnull)
+            elapsed = time.time() - start
+            with open(dst, 'rb') as f:
+                ok = status == 0 and f.read() == data
+            report('zmodem lrzsz %s%s' % (command,
+                                          ' resume' if resume else ''),
+                   ok=ok, seconds=elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+
+class ScriptedLine(object):
+    '''getc of a recorded byte string, putc counted, kept when keep'''
+
+    def __init__(self, incoming=b'', keep=False):
+        self.incoming = incoming
+        self.pos = 0
+        self.gets = 0
+        self.puts = 0
+        self.crc = 0  # CRC-16 of the bytes sent
+        self.sent = [] if keep else None
+
+    def getc(self, size, timeout=1):
+        self.gets += 1
+        if self.pos + size > len(self.incoming):
+            return None
+        data = self.incoming[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def putc(self, data, timeout=1):
+        self.puts += 1
+        self.crc = binascii.crc_hqx(data, self.crc)
+        if self.sent is not None:
+            self.sent.append(bytes(data))
+        return len(data)
+
+
+@benchmark('packets')
+def bench_packets(options):
+    '''XMODEM packet buffer send and one-read receive against copying blocks'''
+    import mmap
+    from functools import partial
+    from xmodem import XMODEM, ACK, CRC, EOT
+
+    class CopyingXMODEM(XMODEM):
+        '''Blocks built and read as before the packet buffer'''
+
+        def _fill_packet(self, buf, stream, packet_size, sequence, crc_mode):
+            data = stream.read(packet_size)
+            if not data:
+                return None
+            header = self._make_send_header(packet_size, sequence)
+            data = data.ljust(packet_size, self.pad)
+            checksum = self._make_send_checksum(crc_mode, data)
+            return header + data + checksum
+
+        def _recv_block(self, packet_size, crc_mode, sequence, timeout):
+            seq1 = self.getc(1, timeout)
+            seq2 = self.getc(1, timeout)
+            if seq1 is None or seq2 is None or \
+                    not (ord(seq1) == 0xff - ord(seq2) == sequence):
+                self.getc(packet_size + 1 + crc_mode)
+                return None
+            data = self.getc(packet_size + 1 + crc_mode, timeout)
+            valid, data = self._verify_recv_checksum(crc_mode, data)
+            return data if valid else None
+
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    def measure(prepare):
+        '''
+        (best seconds of 3, peak bytes allocated, result) of the run
+        returned by prepare(), which sets up the streams untimed
+        '''
+        times = []
+        for _ in range(3):
+            run = prepare()
+            start = time.time()
+            result = run()
+            times.append(time.time() - start)
+        peak = 0
+        if tracemalloc is not None:
+            run = prepare()
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return min(times), peak, result
+
+    size = max(options.image_size, 1024 * 1024)
+    data = os.urandom(size - 100)  # a padded last block
+    fd, image = tempfile.mkstemp(prefix='sensorhub-image-')
+    os.write(fd, data)
+    os.close(fd)
+    blocks = (len(data) + 1023) // 1024
+    padded = data + b'\x1a' * (blocks * 1024 - len(data))
+    padded_crc = binascii.crc_hqx(padded, 0)
+    acks = CRC + ACK * (blocks + 1)
+    files = []
+
+    def modem(modem_class, line):
+        modem = modem_class(line.getc, line.putc, mode='xmodem1k')
+        modem.log.disabled = True
+        return modem
+
+    def prepare_send(modem_class, window, source):
+        if source == 'bytesio':
+            stream = io.BytesIO(data)
+        else:
+            stream = open(image, 'rb')
+            files.append(stream)
+            if source == 'mmap':
+                stream = mmap.mmap(stream.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+                files.append(stream)
+        line = ScriptedLine(acks)
+        sender = modem(modem_class, line)
+
+        def run():
+            ok = sender.send(stream, window=window)
+            return ok and line.crc == crc, line.gets + line.puts
+        return run
+
+    def prepare_recv(modem_class, sink):
+        if sink == 'mmap':
+            out = tempfile.TemporaryFile()
+            out.truncate(len(padded))
+            files.append(out)
+            stream = mmap.mmap(out.fileno(), len(padded))
+            files.append(stream)
+        else:
+            stream = io.BytesIO()
+            stream.write(bytes(bytearray(len(padded))))  # no growth in recv
+            stream.seek(0)
+        line = ScriptedLine(frames)
+        receiver = modem(modem_class, line)
+
+        def run():
+            ok = receiver.recv(stream, quiet=True) == len(padded)
+            if sink == 'mmap':
+                received = stream
+            elif hasattr(stream, 'getbuffer'):
+                received = stream.getbuffer()
+            else:
+                received = stream.getvalue()
+            ok = ok and binascii.crc_hqx(received, 0) == padded_crc
+            del received
+            return ok, line.gets + line.puts
+        return run
+
+    try:
+        # the frames of the previous code, both sends must match them
+        line = ScriptedLine(acks, keep=True)
+        modem(CopyingXMODEM, line).send(io.BytesIO(data))
+        frames = b''.join(line.sent)
+        crc = binascii.crc_hqx(frames, 0)
+        assert frames.endswith(EOT)
+
+        for name, modem_class in (('copying', CopyingXMODEM),
+                                  ('buffer', XMODEM)):
+            tests = [('send window=%d %s' % (window, source),
+                      partial(prepare_send, modem_class, window, source))
+                     for window in (1, 8)
+                     for source in ('bytesio', 'file', 'mmap')]
+            tests += [('recv %s' % sink, partial(prepare_recv, modem_class,
+                                                 sink))
+                      for sink in ('bytesio', 'mmap')]
+            for test, prepare in tests:
+                elapsed, peak, (ok, calls) = measure(prepare)
+                report('packets %s %s' % (name, test), ok=ok,
+                       us_per_block=elapsed / blocks * 1e6,
+                       mb_per_s=len(data) / elapsed / 1e6,
+                       calls_per_block=calls / blocks, peak_kb=peak / 1024)
+                while files:
+                    files.pop().close()
+    finally:
+        os.unlink(image)
+
+
+@benchmark('checksum')
+def bench_checksum(options):
+    '''XMODEM checksum and CRC engines, checked against the 0.4.5 code'''
+    import platform
+    import xmodem
+
+    table = xmodem.XMODEM.crctable
+
+    def old_checksum(data, checksum=0):
+        if platform.python_version_tuple() >= ('3', '0', '0'):
+            return (sum(data) + checksum) % 256
+        else:
+            return (sum(map(ord, data)) + checksum) % 256
+
+    def old_crc(data, crc=0):
+        for char in bytearray(data):
+            crctbl_idx = ((crc >> 8) ^ char) & 0xff
+            crc = ((crc << 8) ^ table[crctbl_idx]) & 0xffff
+        return crc & 0xffff
+
+    rand = random.Random(1)
+    engines = sorted(xmodem.CRC_ENGINES.items())
+    checked = 0
+    sizes = list(range(0, 70)) + [127, 128, 129, 1023, 1024, 1025, 4099]
+    for size in sizes:
+        data = bytes(bytearray(rand.getrandbits(8) for _ in range(size)))
+        for start in (0, 1, 0xffff, rand.getrandbits(16)):
+            crc = old_crc(data, start)
+            csum = old_checksum(data, start & 0xff)
+            cut = rand.randint(0, size)
+            for view in (data, bytearray(data), memoryview(data)):
+                assert xmodem.calc_checksum8(view, start & 0xff) == csum
+                assert xmodem.calc_checksum8(
+                    view[cut:], xmodem.calc_checksum8(view[:cut],
+                                                      start & 0xff)) == csum
+                for name, engine in engines:
+                    assert engine(view, start) == crc, name
+                    assert engine(view[cut:], engine(view[:cut], start)) \
+                        == crc, name
+                    checked += 2
+    for mode, size in (('xmodem', 128), ('xmodem1k', 1024),
+                       ('ymodem', 128), ('ymodem', 1024)):
+        modem = xmodem.XMODEM(None, None, mode=mode)
+        modem.log.disabled = True
+        for _ in range(50):
+            block = bytes(bytearray(rand.getrandbits(8) for _ in range(size)))
+            crc = old_crc(block)
+            sums = {0: bytearray([old_checksum(block)]),
+                    1: bytearray([crc >> 8, crc & 0xff])}
+            for crc_mode, expected in sums.items():
+                assert modem._make_send_checksum(crc_mode, block) == expected
+                frame = block + bytes(expected)
+                assert modem._verify_recv_checksum(crc_mode, frame) == \
+                    (True, block)
+                bad = bytearray(frame)
+                bad[rand.randrange(size)] ^= 0x10
+                assert not modem._verify_recv_checksum(crc_mode,
+                                                       bytes(bad))[0]
+                checked += 3
+    report('checksum cross-check', checked=checked, ok=True,
+           engine=xmodem.CRC_ENGINE)
+
+    block = bytes(bytearray(rand.getrandbits(8) for _ in range(1024)))
+    count = max(1, options.count // 10)
+    funcs = [('checksum 0.4.5', old_checksum),
+             ('checksum', xmodem.calc_checksum8),
+             ('crc 0.4.5', old_crc)] + \
+        [('crc %s' % name, engine) for name, engine in engines]
+    for name, func in funcs:
+        func(block)  # table setup
+        start = time.time()
+        for _ in range(count):
+            func(block)
+        elapsed = time.time() - start
+        report('checksum %s' % name, blocks=count,
+               us_per_1k_block=elapsed / count * 1e6,
+               mb_per_s=count * len(block) / elapsed / 1e6)
+
+def main():
+    parser = OptionParser(usage='%prog [<options>] <benchmark> ...')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      help='list the benchmarks')
+    parser.add_option('-n', '--count', type='int', default=10000,
+                      help='number of samples [default: %default]')
+    parser.add_option('-f', '--file', default=None,
+                      help='recorded input, when supported')
+    parser.add_option('-d', '--duration', type='float', default=3.0,
+                      help='seconds per measurement [default: %default]')
+    parser.add_option('-c', '--clients', type='int', default=32,
+                      help='concurrent clients [default: %default]')
+    parser.add_option('--nodes', type='int', default=20,
+                      help='simulated sensor nodes [default: %default]')
+    parser.add_option('--latency', type='float', default=0.02,
+                      help='simulated node latency [default: %default]')
+    parser.add_option('--failure-rate', type='float', default=0.0,
+                      help='simulated unanswered reads [default: %default]')
+    parser.add_option('--boards', type='int', default=4,
+                      help='simulated ext boards [default: %default]')
+    parser.add_option('--cycles', type='int', default=5,
+                      help='polling cycles [default: %default]')
+    parser.add_option('--timeout', type='float', default=0.5,
+                      help='read timeout [default: %default]')
+    parser.add_option('--image-size', type='int', default=32 * 1024,
+                      help='upgrade image bytes [default: %default]')
+    options, args = parser.parse_args()
+
+    if options.list or not args:
+        for name in sorted(BENCHMARKS):
+            print('%-12s %s' % (name, BENCHMARKS[name].__doc__))
+        return 0
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    for name in args:
+        BENCHMARKS[name](options)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
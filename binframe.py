@@ -0,0 +1,156 @@
+"""
+Binary frames of the ext board protocol.
+
+Once the board acknowledged set_frame_mode(1) with {"frame": 1}, register
+reads go out and come back as binary frames instead of text commands and
+JSON answers:
+
+    0xA5 | type | seq | payload length (2) | payload | CRC-16 (2)
+
+Numbers are big endian, the CRC-16 is the XMODEM one over type to the end
+of the payload. The answer carries the sequence number of its request, so
+a late answer of a timed out read is never taken for the next one.
+
+    READ    0x01  bus, node, addr (2), size (2)
+    DATA    0x81  registers, 2 bytes each
+    STATUS  0x82  status
+
+A read failing on the 485 bus gets no answer, like in JSON mode. Text
+commands and JSON answers are still accepted in binary mode, FrameReader
+passes the bytes outside binary frames on as text. A header whose frame
+is not complete after FRAME_TIMEOUT is a false one too: on a request and
+answer link the rest may never come, and the answers behind it would
+wait for it forever.
+"""
+
+import time
+import struct
+
+from xmodem import calc_crc16
+
+SYNC = 0xa5
+READ = 0x01
+DATA = 0x81
+STATUS = 0x82
+# Payloads are well below this, larger means a false sync byte
+MAX_PAYLOAD = 512
+# Seconds a frame may take to complete, as a read answer
+FRAME_TIMEOUT = 2.0
+
+_HEADER = struct.Struct('>BBBH')  # sync, type, seq, payload length
+_READ = struct.Struct('>BBHH')
+_CRC = struct.Struct('>H')
+_SYNC = bytearray([SYNC])
+_TYPES = (READ, DATA, STATUS)
+
+_crc = calc_crc16
+
+
+def encode(ftype, seq, payload=b''):
+    frame = bytearray(_HEADER.pack(SYNC, ftype, seq & 0xff, len(payload)))
+    frame += payload
+    frame += _CRC.pack(_crc(memoryview(frame)[1:]))
+    return bytes(frame)
+
+
+def encode_read(seq, bus, node, addr, size):
+    return encode(READ, seq, _READ.pack(bus, node, addr, size))
+
+
+def encode_data(seq, registers):
+    return encode(DATA, seq, struct.pack('>%dH' % len(registers),
+                                         *registers))
+
+
+def encode_status(seq, status):
+    return encode(STATUS, seq, struct.pack('>B', status & 0xff))
+
+
+def decode(ftype, seq, payload):
+    """Message of a frame, as the JSON protocol would give it"""
+    if ftype == DATA:
+        return {'data': list(struct.unpack('>%dH' % (len(payload) // 2),
+                                           payload)), 'seq': seq}
+    if ftype == STATUS:
+        return {'status': bytearray(payload[:1])[0], 'seq': seq}
+    return {'read': list(_READ.unpack(payload)), 'seq': seq}
+
+
+class FrameReader(object):
+    """
+    Split a byte stream into binary frames and the text between them.
+    Frames with a bad CRC are dropped and scanning resumes right after
+    their sync byte. dropped counts the frames lost, a sync byte starting
+    no valid header, or found in the span of a dropped frame, is not one.
+    A frame still incomplete timeout seconds after its header came is
+    passed on as text from its sync byte too.
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD, timeout=FRAME_TIMEOUT):
+        self.max_payload = max_payload
+        self.timeout = timeout
+        self.frames = 0
+        self.dropped = 0
+        self._buf = bytearray()
+        self._broken = 0  # end in _buf of the last dropped frame
+        self._since = None  # time the frame at the start of _buf came
+
+    def reset(self):
+        self._buf = bytearray()
+        self._broken = 0
+        self._since = None
+
+    def feed(self, data):
+        """
+        [(type, seq, payload)] of the complete frames in order, a text
+        chunk is returned as (None, None, bytes)
+        """
+        buf = self._buf
+        buf += data
+        result = []
+        pos = 0
+        waiting = None
+        while pos < len(buf):
+            start = buf.find(_SYNC, pos)
+            if start < 0:
+                start = len(buf)
+            if start > pos:
+                result.append((None, None, bytes(buf[pos:start])))
+                pos = start
+                continue
+            if len(buf) - pos < _HEADER.size:
+                break
+            sync, ftype, seq, length = _HEADER.unpack_from(buf, pos)
+            if ftype not in _TYPES or length > self.max_payload:
+                result.append((None, None, bytes(buf[pos:pos + 1])))
+                pos += 1
+                continue
+            end = pos + _HEADER.size + length
+            if len(buf) < end + _CRC.size:
+                now = time.time()
+                if pos or self._since is None:
+                    waiting = now
+                    break
+                if now - self._since < self.timeout:
+                    waiting = self._since
+                    break
+                # the rest never came, a false header
+                self._since = None
+                result.append((None, None, bytes(buf[pos:pos + 1])))
+                pos += 1
+                continue
+            if _crc(memoryview(buf)[pos + 1:end]) != \
+                    _CRC.unpack_from(buf, end)[0]:
+                if pos >= self._broken:
+                    self.dropped += 1
+                    self._broken = end + _CRC.size
+                result.append((None, None, bytes(buf[pos:pos + 1])))
+                pos += 1
+                continue
+            result.append((ftype, seq, bytes(buf[pos + _HEADER.size:end])))
+            self.frames += 1
+            pos = end + _CRC.size
+        del buf[:pos]
+        self._broken = max(0, self._broken - pos)
+        self._since = waiting
+        return result
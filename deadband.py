@@ -0,0 +1,114 @@
+"""
+Change-only uploads.
+
+Every sensor of the register image is compared with the last uploaded
+image, and only the sensors which moved out of their deadband are sent.
+A full image (keyframe) is still sent every keyframe interval so the
+server can resync.
+
+Keyframe: the usual upload message with ``key`` 1 and ``seq``.
+Delta: ``key`` 0, ``seq`` and ``delta``, a list of [reg, [values]] to
+write over the image rebuilt from the previous messages; ``data`` is
+left out and ``values`` only keeps the typed values of those sensors.
+A change of the quality codes in ``quality`` is sent even when no value
+moved. Messages are numbered by ``seq`` so the server can detect a gap
+and wait for the next keyframe.
+"""
+
+import time
+
+# Seconds between two full image uploads
+KEYFRAME_INTERVAL = 600
+
+
+class DeadbandFilter(object):
+    """
+    :param sensormap: rows of [reg, description, bus, node, addr, size,
+        interval, deadband, deadband_pct], the last three optional
+    :param deadband: absolute deadband of sensors without one
+    :param deadband_pct: deadband in percent of the last uploaded value,
+        for sensors without one
+    :param keyframe_interval: max seconds between two full images
+    """
+
+    def __init__(self, sensormap, deadband=0, deadband_pct=0,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.sensors = []
+        for row in sensormap:
+            absolute = row[7] if len(row) > 7 and row[7] is not None \
+                else deadband
+            pct = row[8] if len(row) > 8 and row[8] is not None \
+                else deadband_pct
+            self.sensors.append((row[0], row[5], absolute, pct / 100.0))
+        self.seq = 0
+        self._image = None
+        self._keyframe = 0
+        self._codes = None
+        self.messages_sent = 0
+        self.messages_suppressed = 0
+        self.bytes_sent = 0
+        self.bytes_suppressed = 0
+
+    def changed(self, old, new, absolute, ratio):
+        for a, b in zip(old, new):
+            if abs(b - a) > max(absolute, abs(a) * ratio):
+                return True
+        return False
+
+    def encode(self, msg, values, now=None):
+        """
+        Return the message to upload for the register image values, with
+        msg providing the other fields, or None when nothing changed.
+        """
+        if now is None:
+            now = time.time()
+        values = list(values)
+        codes = [q[1] for q in msg.get('quality', ())]
+        full = dict(msg, data=values)
+        if self._image is None or len(self._image) != len(values) or \
+                now - self._keyframe >= self.keyframe_interval:
+            out = dict(full, key=1, seq=self.seq)
+            self._image = values
+            self._keyframe = now
+        else:
+            delta = []
+            image = self._image
+            for reg, size, absolute, ratio in self.sensors:
+                old = image[reg:reg + size]
+                new = values[reg:reg + size]
+                if self.changed(old, new, absolute, ratio):
+                    delta.append([reg, new])
+                    image[reg:reg + size] = new
+            if not delta and codes == self._codes:
+                self.messages_suppressed += 1
+                self.bytes_suppressed += len(str(full))
+                return None
+            out = dict(msg, key=0, seq=self.seq, delta=delta)
+            if 'values' in msg:
+                moved = set(reg for reg, new in delta)
+                out['values'] = [v for v in msg['values'] if v[0] in moved]
+            self.bytes_suppressed += max(0, len(str(full)) - len(str(out)))
+        self._codes = codes
+        self.seq += 1
+        self.messages_sent += 1
+        self.bytes_sent += len(str(out))
+        return out
+
+    def stats(self):
+        return {
+            'messages_sent': self.messages_sent,
+            'messages_suppressed': self.messages_suppressed,
+            'bytes_sent': self.bytes_sent,
+            'bytes_suppressed': self.bytes_suppressed,
+        }
+
+
+def rebuild(image, msg):
+    """Server side: apply an uploaded message to image, return the image"""
+    if msg.get('key', 1):
+        return list(msg['data'])
+    image = list(image)
+    for reg, values in msg['delta']:
+        image[reg:reg + len(values)] = values
+    return image
@@ -0,0 +1,185 @@
+"""
+Local time-series history of the register image.
+
+Every sensormap row gets a fixed size ring buffer file, memory mapped and
+laid out as a header, a column of timestamps and a column of register
+values. Appending writes into the map only, the kernel writes the pages
+back and ``flush()`` is called from time to time, so there is no fsync
+per sample. Samples are appended in time order, a time range lookup is a
+binary search over the ring. Samples keep their real timestamps when the
+clock steps back by up to a poll interval, a few of them are then a bit
+out of order; on a longer step back the samples stamped after the new
+time are dropped.
+"""
+
+import os
+import mmap
+import time
+import struct
+import logging
+import threading
+
+# Days of samples kept by default
+HISTORY_DAYS = 3
+# Seconds between two flushes of the history files
+HISTORY_SYNC_INTERVAL = 60
+
+_MAGIC = b'SHR1'
+_HEADER = struct.Struct('<4sIIIQQ')  # magic, size, capacity, 0, head, count
+_STAMP = struct.Struct('<d')
+
+
+class RingFile(object):
+    """
+    Ring buffer of (timestamp, registers) samples in one file.
+
+    :param filename: backing file, created or resized when needed
+    :param size: registers per sample
+    :param capacity: samples kept
+    :param max_step: seconds the clock may step back before the samples
+        stamped after the new time are dropped
+    """
+
+    def __init__(self, filename, size, capacity, max_step=0.0):
+        self.filename = filename
+        self.size = size
+        self.capacity = capacity
+        self.max_step = max_step
+        self._value = struct.Struct('<%dH' % size)
+        self._stamps = _HEADER.size
+        self._values = self._stamps + capacity * _STAMP.size
+        length = self._values + capacity * self._value.size
+        self._lock = threading.Lock()
+
+        fresh = True
+        if os.path.exists(filename) and os.path.getsize(filename) == length:
+            with open(filename, 'rb') as f:
+                magic, fsize, fcap = _HEADER.unpack(f.read(_HEADER.size))[:3]
+            fresh = (magic, fsize, fcap) != (_MAGIC, size, capacity)
+        if fresh:
+            if os.path.exists(filename):
+                logging.warning('history %s layout changed, restarted'
+                                % filename)
+            with open(filename, 'wb') as f:
+                f.truncate(length)
+        self._file = open(filename, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), length)
+        if fresh:
+            _HEADER.pack_into(self._mm, 0, _MAGIC, size, capacity, 0, 0, 0)
+        self.head, self.count = _HEADER.unpack_from(self._mm, 0)[4:]
+
+    def _stamp(self, idx):
+        """Timestamp of the idx-th oldest sample"""
+        pos = (self.head - self.count + idx) % self.capacity
+        return _STAMP.unpack_from(self._mm, self._stamps +
+                                  pos * _STAMP.size)[0]
+
+    def _sample(self, idx):
+        pos = (self.head - self.count + idx) % self.capacity
+        stamp = _STAMP.unpack_from(self._mm, self._stamps +
+                                   pos * _STAMP.size)[0]
+        values = self._value.unpack_from(self._mm, self._values +
+                                         pos * self._value.size)
+        return stamp, list(values)
+
+    def append(self, stamp, values):
+        with self._lock:
+            if self.count and \
+                    stamp < self._stamp(self.count - 1) - self.max_step:
+                self._truncate(stamp)
+            pos = self.head
+            _STAMP.pack_into(self._mm, self._stamps + pos * _STAMP.size, stamp)
+            self._value.pack_into(self._mm, self._values +
+                                  pos * self._value.size,
+                                  *[int(v) & 0xffff for v in values])
+            self.head = (pos + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            _HEADER.pack_into(self._mm, 0, _MAGIC, self.size, self.capacity,
+                              0, self.head, self.count)
+
+    def _truncate(self, stamp):
+        """Drop the samples stamped after stamp, the clock stepped back"""
+        count = self._bisect(stamp)
+        logging.warning('history %s: clock stepped back %.0fs, %d later '
+                        'samples dropped' % (
+                        self.filename, self._stamp(self.count - 1) - stamp,
+                        self.count - count))
+        self.head = (self.head - (self.count - count)) % self.capacity
+        self.count = count
+
+    def _bisect(self, stamp):
+        """Index of the first sample not older than stamp"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._stamp(mid) < stamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start, end):
+        """Samples with start <= timestamp < end, oldest first"""
+        with self._lock:
+            first = self._bisect(start)
+            last = self._bisect(end)
+            return [self._sample(i) for i in range(first, last)]
+
+    def latest(self, count):
+        """The last count samples, oldest first"""
+        with self._lock:
+            count = min(count, self.count)
+            return [self._sample(i)
+                    for i in range(self.count - count, self.count)]
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
+
+
+class HistoryStore(object):
+    """
+    History of every sensormap row, keyed by its register offset.
+
+    :param path: directory of the ring files
+    :param sensormap: rows of [reg, description, bus, node, addr, size, ...]
+    :param days: days of samples kept at the poll interval of each row
+    :param interval: callable returning the poll interval of a row
+    """
+
+    def __init__(self, path, sensormap, interval, days=HISTORY_DAYS):
+        self.path = path
+        self.days = days
+        self.rings = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for row in sensormap:
+            reg, size = row[0], row[5]
+            capacity = max(1, int(days * 86400 / interval(row)))
+            self.rings[reg] = RingFile(
+                os.path.join(path, 'reg%04d.ring' % reg), size, capacity,
+                interval(row))
+
+    def append(self, reg, values, stamp=None):
+        ring = self.rings.get(reg)
+        if ring is not None:
+            ring.append(time.time() if stamp is None else stamp, values)
+
+    def range(self, reg, start, end=None):
+        ring = self.rings[reg]
+        return ring.range(start, time.time() + 1 if end is None else end)
+
+    def latest(self, reg, count=1):
+        return self.rings[reg].latest(count)
+
+    def flush(self):
+        for ring in self.rings.values():
+            ring.flush()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
@@ -0,0 +1,130 @@
+"""
+Incremental JSON framer for the ext board uart stream.
+
+Bytes are fed as they come off the serial port. Only the new bytes are
+scanned, every complete JSON object is decoded exactly once, a partial
+trailing frame is kept for the next chunk and anything outside a frame
+(boot messages, line noise) is skipped.
+"""
+
+from __future__ import division, print_function
+
+import re
+import json
+import logging
+
+# Ext board responses are well below this, larger means a lost '}'
+MAX_FRAME_SIZE = 4096
+
+_FRAME_START = re.compile(b'{')
+_OUTSIDE_STRING = re.compile(b'[{}"]')
+_INSIDE_STRING = re.compile(b'["\\\\]')
+
+_OPEN = ord(b'{')
+_CLOSE = ord(b'}')
+_QUOTE = ord(b'"')
+
+
+class JSONFramer(object):
+    """
+    Split a byte stream into JSON objects.
+
+    :param max_size: max bytes of a single frame, longer frames are dropped
+    """
+
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.frames = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        self._buf = bytearray()
+        self._pos = 0  # next byte to scan
+        self._depth = 0  # 0: looking for a frame start
+        self._in_string = False
+
+    def feed(self, data):
+        """Scan data and return the list of complete objects"""
+        buf = self._buf
+        buf.extend(data)
+        messages = []
+        pos = self._pos
+        start = 0
+        while True:
+            if self._depth == 0:
+                m = _FRAME_START.search(buf, pos)
+                if m is None:
+                    self.skipped += len(buf) - start
+                    start = pos = len(buf)
+                    break
+                self.skipped += m.start() - start
+                start = m.start()
+                pos = m.end()
+                self._depth = 1
+                continue
+
+            if pos - start > self.max_size:
+                self._drop(buf, start, pos)
+                start = pos
+                continue
+
+            if self._in_string:
+                m = _INSIDE_STRING.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if buf[m.start()] == _QUOTE:
+                    self._in_string = False
+                    pos = m.end()
+                elif m.end() < len(buf):
+                    pos = m.end() + 1  # skip the escaped char
+                else:
+                    pos = m.start()  # wait for the escaped char
+                    break
+                continue
+
+            m = _OUTSIDE_STRING.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            pos = m.end()
+            char = buf[m.start()]
+            if char == _QUOTE:
+                self._in_string = True
+            elif char == _OPEN:
+                self._depth += 1
+            elif char == _CLOSE:
+                self._depth -= 1
+                if self._depth == 0:
+                    if pos - start > self.max_size:
+                        self._drop(buf, start, pos)
+                    else:
+                        self._emit(buf, start, pos, messages)
+                    start = pos
+
+        if self._depth and len(buf) - start > self.max_size:
+            self._drop(buf, start, len(buf))
+            start = pos = len(buf)
+
+        # forget consumed bytes, keep the partial frame
+        if start:
+            del buf[:start]
+            pos -= start
+        self._pos = pos
+        return messages
+
+    def _emit(self, buf, start, end, messages):
+        try:
+            messages.append(json.loads(bytes(buf[start:end]).decode('utf-8')))
+            self.frames += 1
+        except ValueError:
+            self.dropped += 1
+            logging.info('invalid message: [%r]', bytes(buf[start:end]))
+
+    def _drop(self, buf, start, end):
+        self.dropped += 1
+        logging.info('drop oversize frame (%d bytes)', end - start)
+        self._depth = 0
+        self._in_string = False
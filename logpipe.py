@@ -0,0 +1,176 @@
+"""
+Asynchronous logging.
+
+Logging calls only append their record to a bounded queue, a writer
+thread wakes up every WRITE_INTERVAL, formats the queued records and
+writes them to the real handlers, so a slow SD card never delays a poll
+and a logging call never waits for a lock. Messages are formatted by the
+writer, pass the arguments instead of formatting in place:
+
+    logging.debug('<recv>: %r', data)
+
+A record carrying a ratelimit key is let through once per interval for
+that key, the next one tells how many were suppressed:
+
+    logging.info('failed to read node %d', node, extra={'ratelimit': node})
+"""
+
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+# Records waiting for the writer, more are dropped and counted
+LOG_QUEUE_SIZE = 10000
+# Seconds between two runs of the writer
+WRITE_INTERVAL = 0.1
+# Seconds between two records of the same ratelimit key
+RATE_INTERVAL = 60
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    :param interval: seconds between two records of the same key
+    """
+
+    def __init__(self, interval=RATE_INTERVAL):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.suppressed = 0
+        self._keys = {}  # key: (time let through, suppressed since)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'ratelimit', None)
+        if key is None:
+            return True
+        with self._lock:
+            passed, count = self._keys.get(key, (None, 0))
+            if passed is not None and record.created - passed < self.interval:
+                self._keys[key] = (passed, count + 1)
+                self.suppressed += 1
+                return False
+            self._keys[key] = (record.created, 0)
+        if count:
+            record.msg = '%s (%d more in %.0fs)' % (
+                record.msg, count, record.created - passed)
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """
+    Append records to a deque, unformatted, dropping them when it holds
+    max_size records
+    """
+
+    def __init__(self, records, max_size=LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.records = records
+        self.max_size = max_size
+        self.dropped = 0
+        self._formatter = logging.Formatter()
+
+    def handle(self, record):
+        # no handler lock, deque appends are atomic
+        if self.filter(record):
+            self.emit(record)
+
+    def emit(self, record):
+        if record.exc_info:
+            # tracebacks do not outlive the caller frame, format them now
+            record.exc_text = self._formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if len(self.records) < self.max_size:
+            self.records.append(record)
+        else:
+            self.dropped += 1
+
+
+class AsyncLogging(object):
+    """
+    Route records through a queue to handlers run by a writer thread.
+
+    :param handlers: logging handlers, written from the writer thread only
+    :param queue_size: max records waiting for the writer
+    :param rate_interval: seconds between two records of a ratelimit key
+    :param interval: seconds between two runs of the writer
+    """
+
+    def __init__(self, handlers, queue_size=LOG_QUEUE_SIZE,
+                 rate_interval=RATE_INTERVAL, interval=WRITE_INTERVAL):
+        self.handlers = list(handlers)
+        self.interval = interval
+        self.records = deque()
+        self.handler = QueueHandler(self.records, queue_size)
+        self.limiter = RateLimitFilter(rate_interval)
+        self.handler.addFilter(self.limiter)
+        self.written = 0
+        self._reported = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='logwriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Write what is queued and close the handlers"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        for handler in self.handlers:
+            handler.close()
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+        self.written += 1
+
+    def write_queued(self):
+        """Write the queued records, returns how many"""
+        records = self.records
+        count = 0
+        while records:
+            self._write(records.popleft())
+            count += 1
+        dropped = self.handler.dropped
+        if dropped != self._reported:
+            self._write(logging.makeLogRecord({
+                'name': 'logpipe', 'levelno': logging.WARNING,
+                'levelname': 'WARNING', 'created': time.time(),
+                'msg': '%d log records dropped, the queue was full'
+                       % (dropped - self._reported)}))
+            self._reported = dropped
+        return count
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.write_queued()
+        self.write_queued()
+
+
+def install(handlers, level=logging.INFO, queue_size=LOG_QUEUE_SIZE,
+            rate_interval=RATE_INTERVAL):
+    """
+    Make handlers the asynchronous handlers of the root logger, replacing
+    its handlers, e.g. the ones inherited by a forked process, whose
+    writer thread did not survive the fork. Returns the AsyncLogging.
+    """
+    pipe = AsyncLogging(handlers, queue_size, rate_interval)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(pipe.handler)
+    root.setLevel(level)
+    pipe.start()
+    atexit.register(pipe.stop)
+    return pipe
@@ -0,0 +1,371 @@
+"""
+Modbus TCP server serving an immutable register image snapshot.
+
+The poller writes into a working image and publishes it after each read,
+which packs it once into an immutable bytes snapshot and swaps a single
+reference. Client requests are answered from whatever snapshot is
+current, so they never wait for acquisition and acquisition never waits
+for them.
+
+All connections are handled by one event loop thread over epoll (select
+where epoll is missing), each with its own non-blocking socket and
+buffers. Supported functions: 3 and 4 (read, both served from the
+holding register image), 6 and 16 (write). Several slaves can be served
+by unit id, like modbus_tk add_slave/get_slave.
+"""
+
+import errno
+import socket
+import select
+import struct
+import logging
+import threading
+
+MODBUS_PORT = 502
+# Block type of add_block, as modbus_tk.defines, every block is served as
+# holding registers
+HOLDING_REGISTERS = 3
+
+_MBAP = struct.Struct('>HHHB')
+_ADDR_QTY = struct.Struct('>HH')
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+
+class SnapshotSlave(object):
+    """
+    Register image with the modbus_tk slave add_block/get_values/set_values
+    calls used by SensorManager, plus publish(). When size is given, block
+    '0' of size registers starts at address 0. Addresses are absolute as
+    in modbus_tk.
+    """
+
+    def __init__(self, size=None):
+        self._blocks = {}  # name: (start, image)
+        self._lock = threading.Lock()
+        self.snapshot = ()  # ((start, end, packed registers), ...)
+        self.publishes = 0
+        if size is not None:
+            self.add_block('0', HOLDING_REGISTERS, 0, size)
+        self.publish()
+
+    @property
+    def size(self):
+        """Registers of every block"""
+        return sum(len(image) for start, image in self._blocks.values())
+
+    def add_block(self, name, block_type, start, size):
+        with self._lock:
+            if name in self._blocks:
+                raise ValueError('block %s already exists' % name)
+            for other, image in self._blocks.values():
+                if start < other + len(image) and other < start + size:
+                    raise ValueError('block %s overlaps another one' % name)
+            self._blocks[name] = (start, [0] * size)
+
+    def remove_block(self, name):
+        with self._lock:
+            del self._blocks[name]
+
+    def _locate(self, block, address, count):
+        start, image = self._blocks[block]
+        offset = address - start
+        if offset < 0 or offset + count > len(image):
+            raise ValueError('register %d+%d out of block %s' % (
+                             address, count, block))
+        return image, offset
+
+    def set_values(self, block, address, values):
+        with self._lock:
+            image, offset = self._locate(block, address, len(values))
+            image[offset:offset + len(values)] = \
+                [int(v) & 0xffff for v in values]
+
+    def get_values(self, block, address, size=1):
+        with self._lock:
+            image, offset = self._locate(block, address, size)
+            return tuple(image[offset:offset + size])
+
+    def publish(self):
+        """Make the current image visible to the clients"""
+        with self._lock:
+            # swapped under the lock, so boards sharing the slave never
+            # replace a newer snapshot with an older one
+            self.snapshot = tuple(
+                (start, start + len(image),
+                 struct.pack('>%dH' % len(image), *image))
+                for start, image in self._blocks.values())
+            self.publishes += 1
+
+    def read(self, address, count):
+        """Packed registers from the current snapshot, None if unmapped"""
+        for start, end, data in self.snapshot:
+            if start <= address and address + count <= end:
+                return data[(address - start) * 2:(address - start + count) * 2]
+        return None
+
+    def block_at(self, address, count):
+        """Name of the block holding address+count, None if unmapped"""
+        for name, (start, image) in self._blocks.items():
+            if start <= address and address + count <= start + len(image):
+                return name
+        return None
+
+
+class _Connection(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+
+
+class SnapshotServer(object):
+    """
+    :param slave: SnapshotSlave served to the clients at unit, and at unit
+        0 and 255; more slaves are added by add_slave()
+    :param address: listening address
+    :param port: listening port
+    :param unit: unit id of slave
+    """
+
+    def __init__(self, slave=None, address='', port=MODBUS_PORT, unit=1):
+        self.slave = None
+        self.slaves = {}
+        self.address = address
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._conns = {}
+        self._sock = None
+        self._thread = None
+        self._running = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        if slave is not None:
+            self.add_slave(unit, slave)
+
+    def add_slave(self, unit, slave=None):
+        """Serve slave, a new empty SnapshotSlave by default, at unit"""
+        if unit in self.slaves or unit in (0, 255):
+            raise ValueError('unit %d is already served' % unit)
+        if slave is None:
+            slave = SnapshotSlave()
+        self.slaves[unit] = slave
+        if self.slave is None:
+            self.slave = slave  # the one answering unit 0 and 255
+        return slave
+
+    def get_slave(self, unit):
+        return self.slaves[unit]
+
+    def _slave_of(self, unit):
+        slave = self.slaves.get(unit)
+        if slave is None and unit in (0, 255):
+            return self.slave
+        return slave
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.address, self.port))
+        self._sock.listen(128)
+        self._sock.setblocking(False)
+        self.port = self._sock.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('snapshot modbus server listening on port %d' % self.port)
+
+    def stop(self):
+        self._running = False
+        self._wake_w.send(b'x')
+        if self._thread:
+            self._thread.join()
+        for conn in list(self._conns.values()):
+            conn.sock.close()
+        self._conns.clear()
+        if self._sock is not None:
+            self._sock.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def run(self):
+        if hasattr(select, 'epoll'):
+            self._run_epoll()
+        else:
+            self._run_select()
+
+    def _run_epoll(self):
+        ep = select.epoll()
+        listen_fd = self._sock.fileno()
+        wake_fd = self._wake_r.fileno()
+        ep.register(listen_fd, select.EPOLLIN)
+        ep.register(wake_fd, select.EPOLLIN)
+        while self._running:
+            try:
+                events = ep.poll(1.0)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == listen_fd:
+                    for conn in self._accept():
+                        ep.register(conn.sock.fileno(), select.EPOLLIN)
+                    continue
+                if fd == wake_fd:
+                    continue
+                conn = self._conns.get(fd)
+                if conn is None:
+                    continue
+                if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                    if not self._on_readable(conn):
+                        ep.unregister(fd)
+                        self._close(conn)
+                        continue
+                if event & select.EPOLLOUT or conn.outbuf:
+                    if not self._on_writable(conn):
+                        ep.unregister(fd)
+                        self._close(conn)
+                        continue
+                ep.modify(fd, select.EPOLLIN |
+                          (select.EPOLLOUT if conn.outbuf else 0))
+        ep.close()
+
+    def _run_select(self):
+        while self._running:
+            socks = [self._sock, self._wake_r] + \
+                [c.sock for c in self._conns.values()]
+            wsocks = [c.sock for c in self._conns.values() if c.outbuf]
+            rlist, wlist, _ = select.select(socks, wsocks, [], 1.0)
+            for sock in rlist:
+                if sock is self._sock:
+                    self._accept()
+                    continue
+                if sock is self._wake_r:
+                    continue
+                conn = self._conns.get(sock.fileno())
+                if conn and (not self._on_readable(conn) or
+                             not self._on_writable(conn)):
+                    self._close(conn)
+            for sock in wlist:
+                conn = self._conns.get(sock.fileno())
+                if conn and not self._on_writable(conn):
+                    self._close(conn)
+
+    def _accept(self):
+        conns = []
+        while True:
+            try:
+                sock, addr = self._sock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return conns
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, addr)
+            self._conns[sock.fileno()] = conn
+            conns.append(conn)
+            logging.debug('modbus client %s connected' % (addr,))
+
+    def _close(self, conn):
+        self._conns.pop(conn.sock.fileno(), None)
+        conn.sock.close()
+        logging.debug('modbus client %s disconnected' % (conn.addr,))
+
+    def _on_readable(self, conn):
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        if not data:
+            return False
+        buf = conn.inbuf
+        buf.extend(data)
+        # answer every complete frame, pipelined requests included
+        while len(buf) >= _MBAP.size:
+            tid, pid, length, unit = _MBAP.unpack_from(buf, 0)
+            if pid != 0 or length < 2 or length > 254:
+                return False
+            end = 6 + length
+            if len(buf) < end:
+                break
+            pdu = bytes(buf[_MBAP.size:end])
+            del buf[:end]
+            slave = self._slave_of(unit)
+            if slave is None:
+                continue
+            resp = self.handle(pdu, slave)
+            conn.outbuf.extend(_MBAP.pack(tid, 0, len(resp) + 1, unit))
+            conn.outbuf.extend(resp)
+        return True
+
+    def _on_writable(self, conn):
+        if not conn.outbuf:
+            return True
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        del conn.outbuf[:sent]
+        return True
+
+    def _exception(self, function, code):
+        self.errors += 1
+        return struct.pack('>BB', function | 0x80, code)
+
+    def handle(self, pdu, slave=None):
+        """Return the response pdu of a request pdu to slave"""
+        if slave is None:
+            slave = self.slave
+        self.requests += 1
+        function = ord(pdu[0:1])
+        if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+            if len(pdu) != 5:
+                return self._exception(function, ILLEGAL_DATA_VALUE)
+            address, count = _ADDR_QTY.unpack_from(pdu, 1)
+            if count < 1 or count > 125:
+                return self._exception(function, ILLEGAL_DATA_VALUE)
+            data = slave.read(address, count)  # one snapshot, never torn
+            if data is None:
+                return self._exception(function, ILLEGAL_DATA_ADDRESS)
+            return struct.pack('>BB', function, count * 2) + data
+        elif function == WRITE_SINGLE_REGISTER:
+            if len(pdu) != 5:
+                return self._exception(function, ILLEGAL_DATA_VALUE)
+            address, value = _ADDR_QTY.unpack_from(pdu, 1)
+            block = slave.block_at(address, 1)
+            if block is None:
+                return self._exception(function, ILLEGAL_DATA_ADDRESS)
+            slave.set_values(block, address, [value])
+            slave.publish()
+            return pdu
+        elif function == WRITE_MULTIPLE_REGISTERS:
+            if len(pdu) < 6:
+                return self._exception(function, ILLEGAL_DATA_VALUE)
+            address, count = _ADDR_QTY.unpack_from(pdu, 1)
+            nbytes = ord(pdu[5:6])
+            if count < 1 or count > 123 or nbytes != count * 2 or \
+                    len(pdu) != 6 + nbytes:
+                return self._exception(function, ILLEGAL_DATA_VALUE)
+            block = slave.block_at(address, count)
+            if block is None:
+                return self._exception(function, ILLEGAL_DATA_ADDRESS)
+            values = struct.unpack('>%dH' % count, pdu[6:])
+            slave.set_values(block, address, values)
+            slave.publish()
+            return pdu[:5]
+        return self._exception(function, ILLEGAL_FUNCTION)
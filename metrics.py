@@ -0,0 +1,284 @@
+"""
+Process metrics.
+
+Counters, gauges and histograms are kept in plain Python objects, a
+recording is one attribute update or one bisect, so they stay on in
+production. Labelled values are looked up once and kept by the caller:
+
+    reads = REGISTRY.counter('reads_total', 'reads', ('bus', 'node'))
+    node_reads = reads.labels(1, 3)
+    node_reads.inc()
+
+Updates are not locked: with the GIL a concurrent increment is lost at
+worst, which is fine for monitoring. The registry is exposed in the
+Prometheus text format by MetricsServer and saved as JSON snapshots.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Default port of the metrics endpoint
+METRICS_PORT = 9108
+# Histogram bounds in seconds, for serial reads and uploads
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Value(object):
+    """Counter or gauge value, or a function called when collected"""
+
+    __slots__ = ('value', 'func')
+
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        self.func = func
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+
+class Histogram(object):
+    """Observations counted in buckets by their upper bound"""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value, bisect=bisect_left):
+        # one C bisect and one bucket, cumulated when exposed
+        self.counts[bisect(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class Metric(object):
+    """
+    A metric and its values by label values.
+
+    :param name: metric name
+    :param kind: counter, gauge or histogram
+    :param doc: help text
+    :param labelnames: label names, in the order of labels() arguments
+    :param buckets: upper bounds of a histogram
+    """
+
+    def __init__(self, name, kind, doc, labelnames=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets or LATENCY_BUCKETS))
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Value or Histogram of the label values, created once"""
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s takes labels %s' % (
+                                 self.name, ', '.join(self.labelnames)))
+            with self._lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = Histogram(self.buckets) \
+                        if self.kind == 'histogram' else Value()
+                    self.children[values] = child
+        return child
+
+    def remove(self, *values):
+        self.children.pop(tuple(str(v) for v in values), None)
+
+    def _labels(self, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                                 for k, v in pairs)
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted(self.children.items()):
+            if self.kind != 'histogram':
+                lines.append('%s%s %s' % (self.name, self._labels(values),
+                                          _number(child.get())))
+                continue
+            counts = list(child.cumulative())
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                lines.append('%s_bucket%s %d' % (
+                    self.name, self._labels(values, ('le', _number(bound))),
+                    count))
+            lines.append('%s_sum%s %s' % (self.name, self._labels(values),
+                                          _number(child.sum)))
+            lines.append('%s_count%s %d' % (self.name, self._labels(values),
+                                            counts[-1]))
+        return lines
+
+    def snapshot(self):
+        result = []
+        for values, child in sorted(self.children.items()):
+            item = {'labels': dict(zip(self.labelnames, values))}
+            if self.kind == 'histogram':
+                item.update(count=child.count, sum=child.sum,
+                            buckets=list(zip(self.buckets,
+                                             child.counts)))
+            else:
+                item['value'] = child.get()
+            result.append(item)
+        return result
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    """Metrics of one process, registering a name again returns its metric"""
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, name, kind, doc, labelnames, buckets=None):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(name, kind, doc,
+                                                     labelnames, buckets)
+            elif metric.kind != kind or \
+                    metric.labelnames != tuple(labelnames):
+                raise ValueError('metric %s is already a different %s'
+                                 % (name, metric.kind))
+            return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._register(name, 'counter', doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._register(name, 'gauge', doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(name, 'histogram', doc, labelnames, buckets)
+
+    def exposition(self):
+        """Every metric in the Prometheus text format"""
+        lines = []
+        for name in sorted(self.metrics):
+            try:
+                lines.extend(self.metrics[name].exposition())
+            except Exception as e:
+                logging.error('cannot collect metric %s: %s' % (name, e))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        metrics = {}
+        for name in sorted(self.metrics):
+            try:
+                metrics[name] = self.metrics[name].snapshot()
+            except Exception as e:
+                logging.error('cannot collect metric %s: %s' % (name, e))
+        return {'timestamp': time.time(), 'metrics': metrics}
+
+    def save(self, path):
+        """Write a JSON snapshot to path, replaced atomically"""
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logging.warning('cannot save metrics to %s: %s' % (path, e))
+
+
+# Metrics of this process
+REGISTRY = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug('metrics: ' + fmt % args)
+
+
+class MetricsServer(object):
+    """
+    HTTP endpoint of a registry, in a daemon thread.
+
+    :param registry: Registry served
+    :param address: listening address, local only by default
+    :param port: listening port, 0 for any free port
+    """
+
+    def __init__(self, registry=REGISTRY, address='127.0.0.1',
+                 port=METRICS_PORT):
+        self.registry = registry
+        self._httpd = HTTPServer((address, port), _Handler)
+        self._httpd.registry = registry
+        self.port = self._httpd.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('metrics are served on port %d' % self.port)
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
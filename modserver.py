@@ -6,23 +6,52 @@ import time
 import serial
 import threading
 import logging
+import logging.handlers
 import json
 import subprocess
 import binascii
+import ast
+import struct
 
 from optparse import OptionParser
 
-import modbus_tk
-import modbus_tk.defines as cst
-import modbus_tk.modbus as modbus
-import modbus_tk.modbus_tcp as modbus_tcp
+try:
+    import modbus_tk
+    import modbus_tk.defines as cst
+    import modbus_tk.modbus as modbus
+    import modbus_tk.modbus_tcp as modbus_tcp
+except ImportError:
+    modbus_tk = None  # only the snapshot modbus engine is available
 
-from xmodem import YMODEM
+from xmodem import YMODEM, SerialTransport
+from readplan import ReadPlanner, READ_GAP, POLL_INTERVAL, row_interval
+from scheduler import PollScheduler, LINK_SPACING
+from uploadqueue import SegmentQueue, UploadFlusher, HIGH_WATER
+from uploader import HTTPUploader, UploadError, UPLOAD_WINDOW
+from batchformat import encode_batch, BATCH_CONTENT_TYPE
+from deadband import DeadbandFilter, KEYFRAME_INTERVAL
+from history import HistoryStore, HISTORY_DAYS, HISTORY_SYNC_INTERVAL
+from mbserver import SnapshotSlave, SnapshotServer, MODBUS_PORT, \
+    HOLDING_REGISTERS
+from quality import QualityTable, META_BASE
+from shmimage import SharedImage, SharedSlave, SharedReader, SHM_DIR
+from supervisor import Supervisor, ignore_sigint
+from typedecode import CommandDecoder, is_typed, typed_values
+from pollplan import compile_plan, ConfigWatcher, ConfigError, PLAN_CACHE_DIR
+from transaction import TransactionManager
+from jsonframe import JSONFramer
+from binframe import FrameReader, encode_read, decode as decode_frame
+from reactor import SerialReactor
+from metrics import REGISTRY, MetricsServer, METRICS_PORT
+import logpipe
 
 import urllib
-import urllib2
 
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # not on a Raspberry Pi, e.g. running against the ext board simulator
+    from simulator import GPIO
 GPIO.setmode(GPIO.BCM)
 
 UART_PORT = '/dev/ttyAMA0'  # Raspberry Pi3
@@ -64,6 +93,9 @@ download_message_default = {
 # node: node id
 # addr: register address in real sensor
 # size: register size in real sensor
+# interval: optional poll interval in seconds
+# deadband: optional absolute change needed to upload the sensor
+# deadband_pct: optional change in percent needed to upload the sensor
 SENSORMAP = [
 #    reg, description,      bus, node, addr, size
     [0,   'wind speed',     1,   1,    0,    2],
@@ -77,30 +109,259 @@ SENSORMAP = [
 UPGRADE_CONF_FILENAME = "upgrade.conf"
 # Default image for ext board
 DEFAULT_IMAGE = "default_image.bin"
+# Seconds between two checks of the upgrade configuration file
+UPGRADE_CHECK_INTERVAL = 30
+# Samples waiting for upload are kept here until the server gets them
+SPOOL_DIR = '/var/spool/sensorhub'
+# Seconds between two uploaded samples
+UPLOAD_INTERVAL = 60
+# Sample history of every sensor
+HISTORY_DIR = '/var/lib/sensorhub/history'
+# Seconds between two checks for a changed sensor config
+RELOAD_CHECK_INTERVAL = 1
+# Niceness of the serving and upload processes, below the acquisition
+SERVER_NICE = 5
+UPLOADER_NICE = 10
+# Registers of every board in the range board map, data then quality block
+BOARD_SPAN = 2048
+# A sensor is stale after this many poll intervals without a good read
+STALE_FACTOR = 3
+# Binary reads timed out in a row before the frame mode is negotiated again
+FRAME_MISSES = 10
+# Log file, rotated at LOG_SIZE bytes keeping LOG_BACKUPS older files
+LOG_FILE = '/var/log/sensorhub.log'
+LOG_SIZE = 1024 * 1024
+LOG_BACKUPS = 5
+# Metrics snapshot file and seconds between two snapshots
+METRICS_FILE = '/var/lib/sensorhub/metrics.json'
+METRICS_INTERVAL = 60
+
+# Metrics, the board label is the serial port name
+READ_SECONDS = REGISTRY.histogram(
+    'sensorhub_read_seconds', 'Ext board read latency of answered reads',
+    ('board', 'bus', 'node'))
+READ_TIMEOUTS = REGISTRY.counter(
+    'sensorhub_read_timeouts_total', 'Ext board reads without an answer',
+    ('board', 'bus', 'node'))
+UART_SENT = REGISTRY.counter(
+    'sensorhub_uart_sent_bytes_total', 'Bytes written to the ext board',
+    ('board',))
+UART_RECEIVED = REGISTRY.counter(
+    'sensorhub_uart_received_bytes_total', 'Bytes read from the ext board',
+    ('board',))
+FRAMES_DROPPED = REGISTRY.counter(
+    'sensorhub_frames_dropped_total', 'Ext board frames dropped as broken',
+    ('board', 'parser'))
+UART_SKIPPED = REGISTRY.counter(
+    'sensorhub_uart_skipped_bytes_total',
+    'Ext board bytes outside frames, boot messages and line noise',
+    ('board',))
+POLL_SECONDS = REGISTRY.histogram(
+    'sensorhub_poll_seconds', 'Duration of a planned read and its retries',
+    ('board',))
+UPLOAD_SECONDS = REGISTRY.histogram(
+    'sensorhub_upload_seconds', 'Latency of successful uploads').labels()
+UPLOAD_FAILURES = REGISTRY.counter(
+    'sensorhub_upload_failures_total', 'Failed uploads').labels()
+UPLOAD_DROPPED = REGISTRY.counter(
+    'sensorhub_upload_dropped_total',
+    'Queued records skipped as they cannot be encoded').labels()
+UPLOAD_QUEUE_DEPTH = REGISTRY.gauge(
+    'sensorhub_upload_queue_depth', 'Messages waiting for upload',
+    ('board',))
 
 # setup logger according to running method
 parser = OptionParser()
 parser.add_option("-v", "--verbose",
                   action="store_true", dest="verbose", default=False,
                   help="verbose logging")
-(options, args) = parser.parse_args()
-
-debug_level = logging.DEBUG if options.verbose else logging.INFO
-logging.basicConfig(level=debug_level,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M',
-                    filename='/var/log/sensorhub.log', # TODO: avoid overwritten
-                    filemode='w')
-if options.verbose:
-    # define a Handler which writes DEBUG messages or higher to the sys.stderr
-    console = logging.StreamHandler()
-    console.setLevel(debug_level)
-    # set a format which is simpler for console use
-    formatter = logging.Formatter('%(levelname)-8s %(message)s')
-    # tell the handler to use this format
-    console.setFormatter(formatter)
-    # add the handler to the root logger
-    logging.getLogger('').addHandler(console)
+parser.add_option("-p", "--port",
+                  dest="port", default=UART_PORT,
+                  help="ext board serial ports, comma separated, one "
+                       "acquisition loop each [default: %default]")
+parser.add_option("--reset-pins",
+                  dest="reset_pins", default=str(EXT_BOARD_RST),
+                  help="reset GPIO of every ext board, comma separated in "
+                       "port order, boards without one are not upgraded "
+                       "[default: %default]")
+parser.add_option("--board-map",
+                  type="choice", choices=["unit", "range"],
+                  dest="board_map", default="unit",
+                  help="modbus mapping of the ext boards: unit, board i is "
+                       "unit id i+1, or range, board i starts at register "
+                       "i*%d of unit 1 [default: %%default]" % BOARD_SPAN)
+parser.add_option("-g", "--read-gap",
+                  type="int", dest="read_gap", default=READ_GAP,
+                  help="max unused sensor registers to merge two reads, "
+                       "-1 disables merging [default: %default]")
+parser.add_option("-i", "--interval",
+                  type="float", dest="interval", default=POLL_INTERVAL,
+                  help="poll interval of sensors without one in the config, "
+                       "in seconds [default: %default]")
+parser.add_option("-s", "--link-spacing",
+                  type="float", dest="link_spacing", default=LINK_SPACING,
+                  help="min seconds between two serial transactions "
+                       "[default: %default]")
+parser.add_option("-u", "--upload-interval",
+                  type="float", dest="upload_interval", default=UPLOAD_INTERVAL,
+                  help="seconds between two uploads, 0 disables uploading "
+                       "[default: %default]")
+parser.add_option("--upload-window",
+                  type="int", dest="upload_window", default=UPLOAD_WINDOW,
+                  help="uploads in flight at once over keep-alive "
+                       "connections [default: %default]")
+parser.add_option("--upload-high-water",
+                  type="int", dest="upload_high_water", default=HIGH_WATER,
+                  help="queued samples before the upload rate is thinned, "
+                       "0 never thins [default: %default]")
+parser.add_option("--upload-format",
+                  type="choice", choices=["form", "batch"],
+                  dest="upload_format", default="form",
+                  help="form posts a sample per request, batch posts the "
+                       "queued samples in one compressed columnar body "
+                       "[default: %default]")
+parser.add_option("--spool-dir",
+                  dest="spool_dir", default=SPOOL_DIR,
+                  help="upload queue directory [default: %default]")
+parser.add_option("-c", "--change-only",
+                  action="store_true", dest="change_only", default=False,
+                  help="upload changed sensors only, with periodic keyframes")
+parser.add_option("--deadband",
+                  type="float", dest="deadband", default=0,
+                  help="absolute deadband of sensors without one "
+                       "[default: %default]")
+parser.add_option("--deadband-pct",
+                  type="float", dest="deadband_pct", default=0,
+                  help="deadband in percent of sensors without one "
+                       "[default: %default]")
+parser.add_option("--keyframe-interval",
+                  type="float", dest="keyframe_interval",
+                  default=KEYFRAME_INTERVAL,
+                  help="max seconds between two full uploads in change-only "
+                       "mode [default: %default]")
+parser.add_option("-e", "--modbus-engine",
+                  type="choice", choices=["modbus_tk", "snapshot"],
+                  dest="modbus_engine", default="modbus_tk",
+                  help="modbus TCP server: modbus_tk, or snapshot for the "
+                       "event loop server reading published register "
+                       "snapshots [default: %default]")
+parser.add_option("--modbus-port",
+                  type="int", dest="modbus_port", default=MODBUS_PORT,
+                  help="modbus TCP port [default: %default]")
+parser.add_option("--modbus-address",
+                  dest="modbus_address", default=None,
+                  help="modbus TCP listening address, localhost for "
+                       "modbus_tk and all interfaces for snapshot by default")
+parser.add_option("--history-dir",
+                  dest="history_dir", default=HISTORY_DIR,
+                  help="sample history directory [default: %default]")
+parser.add_option("--history-days",
+                  type="float", dest="history_days", default=HISTORY_DAYS,
+                  help="days of sample history kept, 0 disables it "
+                       "[default: %default]")
+parser.add_option("--stale-factor",
+                  type="float", dest="stale_factor", default=STALE_FACTOR,
+                  help="warn about sensors without a good read for this many "
+                       "poll intervals, 0 disables it [default: %default]")
+parser.add_option("--plan-cache",
+                  dest="plan_cache", default=PLAN_CACHE_DIR,
+                  help="compiled poll plan cache directory, empty disables "
+                       "it [default: %default]")
+parser.add_option("--no-reload",
+                  action="store_false", dest="reload", default=True,
+                  help="do not reload the sensor config when it changes")
+parser.add_option("--processes",
+                  action="store_true", dest="processes", default=False,
+                  help="run acquisition, modbus serving and uploading in "
+                       "separate supervised processes sharing the register "
+                       "image in memory")
+parser.add_option("--shm-dir",
+                  dest="shm_dir", default=SHM_DIR,
+                  help="shared register image directory [default: %default]")
+parser.add_option("--log-file",
+                  dest="log_file", default=LOG_FILE,
+                  help="log file, kept across restarts and rotated "
+                       "[default: %default]")
+parser.add_option("--log-size",
+                  type="int", dest="log_size", default=LOG_SIZE,
+                  help="bytes of the log file before it is rotated "
+                       "[default: %default]")
+parser.add_option("--log-backups",
+                  type="int", dest="log_backups", default=LOG_BACKUPS,
+                  help="rotated log files kept [default: %default]")
+parser.add_option("--log-rate",
+                  type="float", dest="log_rate", default=logpipe.RATE_INTERVAL,
+                  help="seconds between two repeated failure messages of "
+                       "a sensor node [default: %default]")
+parser.add_option("--metrics-port",
+                  type="int", dest="metrics_port", default=METRICS_PORT,
+                  help="local HTTP port of the Prometheus metrics, 0 "
+                       "disables it [default: %default]")
+parser.add_option("--metrics-address",
+                  dest="metrics_address", default="127.0.0.1",
+                  help="metrics listening address [default: %default]")
+parser.add_option("--metrics-file",
+                  dest="metrics_file", default=METRICS_FILE,
+                  help="metrics snapshot file, empty disables it "
+                       "[default: %default]")
+parser.add_option("--metrics-interval",
+                  type="float", dest="metrics_interval",
+                  default=METRICS_INTERVAL,
+                  help="seconds between two metrics snapshots "
+                       "[default: %default]")
+parser.add_option("--framing",
+                  type="choice", choices=["binary", "json"],
+                  dest="framing", default="binary",
+                  help="ext board reads in binary frames when the board "
+                       "supports them, or always in JSON [default: %default]")
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+else:
+    # imported by the benchmarks, use the defaults
+    (options, args) = parser.parse_args([])
+
+# AsyncLogging of setup_logging(), None when the caller set logging up
+_logpipe = None
+
+
+def setup_logging(suffix=''):
+    """
+    Log asynchronously to the rotated log file + suffix, the separate
+    processes call it again with a suffix of their own
+    """
+    global _logpipe
+    debug_level = logging.DEBUG if options.verbose else logging.INFO
+    handlers = []
+    try:
+        logfile = logging.handlers.RotatingFileHandler(
+            options.log_file + suffix, maxBytes=options.log_size,
+            backupCount=options.log_backups)
+        logfile.setFormatter(logging.Formatter(
+            '%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+            '%m-%d %H:%M:%S'))
+        handlers.append(logfile)
+    except (IOError, OSError) as e:
+        sys.stderr.write('cannot log to %s: %s\n' % (options.log_file, e))
+    if options.verbose or not handlers:
+        # define a Handler which writes DEBUG messages or higher to the sys.stderr
+        console = logging.StreamHandler()
+        console.setLevel(debug_level)
+        # set a format which is simpler for console use
+        formatter = logging.Formatter('%(levelname)-8s %(message)s')
+        # tell the handler to use this format
+        console.setFormatter(formatter)
+        handlers.append(console)
+    _logpipe = logpipe.install(handlers, debug_level,
+                               rate_interval=options.log_rate)
+    return _logpipe
+
+
+def start_child(name):
+    """First call of every separate process, name tells its log file"""
+    ignore_sigint()
+    if _logpipe is not None:
+        # the writer thread of the parent did not survive the fork
+        setup_logging('.%s' % name)
 
 
 headers = {
@@ -109,31 +370,140 @@ headers = {
 }
 #url = "http://10.0.0.121:8080/ZhiHuiNongYe/uploaddata.do"
 url = "http://www.ttyoa.com:8080/ZhiHuiNongYe/uploaddata.do"
+_uploader = None
+
+def uploader():
+    """HTTPUploader of url, shared by the boards of this process"""
+    global _uploader
+    if _uploader is None or _uploader.url != url:
+        if _uploader is not None:
+            _uploader.close()
+        _uploader = HTTPUploader(url, window=options.upload_window,
+                                 headers=headers, latency=UPLOAD_SECONDS,
+                                 failures=UPLOAD_FAILURES)
+    return _uploader
+
+def upload_body(msg):
+    if not isinstance(msg, str):
+        msg = str(msg)
+    return urllib.urlencode({'uploaddata': msg})
+
 def upload(msg = None):
-    conn = None
-    response = None
+    """Upload one message, returns the server response or None"""
+    if not msg:
+        msg = {"device": "123456781234567812345678",
+               "timestamp": time.time(),
+               "bus": 1, "node": 1, "command": "read",
+               "data": [0.12, 0.34, 56, 789],
+               "status": 0}
     try:
-        if not msg:
-            msg = {"device": "123456781234567812345678",
-                   "timestamp": time.time(),
-                   "bus": 1, "node": 1, "command": "read",
-                   "data": [0.12, 0.34, 56, 789],
-                   "status": 0}
-        msg2 = {'uploaddata': str(msg)}
-        data = urllib.urlencode(msg2)
-        req = urllib2.Request(url, data)
-        response = urllib2.urlopen(req, timeout=2)
-        logging.info('upload response=%s' % response.read())
-    except Exception as e:
+        response = uploader().post(upload_body(msg))
+    except (UploadError, IOError) as e:
         logging.error('Upload error: %s' % e)
-    finally:
-        if conn:
-            conn.close()
+        UPLOAD_FAILURES.inc()
+        return None
+    logging.info('upload response=%s' % response)
     return response
 
+def upload_record(msg):
+    """Queue record of an upload message"""
+    if options.upload_format == 'batch':
+        return json.dumps(msg, separators=(',', ':'))
+    return str(msg)
+
+def _record_message(record):
+    try:
+        return json.loads(record)
+    except ValueError:
+        return ast.literal_eval(record)  # queued in form format
+
+# What a queued record the batch format cannot take raises
+_ENCODE_ERRORS = (ValueError, TypeError, KeyError, AttributeError,
+                  OverflowError, SyntaxError, struct.error)
+
+def _encodable(record):
+    try:
+        encode_batch([_record_message(record)])
+        return True
+    except _ENCODE_ERRORS as e:
+        logging.error('upload record skipped, cannot encode it (%s): %r'
+                      % (e, record))
+        UPLOAD_DROPPED.inc()
+        return False
+
+def encode_records(msgs):
+    """
+    Batch body of queued records, None when none can be encoded. A record
+    the batch format cannot take is logged and left out: retrying it would
+    hold the queue head forever.
+    """
+    try:
+        return encode_batch([_record_message(msg) for msg in msgs])
+    except _ENCODE_ERRORS:
+        pass
+    msgs = [msg for msg in msgs if _encodable(msg)]
+    if not msgs:
+        return None
+    try:
+        return encode_batch([_record_message(msg) for msg in msgs])
+    except _ENCODE_ERRORS as e:
+        # each one encodes alone, together they do not: skip them all
+        logging.error('upload batch of %d records skipped, cannot encode '
+                      'it (%s): %r' % (len(msgs), e, msgs))
+        UPLOAD_DROPPED.inc(len(msgs))
+        return None
+
+def upload_batch(msgs):
+    """
+    Upload queued messages in order, returns how many were delivered or
+    skipped as they cannot be encoded
+    """
+    if options.upload_format != 'batch':
+        return uploader().send([upload_body(msg) for msg in msgs])
+    try:
+        body = encode_records(msgs)
+        if body is not None:
+            uploader().post(body, {'Content-type': BATCH_CONTENT_TYPE})
+    except (UploadError, IOError) as e:
+        logging.info('batch upload failed: %s' % e)
+        UPLOAD_FAILURES.inc()
+        return 0
+    return len(msgs)
+
+def image_message(cpuid, data, quality, values=None):
+    """
+    Upload message of a register image, its quality table and the
+    [[reg, [typed values]], ...] of the sensors declaring a type
+    """
+    msg = {"device": cpuid,
+           "timestamp": time.time(),
+           "bus": 1, "node": 1, "command": "read",
+           "data": data,
+           "status": 0,
+           "quality": quality}
+    if values:
+        msg["values"] = values
+    return msg
+
+
+def modbus_server():
+    """Start and return the modbus TCP server of the configured engine"""
+    if options.modbus_engine == 'snapshot' or modbus_tk is None:
+        server = SnapshotServer(address=options.modbus_address or '',
+                                port=options.modbus_port)
+    else:
+        kwargs = {'port': options.modbus_port}
+        if options.modbus_address:
+            kwargs['address'] = options.modbus_address
+        server = modbus_tcp.TcpServer(**kwargs)
+    server.start()
+    return server
+
+
 class SensorManager(object):
-    def __init__(self, device, baudrate):
+    def __init__(self, device, baudrate, reset_pin=EXT_BOARD_RST):
         self.device = device
+        self.reset_pin = reset_pin
         self.baudrate = baudrate
         self.cpuid = None
         self.sensormap = SENSORMAP
@@ -151,17 +521,66 @@ class SensorManager(object):
         self._data_to_write = b''
         self.sensor_data = None
         self._mdbus = None
+        self._own_mdbus = False
         self._slave = None
         self._reg_size = 256
-        self._mdbus1 = None
-        self._mdbus2 = None
+        self.base = 0
+        self._data_block = '0'
+        self._quality_block = str(META_BASE)
         self._updating = False
-        self._xmodem_sending = False
-        self._modem = YMODEM(self.modem_read, self.modem_write)
+        self.read_gap = options.read_gap
+        self.interval = options.interval
+        self.link_spacing = options.link_spacing
+        self.upload_interval = options.upload_interval
+        self.planner = None
+        self.plan = None
+        self._scheduler = None
+        self._poll_timeout = 2.0
+        self._poll_jobs = []
+        self._watcher = None
+        self._typed_rows = set()
+        self._typed = {}
+        self._decoders = {}
+        self._trans = TransactionManager(self.write_data)
+        self._framer = JSONFramer()
+        self._frames = FrameReader() if options.framing == 'binary' else None
+        self.binary = False
+        self._seq = 0
+        self._frame_misses = 0
+        self._reactor = SerialReactor(self._dev, self.on_uart_read)
+        self._upload_queue = None
+        self._flusher = None
+        self._deadband = None
+        self._history = None
+        self._quality = QualityTable(self.sensormap)
+        self._stale = set()
+        board = os.path.basename(device)
+        self._node_metrics = {}
+        self._sent = UART_SENT.labels(board)
+        self._received = UART_RECEIVED.labels(board)
+        self._poll_seconds = POLL_SECONDS.labels(board)
+        FRAMES_DROPPED.labels(board, 'json').set_function(
+            lambda: self._framer.dropped)
+        # the bytes outside binary frames go through the JSON framer too
+        UART_SKIPPED.labels(board).set_function(
+            lambda: self._framer.skipped)
+        if self._frames is not None:
+            FRAMES_DROPPED.labels(board, 'binary').set_function(
+                lambda: self._frames.dropped)
+        UPLOAD_QUEUE_DEPTH.labels(board).set_function(
+            lambda: self._upload_queue.depth if self._upload_queue else 0)
+
+    def config_files(self):
+        """Device and common config filenames, by priority"""
+        files = ['dstcommon.conf']
+        if self.cpuid:
+            files.insert(0, 'dst%s.conf' % self.cpuid)
+        return files
 
     def load_config(self):
+        """Load the poll plan of the config file, True when it changed"""
         if not self.cpuid:
-            return
+            return False
 
         cfg = 'dst%s.conf' % self.cpuid
         if not os.path.exists(cfg):
@@ -169,96 +588,133 @@ class SensorManager(object):
             cfg = 'dstcommon.conf'
             if not os.path.exists(cfg):
                 logging.info('common config file %s not found' % cfg)
-                return
-        # reg, description, bus, node, addr, size, default
-        self.sensormap = []
-        for line in file(cfg):
-            if line.startswith('#') or not line.strip():
-                continue  # comments or empty line
-            data = line.split(',').strip()
-            if len(data) != 6:
-                logging.info('ignore illegal line %s' % line)
-                continue
-            # TODO: check the correctness
-            self.sensormap.append(data)
-
-        if self.sensormap:
-            #last offset + its size
-            len = self.sensormap[-1][0] + self.sensormap[-1][5]
-            if len > 0 and len < 1024:
-                self._reg_size = len
-            else:
-                logging.warning('invalid register len %d' % len)
-
-        logging.info('updated sensor map from file %s' % cfg)
-        for d in self.sensormap:
+                return False
+        try:
+            plan = compile_plan(cfg, self.read_gap, self.interval,
+                                options.plan_cache)
+        except (IOError, ConfigError) as e:
+            logging.error('cannot load %s, sensor map kept: %s' % (cfg, e))
+            return False
+        if self.plan is not None and plan.digest == self.plan.digest:
+            return False
+        for number, error in plan.errors:
+            logging.info('ignore illegal line %d: %s' % (number, error))
+        logging.info('updated sensor map from file %s%s' % (
+                     cfg, ' (cached plan)' if plan.cached else ''))
+        for d in plan.sensormap:
             logging.info(str(d))
+        self.apply_plan(plan)
+        return True
+
+    def apply_plan(self, plan):
+        """
+        Switch to plan. While serving, this must run between two polls:
+        the modbus blocks are resized in place and the register values,
+        quality and history of the sensors kept are carried over.
+        """
+        old_map, old_size = self.sensormap, self._reg_size
+        self.plan = plan
+        self.sensormap = plan.sensormap
+        self._reg_size = plan.reg_size
+        self.planner = plan.planner
+        self.update_types()
+        if self._slave is None:
+            return  # not serving yet, start_service does the rest
+
+        base = self.base
+        values = self._slave.get_values(self._data_block, base, old_size)
+        if self._reg_size != old_size:
+            self._slave.remove_block(self._data_block)
+            self._slave.add_block(self._data_block, HOLDING_REGISTERS, base,
+                                  self._reg_size)
+        image = [0] * self._reg_size
+        kept = set((row[0], row[5]) for row in old_map)
+        for row in self.sensormap:
+            reg, size = row[0], row[5]
+            if (reg, size) in kept:
+                image[reg:reg + size] = values[reg:reg + size]
+        self._slave.set_values(self._data_block, base, image)
+
+        quality = QualityTable(self.sensormap)
+        quality.carry(self._quality)
+        if quality.size != self._quality.size:
+            self._slave.remove_block(self._quality_block)
+            self._slave.add_block(self._quality_block, HOLDING_REGISTERS,
+                                  base + META_BASE, quality.size)
+        self._quality = quality
+        self._slave.set_values(self._quality_block, base + META_BASE,
+                               quality.registers())
+        if isinstance(self._slave, SharedSlave):
+            self._slave.set_meta(sensormap=self.sensormap,
+                                 size=self._reg_size)
+        self.publish_image()
+
+        if self._deadband:
+            # the next upload is a keyframe of the new map
+            self._deadband = DeadbandFilter(self.sensormap,
+                    deadband=options.deadband,
+                    deadband_pct=options.deadband_pct,
+                    keyframe_interval=options.keyframe_interval)
+        if self._history:
+            path, days = self._history.path, self._history.days
+            self._history.close()
+            self.start_history(path, days)
+        if self._scheduler:
+            self.schedule(self._scheduler, self._poll_timeout)
+        logging.info('poll plan %s applied' % plan.digest[:8])
+
+    def watch_config(self, scheduler):
+        """Reload the config in scheduler, between polls, when it changes"""
+        changed = threading.Event()
+        self._watcher = ConfigWatcher(self.config_files(),
+                                      lambda filename: changed.set())
+        self._watcher.start()
+
+        def check_reload():
+            if changed.is_set():
+                changed.clear()
+                self.load_config()
+        scheduler.add('reload', check_reload, RELOAD_CHECK_INTERVAL,
+                      uses_link=False)
 
     def write_data(self, data):
-        logging.debug('<send>: %s' % data)
+        logging.debug('<send>: %r', data)
         if type(data) != type(bytes()):
             data = data.encode()
+        self._sent.inc(len(data))
         self.on_uart_write(data)
 
     def on_uart_write(self, data):
-        self._dev.write(data)
-        self._dev.flush()
-
-    def uart_write_thread(self):
-        while self._running:
-            # Nothing to do right now
-            time.sleep(1)
+        # batched with other pending commands by the reactor
+        self._reactor.write(data)
 
     def on_uart_read(self, data):
-        logging.debug("<recv>: %s" % (data if type(data) != type(b"")
-                else str(data)))
-        self._data_received += data
+        logging.debug('<recv>: %r', data)
+        self._received.inc(len(data))
         # don't process read data when updating
         if self._updating:
+            self._data_received += data
             return
-        try:
-            self.sensor_data = json.loads(self._data_received.decode())
-            self._data_received = b''
-        except:
-            logging.info('invalid message: [%s]' % self._data_received.decode())
-            self._data_received = b''
-            return
-
-    def uart_read_thread(self):
-        while self._running:
-            # Xmodem need handle the serial read/write itself
-            if self._xmodem_sending:
-                time.sleep(1)
-                continue
-            data = b''
-            count = self._dev.inWaiting()
-            while count > 0:
-                data += self._dev.read(count)
-                time.sleep(0.1)
-                count = self._dev.inWaiting()
-            if data:
-                self.on_uart_read(data)
+        if self._frames is None:
+            messages = self._framer.feed(data)
+        else:
+            messages = []
+            for ftype, seq, payload in self._frames.feed(data):
+                if ftype is None:
+                    messages.extend(self._framer.feed(payload))
+                else:
+                    messages.append(decode_frame(ftype, seq, payload))
+        for msg in messages:
+            self.sensor_data = msg
+            self._trans.complete(msg)
 
     def reset_ext_board(self):
         logging.warning('reset ext board for upgrading')
-        GPIO.output(EXT_BOARD_RST, False)
+        GPIO.output(self.reset_pin, False)
         time.sleep(1)
-        GPIO.output(EXT_BOARD_RST, True)
+        GPIO.output(self.reset_pin, True)
         time.sleep(2)
 
-    def modem_write(self, data, timeout=1):
-        return self._dev.write(data) or None
-
-    def modem_read(self, size, timeout=1):
-        while timeout >= 0:
-            time.sleep(0.2)
-            count = self._dev.inWaiting()
-            if count >= size:
-                data = self._dev.read(size)
-                return data
-            timeout -= 0.2
-        return None
-
     def do_upgrade(self, filename=None):
         # wait until ext board is ready for upgrading
         logging.info('begin to upgrade ext board from %s' % filename)
@@ -272,10 +728,10 @@ class SensorManager(object):
         while timeout > 0:
             time.sleep(0.5)
             logging.debug('writing C to sensor board')
-            self._dev.write('C')
+            self.write_data('C')
             if b'Select 1 or 2' in self._data_received:
                 time.sleep(0.2)
-                self._dev.write('1')  # select download image
+                self.write_data('1')  # select download image
                 break
             timeout -= 0.5
         if timeout <= 0:
@@ -283,13 +739,18 @@ class SensorManager(object):
             return False
 
         time.sleep(1)
-        self._xmodem_sending = True
         logging.info('updating sensor board...')
-        if not self._modem.send([filename,]):
+        # Xmodem need handle the serial read/write itself
+        with self._reactor.raw() as dev:
+            timeout = dev.timeout
+            transport = SerialTransport(dev)
+            try:
+                sent = YMODEM(transport.getc, transport.putc).send([filename,])
+            finally:
+                dev.timeout = timeout
+        if not sent:
             logging.error('writing sensor board failed')
-            self._xmodem_sending = False
             return False
-        self._xmodem_sending = False
         logging.info('write sensor board successfully')
 
         # wait until ext board is ready again
@@ -303,10 +764,10 @@ class SensorManager(object):
         timeout = 10
         while timeout > 0:
             time.sleep(0.5)
-            self._dev.write('C')
+            self.write_data('C')
             if b'Select 1 or 2' in self._data_received:
                 time.sleep(0.2)
-                self._dev.write('2')  # select run application
+                self.write_data('2')  # select run application
                 break
             timeout -= 0.5
         if timeout <=0:
@@ -373,116 +834,578 @@ class SensorManager(object):
                     break
                 timeout -= 1
 
+            self._framer.reset()
+            if self._frames is not None:
+                self._frames.reset()
             self._updating = False
             os.unlink(UPGRADE_CONF_FILENAME)
+            # the new firmware starts in text mode
+            self.negotiate_framing()
 
     def read_cpuid(self):
-        timeout = 2
-        while timeout > 0:
-            self.sensor_data = None
-            self._dev.write_data('get_cpuid_code()')
-            time.sleep(0.5)
-            if self.sensor_data:
-                break
-            timeout -= 0.5
-        if self.sensor_data and 'CPUID' in self.sensor_data:
-            self.cpuid = self.sensor_data['CPUID']
+        resp = self._trans.request('get_cpuid_code()', 0.5, retry=3)
+        if resp and 'CPUID' in resp:
+            self.cpuid = resp['CPUID']
+
+    def negotiate_framing(self):
+        """Read in binary frames if the board knows them, JSON otherwise"""
+        self.binary = False
+        self._frame_misses = 0
+        if self._frames is None:
+            return False
+        # a false header or half a frame left would hold the answer back
+        self._framer.reset()
+        self._frames.reset()
+        resp = self._trans.request('set_frame_mode(1)', 0.5, retry=1)
+        self.binary = bool(resp and resp.get('frame') == 1)
+        logging.info('%s: %s frames' % (self.device, 'binary' if self.binary
+                                         else 'JSON'))
+        return self.binary
 
     def read_modbus(self, cmdstr, timeout):
-        while timeout > 0:
-            self.sensor_data = None
-            self._dev.write_data(cmdstr)
-            time.sleep(0.5)
-            if self.sensor_data:
-                break
-            timeout -= 0.5
-        return self.sensor_data
+        return self._trans.request(cmdstr, timeout)
 
-    def do_polling(self, timeout=2.0):
-        # reg, description, bus, node, addr, size
-        for reg, desc, bus, node, addr, size in self.sensormap:
-            cmdstr = 'read_hold_reg(%d,%d,%d,%d)' % (bus, node, addr, size)
-            resp = self.read_modbus(cmdstr, timeout)
-            if resp and 'data' in resp:
-                logging.debug('sensor data %s' % resp)
-                self._slave.set_values('0', reg, resp['data'])
+    def read_command(self, cmd, timeout):
+        """Response of a ReadCommand, in the negotiated frame mode"""
+        if not self.binary:
+            return self.read_modbus(cmd.cmdstr, timeout)
+        self._seq = (self._seq + 1) & 0xff
+        resp = self._trans.request(encode_read(self._seq, cmd.bus, cmd.node,
+                                               cmd.addr, cmd.size),
+                                   timeout, seq=self._seq)
+        if resp is not None:
+            self._frame_misses = 0
+            return resp
+        self._frame_misses += 1
+        if self._frame_misses >= FRAME_MISSES:
+            # sensors down, or a board reset back into text mode
+            self.negotiate_framing()
+        return None
+
+    def read_latency(self):
+        """Latency statistics of ext board requests, in seconds"""
+        return self._trans.stats.as_dict()
+
+    def update_plan(self):
+        self.update_types()
+        self.planner = ReadPlanner(self.sensormap, max_gap=self.read_gap,
+                                   interval=self.interval)
+        logging.info('read plan: %d commands for %d sensors, %d saved' % (
+                     len(self.planner.commands), len(self.sensormap),
+                     self.planner.saved))
+        for cmd in self.planner.commands:
+            logging.debug(str(cmd))
+
+    def do_read(self, cmd, timeout):
+        start = time.time()
+        resp = self.read_command(cmd, timeout)
+        now = time.time()
+        latency, timeouts = self.node_metrics(cmd.bus, cmd.node)
+        if resp is None:
+            timeouts.inc()
+        else:
+            latency.observe(now - start)
+        good = set()
+        if resp and 'data' in resp:
+            logging.debug('sensor data %s', resp)
+            if self._typed_rows.intersection(r[0] for r in cmd.rows):
+                segments = self.decoder(cmd).decode(resp['data'])
             else:
-                logging.info('failed to read bus %d, node %d, addr %d, size %d' % (
-                             desc, bus, node, addr, size))
-            time.sleep(1)
+                segments = ((reg, values, None)
+                            for reg, values in cmd.split(resp['data']))
+            for reg, values, typed in segments:
+                self._slave.set_values(self._data_block, self.base + reg,
+                                       values)
+                if self._history:
+                    self._history.append(reg, values, now)
+                if reg in self._typed_rows:
+                    self._typed[reg] = typed
+                good.add(reg)
+        for reg, offset, size in cmd.segments:
+            self.set_quality(reg, reg in good, now)
+        return len(good) == len(cmd.segments)
+
+    def node_metrics(self, bus, node):
+        """Read latency histogram and timeout counter of a sensor node"""
+        metrics = self._node_metrics.get((bus, node))
+        if metrics is None:
+            board = os.path.basename(self.device)
+            metrics = self._node_metrics[(bus, node)] = (
+                READ_SECONDS.labels(board, bus, node),
+                READ_TIMEOUTS.labels(board, bus, node))
+        return metrics
+
+    def decoder(self, cmd):
+        """CommandDecoder of cmd, compiled once per plan"""
+        key = (cmd.cmdstr, tuple(cmd.segments))
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            decoder = self._decoders[key] = CommandDecoder(cmd)
+        return decoder
+
+    def update_types(self):
+        """Follow the type declarations of the sensormap"""
+        self._typed_rows = set(row[0] for row in self.sensormap
+                               if is_typed(row))
+        self._typed = dict((reg, values) for reg, values
+                           in self._typed.items() if reg in self._typed_rows)
+        self._decoders = {}
+
+    def typed_values(self):
+        """[[reg, [typed values]], ...] of the sensors declaring a type"""
+        return [[reg, self._typed[reg]] for reg in sorted(self._typed)]
+
+    def set_quality(self, reg, ok, now=None):
+        update = self._quality.update(reg, ok, now)
+        if update is not None:
+            address, regs = update
+            self._slave.set_values(self._quality_block, self.base + address,
+                                   regs)
+
+    def check_quality(self, factor=STALE_FACTOR):
+        """Warn once about every sensor turning stale, returns them"""
+        intervals = dict((row[0], row_interval(row, self.interval))
+                         for row in self.sensormap)
+        stale = set(self._quality.stale(lambda reg: factor * intervals[reg]))
+        for reg in sorted(stale - self._stale):
+            logging.warning('sensor at register %d has no good read for '
+                            '%.0fs' % (reg, factor * intervals[reg]))
+        for reg in sorted(self._stale - stale):
+            logging.info('sensor at register %d is fresh again' % reg)
+        self._stale = stale
+        return sorted(stale)
+
+    def publish_image(self):
+        # modbus_tk serves the working block directly
+        if isinstance(self._slave, SnapshotSlave):
+            self._slave.publish()
+
+    def poll_command(self, cmd, timeout=2.0):
+        """Read one planned command, returns the transactions used"""
+        start = time.time()
+        if self.do_read(cmd, timeout):
+            self.publish_image()
+            self._poll_seconds.observe(time.time() - start)
+            return 1
+        transactions = 1
+        if len(cmd.rows) > 1:
+            # merged read failed, fall back to one read per sensor
+            logging.info('merged read %s failed, splitting', cmd.cmdstr,
+                         extra={'ratelimit': ('split', cmd.cmdstr)})
+            for single in self.planner.unmerged(cmd):
+                transactions += 1
+                if not self.do_read(single, timeout):
+                    logging.info('failed to read bus %d, node %d, '
+                                 'addr %d, size %d', single.bus, single.node,
+                                 single.addr, single.size, extra={
+                                 'ratelimit': ('read', single.cmdstr)})
+        else:
+            logging.info('failed to read bus %d, node %d, addr %d, '
+                         'size %d', cmd.bus, cmd.node, cmd.addr, cmd.size,
+                         extra={'ratelimit': ('read', cmd.cmdstr)})
+        self.publish_image()
+        self._poll_seconds.observe(time.time() - start)
+        return transactions
+
+    def do_polling(self, timeout=2.0):
+        if not self.planner:
+            self.update_plan()
+        transactions = 0
+        for cmd in self.planner.commands:
+            transactions += self.poll_command(cmd, timeout)
+            time.sleep(self.link_spacing)
+        logging.debug('polling cycle: %d transactions, %d saved',
+                      transactions, len(self.sensormap) - transactions)
+        stats = self.read_latency()
+        if stats['count']:
+            logging.debug('read latency: last %.3fs, avg %.3fs, p99 %.3fs, '
+                          '%d timeouts', stats['last'], stats['avg'],
+                          stats['p99'], stats['timeouts'])
+        return transactions
+
+    def schedule(self, scheduler, timeout=2.0):
+        """
+        Add every planned read to scheduler at its own interval, replacing
+        the reads of a previous plan.
+        """
+        if not self.planner:
+            self.update_plan()
+        for name in self._poll_jobs:
+            scheduler.remove(name)
+        self._scheduler = scheduler
+        self._poll_timeout = timeout
+        if self._frames is not None:
+            self._frames.timeout = timeout  # a frame is a read answer
+        self._poll_jobs = []
+        for index, cmd in enumerate(self.planner.commands):
+            # commands of the same read at other intervals share cmdstr
+            name = 'poll %d %s' % (index, cmd.cmdstr)
+            scheduler.add(name,
+                          lambda cmd=cmd: self.poll_command(cmd, timeout),
+                          cmd.interval)
+            self._poll_jobs.append(name)
 
     def do_upload(self):
-        msg = {"device": self.cpuid,
-               "timestamp": time.time(),
-               "bus": 1, "node": 1, "command": "read",
-               "data": self._slave.get_values('0', 0, self._reg_size),
-               "status": 0}
-        ret = upload(msg)
-        logging.info(ret)
+        if self._flusher and not self._flusher.accept(self.upload_interval):
+            logging.info('upload backlog of %d samples, sample skipped',
+                         self._upload_queue.depth,
+                         extra={'ratelimit': ('thin', self.device)})
+            return
+        msg = image_message(self.cpuid,
+                            self._slave.get_values(self._data_block,
+                                                   self.base, self._reg_size),
+                            self._quality.as_upload(), self.typed_values())
+        if self._deadband:
+            msg = self._deadband.encode(msg, msg['data'])
+            if msg is None:
+                logging.debug('nothing changed, upload suppressed')
+                return
+        if self._upload_queue is None:
+            logging.info(upload(msg))
+            return
+        # the flusher thread does the network part
+        self._upload_queue.put(upload_record(msg))
+        self._flusher.notify()
 
-    def start_service(self):
+    def start_upload(self, spool_dir=SPOOL_DIR, change_only=False):
+        if change_only:
+            self._deadband = DeadbandFilter(self.sensormap,
+                    deadband=options.deadband,
+                    deadband_pct=options.deadband_pct,
+                    keyframe_interval=options.keyframe_interval)
+        self._upload_queue = SegmentQueue(spool_dir)
+        self._flusher = UploadFlusher(self._upload_queue, upload_batch,
+                                      high_water=options.upload_high_water)
+        self._flusher.start()
+
+    def upload_status(self):
+        """Depth, age in seconds and bytes of the upload backlog"""
+        queue = self._upload_queue
+        if queue is None:
+            return {'depth': 0, 'age': 0.0, 'bytes': 0, 'evicted': 0}
+        return {'depth': queue.depth, 'age': queue.age,
+                'bytes': queue.backlog, 'evicted': queue.evicted}
+
+    def start_history(self, path=HISTORY_DIR, days=HISTORY_DAYS):
+        self._history = HistoryStore(path, self.sensormap,
+                lambda row: row_interval(row, self.interval), days)
+
+    def flush_history(self):
+        if self._history:
+            self._history.flush()
+
+    def history_range(self, reg, start, end=None):
+        """[(timestamp, values)] of the sensor at reg within [start, end)"""
+        return self._history.range(reg, start, end)
+
+    def history_latest(self, reg, count=1):
+        """The last count [(timestamp, values)] of the sensor at reg"""
+        return self._history.latest(reg, count)
+
+    def deadband_stats(self):
+        """Messages and bytes sent and suppressed in change-only mode"""
+        return self._deadband.stats() if self._deadband else None
+
+    def start_uart(self):
+        if self._running:
+            return
         self._running = True
-        self.threadrx = threading.Thread(target = self.uart_read_thread)
-        self.threadrx.start()
-        self.threadtx = threading.Thread(target = self.uart_write_thread)
-        self.threadtx.start()
-        self._mdbus = modbus_tcp.TcpServer()
-        self._mdbus.start()
-        self._mdbus1 = self._mdbus.add_slave(1)
-        self._mdbus1.add_block('0', cst.HOLDING_REGISTERS, 0, self._reg_size)
-        self._slave = self._mdbus.get_slave(1)
-        logging.info('MODBUS service is started')
+        self._reactor.start()
+
+    def start_service(self, server=None, unit=1, base=0, slave=None):
+        """
+        Serve the sensors by modbus at base of unit, on server shared with
+        the other boards or on a server of our own by default. With slave,
+        e.g. a SharedSlave, the image goes there and no server is used.
+        """
+        # uart reactor is needed by the transactions before polling
+        self.start_uart()
+        # the loaded config decides the quality block size
+        self._quality = QualityTable(self.sensormap)
+        if slave is None:
+            if server is None:
+                server = modbus_server()
+                server.add_slave(unit)
+                self._own_mdbus = True
+            slave = server.get_slave(unit)
+        self._mdbus = server
+        self._slave = slave
+        self.base = base
+        # blocks are named by their start, unique within a shared slave
+        self._data_block = str(base)
+        self._quality_block = str(base + META_BASE)
+        self._slave.add_block(self._data_block, HOLDING_REGISTERS, base,
+                              self._reg_size)
+        self._slave.add_block(self._quality_block, HOLDING_REGISTERS,
+                              base + META_BASE, self._quality.size)
+        self._slave.set_values(self._quality_block, base + META_BASE,
+                               self._quality.registers())
+        self.publish_image()
+        if self.planner is None:
+            self.update_plan()
+        logging.info('MODBUS service is started for %s, unit %d, '
+                     'register %d' % (self.device, unit, base))
 
     def stop_service(self):
         self._data_to_write = b''
         self._data_received = b''
         self._running = False
+        if self._watcher:
+            self._watcher.stop()
+        self._reactor.stop()
         self._dev.close()
-        self.threadtx.join()
-        self.threadrx.join()
-        self._mdbus.stop()
+        if self._flusher:
+            self._flusher.stop()
+        if self._history:
+            self._history.close()
+        if self._own_mdbus:
+            self._mdbus.stop()
         logging.info('MODBUS service is stopped')
 
 
+def board_dir(path, device, boards):
+    """Per board subdirectory of path when there are several boards"""
+    if boards > 1:
+        return os.path.join(path, os.path.basename(device))
+    return path
+
+
+def start_board(sm, server, index, boards, slave=None):
+    """
+    Read the board config, start serving and return its scheduler. With a
+    SharedSlave the image is shared with the other processes instead,
+    and uploading is left to the upload process.
+    """
+    sm.start_uart()
+    retry = 3
+    while not sm.cpuid and retry > 0:
+        sm.read_cpuid()
+        retry -= 1
+    if sm.cpuid:
+        logging.info('%s: CPUID = %s' % (sm.device, sm.cpuid))
+        sm.negotiate_framing()
+        sm.load_config()
+    else:
+        logging.warning('%s: failed to read CPUID, board may be broken'
+                        % sm.device)
+    unit, base = index + 1, 0
+    if options.board_map == 'range':
+        unit, base = 1, index * BOARD_SPAN
+    if slave is not None:
+        slave.set_meta(cpuid=sm.cpuid, sensormap=sm.sensormap, base=base,
+                       size=sm._reg_size)
+    sm.start_service(server, unit, base, slave)
+    scheduler = PollScheduler(spacing=options.link_spacing)
+    sm.schedule(scheduler)
+    if options.reload:
+        sm.watch_config(scheduler)
+    if sm.reset_pin is not None:
+        scheduler.add('upgrade', sm.check_upgrade, UPGRADE_CHECK_INTERVAL)
+    if options.history_days > 0:
+        sm.start_history(board_dir(options.history_dir, sm.device, boards),
+                         options.history_days)
+        scheduler.add('history', sm.flush_history, HISTORY_SYNC_INTERVAL,
+                      uses_link=False)
+    if options.stale_factor > 0:
+        scheduler.add('quality',
+                      lambda: sm.check_quality(options.stale_factor),
+                      options.interval, uses_link=False)
+    if options.upload_interval > 0 and slave is None:
+        sm.start_upload(board_dir(options.spool_dir, sm.device, boards),
+                        options.change_only)
+        scheduler.add('upload', sm.do_upload, options.upload_interval,
+                      uses_link=False)
+    return scheduler
+
+
+def shm_path(device):
+    return os.path.join(options.shm_dir,
+                        'sensorhub.%s' % os.path.basename(device))
+
+
+def start_metrics(scheduler, offset=0, suffix=''):
+    """
+    Serve the metrics of this process at the metrics port + offset and
+    save snapshots to the metrics file + suffix, from scheduler
+    """
+    if options.metrics_port > 0:
+        try:
+            MetricsServer(address=options.metrics_address,
+                          port=options.metrics_port + offset).start()
+        except (IOError, OSError) as e:
+            logging.error('cannot serve metrics: %s' % e)
+    if options.metrics_file and options.metrics_interval > 0:
+        path = options.metrics_file + suffix
+        scheduler.add('metrics', lambda: REGISTRY.save(path),
+                      options.metrics_interval, uses_link=False,
+                      start=time.time() + options.metrics_interval)
+
+
+def run_acquisition(index, device, reset_pin, boards):
+    """Process owning the serial port of one board"""
+    start_child(os.path.basename(device))
+    sm = SensorManager(device, 115200, reset_pin)
+    slave = SharedSlave(SharedImage(shm_path(device), create=True))
+    scheduler = start_board(sm, None, index, boards, slave)
+    start_metrics(scheduler, index, '.%s' % os.path.basename(device))
+    scheduler.run()
+
+
+def run_server(devices):
+    """Process serving the shared images of every board by modbus"""
+    start_child('modbus')
+    if options.modbus_engine != 'snapshot':
+        logging.info('separate processes always use the snapshot engine')
+    server = SnapshotServer(address=options.modbus_address or '',
+                            port=options.modbus_port)
+    paths = [shm_path(device) for device in devices]
+    if options.board_map == 'unit':
+        for i, path in enumerate(paths):
+            server.add_slave(i + 1, SharedReader([path]))
+    else:
+        server.add_slave(1, SharedReader(paths))
+    server.start()
+    while True:
+        time.sleep(60)
+
+
+def run_uploader(index, device, boards):
+    """Process uploading the shared image of one board"""
+    start_child('upload.%s' % os.path.basename(device))
+    reader = SharedReader([shm_path(device)])
+    queue = SegmentQueue(board_dir(options.spool_dir, device, boards))
+    flusher = UploadFlusher(queue, upload_batch,
+                            high_water=options.upload_high_water)
+    flusher.start()
+    UPLOAD_QUEUE_DEPTH.labels(os.path.basename(device)).set_function(
+        lambda: queue.depth)
+    state = {'deadband': None, 'sensormap': None}
+
+    def do_upload():
+        if not flusher.accept(options.upload_interval):
+            logging.info('upload backlog of %d samples, sample skipped',
+                         queue.depth, extra={'ratelimit': 'thin'})
+            return
+        meta = reader.meta()
+        if not meta or 'sensormap' not in meta[0]:
+            logging.debug('no shared image of %s yet' % device)
+            return
+        meta = meta[0]
+        if meta['sensormap'] != state['sensormap']:
+            state['sensormap'] = meta['sensormap']
+            if options.change_only:
+                state['deadband'] = DeadbandFilter(meta['sensormap'],
+                        deadband=options.deadband,
+                        deadband_pct=options.deadband_pct,
+                        keyframe_interval=options.keyframe_interval)
+        base = meta['base']
+        quality = QualityTable(meta['sensormap'])
+        quality.load(reader.get_values(None, base + META_BASE, quality.size))
+        data = reader.get_values(None, base, meta['size'])
+        values = [[row[0], typed_values(row, data[row[0]:row[0] + row[5]])]
+                  for row in meta['sensormap'] if is_typed(row)]
+        msg = image_message(meta['cpuid'], data, quality.as_upload(), values)
+        if state['deadband']:
+            msg = state['deadband'].encode(msg, msg['data'])
+            if msg is None:
+                return
+        queue.put(upload_record(msg))
+        flusher.notify()
+
+    scheduler = PollScheduler(report_interval=0)
+    scheduler.add('upload', do_upload, options.upload_interval,
+                  uses_link=False)
+    start_metrics(scheduler, boards + index,
+                  '.upload.%s' % os.path.basename(device))
+    scheduler.run()
+
+
+def run_processes(ports, pins):
+    supervisor = Supervisor()
+    for i, (port, pin) in enumerate(zip(ports, pins)):
+        supervisor.add('acquisition %s' % port, run_acquisition,
+                       (i, port, pin, len(ports)))
+    supervisor.add('modbus', run_server, (ports,), SERVER_NICE)
+    if options.upload_interval > 0:
+        for i, port in enumerate(ports):
+            supervisor.add('upload %s' % port, run_uploader,
+                           (i, port, len(ports)), UPLOADER_NICE)
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
+
+
+def cleanup_gpio(reset_pins):
+    GPIO.cleanup(PIN_4G_RST)
+    GPIO.cleanup(PIN_4G_EN)
+    for pin in reset_pins:
+        if pin is not None:
+            GPIO.cleanup(pin)
+    GPIO.cleanup(EXT_BOARD_STS)
+
+
 def main():
     logging.info('Starting sensor hub service')
 
+    ports = [port.strip() for port in options.port.split(',') if port.strip()]
+    pins = [int(pin) for pin in options.reset_pins.split(',') if pin.strip()]
+    pins = (pins + [None] * len(ports))[:len(ports)]
+    if options.board_map == 'range' and len(ports) * BOARD_SPAN > 0x10000:
+        logging.error('too many boards for the range board map')
+        sys.exit(1)
+
     GPIO.setup(PIN_4G_EN, GPIO.OUT)
     GPIO.output(PIN_4G_EN, False)
     GPIO.setup(PIN_4G_RST, GPIO.OUT)
     GPIO.output(PIN_4G_RST, False)
-    GPIO.setup(EXT_BOARD_RST, GPIO.OUT)
-    GPIO.output(EXT_BOARD_RST, True)
+    for pin in pins:
+        if pin is not None:
+            GPIO.setup(pin, GPIO.OUT)
+            GPIO.output(pin, True)
     GPIO.setup(EXT_BOARD_STS, GPIO.OUT)
     GPIO.output(EXT_BOARD_STS, False)
     time.sleep(1)
 
-    sm = SensorManager(UART_PORT, 115200)
+    if options.processes:
+        try:
+            run_processes(ports, pins)
+        except KeyboardInterrupt:
+            logging.info('Exiting sensor hub service...')
+        cleanup_gpio(pins)
+        sys.exit(0)
+
+    boards = [SensorManager(port, 115200, pin)
+              for port, pin in zip(ports, pins)]
+    # one modbus server for every board
+    server = modbus_server()
+    if options.board_map == 'unit':
+        for i in range(len(boards)):
+            server.add_slave(i + 1)
+    else:
+        server.add_slave(1)
 
+    schedulers = []
     try:
-        retry = 3
-        while not sm.cpuid and retry > 0:
-            sm.read_cpuid()
-            retry -= 1
-        if sm.cpuid:
-            logging.info('CPUID = %s' % sm.cpuid)
-            sm.load_config()
-        else:
-            logging.warning('failed to read CPUID, board may be broken')
-        sm.start_service()
-        while True:
-            sm.do_polling()
-            sm.check_upgrade()
+        for i, sm in enumerate(boards):
+            schedulers.append(start_board(sm, server, i, len(boards)))
+        start_metrics(schedulers[0])
+        # every board polls in its own thread, the first one in this one
+        for scheduler in schedulers[1:]:
+            thread = threading.Thread(target=scheduler.run)
+            thread.daemon = True
+            thread.start()
+        schedulers[0].run()
     except KeyboardInterrupt:
         logging.info('Exiting sensor hub service...')
-        sm.stop_service()
-
-        GPIO.cleanup(PIN_4G_RST)
-        GPIO.cleanup(PIN_4G_EN)
-        GPIO.cleanup(EXT_BOARD_RST)
-        GPIO.cleanup(EXT_BOARD_STS)
-
+        for scheduler in schedulers:
+            scheduler.stop()
+        for sm in boards:
+            sm.stop_service()
+        server.stop()
+        cleanup_gpio(pins)
         sys.exit(0)
 
 if __name__ == '__main__':
+    setup_logging()
     main()
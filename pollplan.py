@@ -0,0 +1,374 @@
+"""
+Compiled poll plans.
+
+A sensor config file is parsed and validated once into a PollPlan: the
+typed sensormap rows, the register image size and the read commands.
+Plans are cached on disk as JSON, the rows and the read commands by row
+index, keyed by a hash of the config content and of the planner
+settings, so a restart with an unchanged config skips the parsing and
+the planning. A cache file only holds data, never code.
+
+ConfigWatcher reports config file changes through inotify, or by
+polling the modification times where inotify is missing.
+"""
+
+import os
+import sys
+import errno
+import select
+import json
+import struct
+import hashlib
+import logging
+import threading
+
+from readplan import ReadPlanner, ReadCommand, READ_GAP, POLL_INTERVAL
+from quality import META_BASE
+from typedecode import parse_type
+
+# Bump when the PollPlan layout changes, older cache entries are ignored
+PLAN_VERSION = 3
+# Compiled plans are kept here
+PLAN_CACHE_DIR = '/var/cache/sensorhub'
+# Cached plans kept, older ones are removed
+PLAN_CACHE_SIZE = 8
+# Seconds between two checks of the config files without inotify
+WATCH_INTERVAL = 2.0
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def parse_row(line):
+    """
+    Typed sensormap row of a config line: reg, description, bus, node,
+    addr, size[, interval[, deadband[, deadband_pct[, type[, scale[,
+    offset]]]]]], optional columns may be left empty.
+    """
+    data = [d.strip() for d in line.split(',')]
+    if len(data) < 6 or len(data) > 12:
+        raise ConfigError('expected 6 to 12 columns')
+    try:
+        row = [int(data[0]), data[1].strip('\'"'),
+               int(data[2]), int(data[3]), int(data[4]), int(data[5])]
+        row.extend(float(d) if d else None for d in data[6:9])
+        if len(data) > 9:
+            row.append(data[9] or None)
+            row.extend(float(d) if d else None for d in data[10:])
+    except ValueError as e:
+        raise ConfigError(str(e))
+    if len(row) > 9 and row[9]:
+        try:
+            width = parse_type(row[9])[1]
+        except ValueError as e:
+            raise ConfigError(str(e))
+        if row[5] % width:
+            raise ConfigError('size is not a multiple of %s' % row[9])
+    if row[0] < 0 or row[4] < 0 or row[5] <= 0:
+        raise ConfigError('negative register or empty sensor')
+    if row[0] + row[5] > META_BASE:
+        raise ConfigError('register beyond %d' % META_BASE)
+    if any(d is not None and d < 0 for d in row[6:9]):
+        raise ConfigError('negative optional column')
+    if len(row) > 6 and row[6] == 0:
+        raise ConfigError('zero interval')
+    return row
+
+
+def parse_config(text):
+    """Return the sensormap rows and the [(line number, error)] of text"""
+    rows = []
+    errors = []
+    used = {}
+    for number, line in enumerate(text.splitlines(), 1):
+        if line.lstrip().startswith('#') or not line.strip():
+            continue  # comments or empty line
+        try:
+            row = parse_row(line)
+        except ConfigError as e:
+            errors.append((number, '%s: %s' % (e, line.strip())))
+            continue
+        clash = [used[r] for r in range(row[0], row[0] + row[5]) if r in used]
+        if clash:
+            errors.append((number, 'registers overlap line %d: %s' % (
+                           clash[0], line.strip())))
+            continue
+        for r in range(row[0], row[0] + row[5]):
+            used[r] = number
+        rows.append(row)
+    return rows, errors
+
+
+class PollPlan(object):
+    """
+    :param sensormap: validated sensormap rows
+    :param read_gap: max_gap of the ReadPlanner
+    :param interval: poll interval of the rows without one
+    :param digest: content hash of the source config
+    :param source: config filename
+    :param commands: read commands of the sensormap from the cache, planned
+        when None
+    """
+
+    def __init__(self, sensormap, read_gap=READ_GAP, interval=POLL_INTERVAL,
+                 digest='', source='', commands=None):
+        self.sensormap = sensormap
+        self.read_gap = read_gap
+        self.interval = interval
+        self.digest = digest
+        self.source = source
+        self.errors = []
+        self.cached = False
+        # end of the highest register
+        self.reg_size = max([row[0] + row[5] for row in sensormap] or [0])
+        self.planner = ReadPlanner(sensormap, max_gap=read_gap,
+                                   interval=interval, commands=commands)
+
+    @property
+    def commands(self):
+        return self.planner.commands
+
+    def __repr__(self):
+        return '<PollPlan %s %s rows=%d commands=%d>' % (
+            self.source, self.digest[:8], len(self.sensormap),
+            len(self.commands))
+
+
+def plan_digest(data, read_gap, interval):
+    settings = repr((PLAN_VERSION, read_gap, float(interval),
+                     sys.version_info[0])).encode()
+    return hashlib.sha1(settings + b'\0' + data).hexdigest()
+
+
+def _native(value):
+    """value with the strings json gives as unicode on Python 2 as str"""
+    if isinstance(value, type(u'')) and not isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def _plan_data(plan):
+    """Plain data of plan, the commands hold sensormap row indexes"""
+    index = dict((id(row), i) for i, row in enumerate(plan.sensormap))
+    return {'digest': plan.digest, 'read_gap': plan.read_gap,
+            'interval': plan.interval, 'sensormap': plan.sensormap,
+            'errors': plan.errors,
+            'commands': [[cmd.bus, cmd.node, cmd.addr, cmd.interval,
+                          [index[id(row)] for row in cmd.rows]]
+                         for cmd in plan.commands]}
+
+
+def _plan_of(data):
+    """PollPlan of the data of _plan_data"""
+    sensormap = [[_native(v) for v in row] for row in data['sensormap']]
+    commands = []
+    for bus, node, addr, interval, rows in data['commands']:
+        cmd = ReadCommand(bus, node, addr, 0, interval)
+        for i in rows:
+            cmd.add_row(sensormap[i])
+        commands.append(cmd)
+    plan = PollPlan(sensormap, data['read_gap'], data['interval'],
+                    _native(data['digest']), commands=commands)
+    plan.errors = [(number, _native(error))
+                   for number, error in data['errors']]
+    return plan
+
+
+def _load_cached(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        return None
+    try:
+        plan = _plan_of(data)
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        logging.warning('ignore broken plan cache %s: %s' % (path, e))
+        return None
+    plan.cached = True
+    return plan
+
+
+def _save_cached(cache_dir, path, plan):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(_plan_data(plan), f, separators=(',', ':'))
+        os.rename(tmp, path)
+        plans = sorted((os.path.getmtime(os.path.join(cache_dir, name)), name)
+                       for name in os.listdir(cache_dir)
+                       if name.startswith('plan-'))
+        for mtime, name in plans[:-PLAN_CACHE_SIZE]:
+            os.remove(os.path.join(cache_dir, name))
+    except (IOError, OSError) as e:
+        logging.warning('cannot cache the poll plan: %s' % e)
+
+
+def compile_plan(filename, read_gap=READ_GAP, interval=POLL_INTERVAL,
+                 cache_dir=PLAN_CACHE_DIR):
+    """
+    PollPlan of the config filename, from the cache when its content did
+    not change. Raises ConfigError when no row is valid.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    digest = plan_digest(data, read_gap, interval)
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, 'plan-%s.json' % digest)
+        plan = _load_cached(path)
+        if plan is not None:
+            plan.source = filename
+            return plan
+
+    text = data if isinstance(data, str) else data.decode('utf-8')
+    rows, errors = parse_config(text)
+    if not rows:
+        raise ConfigError('no valid sensor in %s' % filename)
+    plan = PollPlan(rows, read_gap, interval, digest, filename)
+    plan.errors = errors
+    if path:
+        _save_cached(cache_dir, path, plan)
+    return plan
+
+
+class _Inotify(object):
+    """Minimal inotify over ctypes, raises OSError where it is missing"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    _EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is missing')
+        self._libc = libc
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+
+    def watch(self, path):
+        # no IN_CREATE or IN_MODIFY, the file may not be complete yet
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_DELETE
+        wd = self._libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), 'cannot watch %s' % path)
+        self.dirs[wd] = path
+
+    def read(self):
+        """[(directory, name)] of the pending events"""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + self._EVENT.size <= len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0').decode()
+            pos += length
+            events.append((self.dirs.get(wd), name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """
+    :param filenames: config files watched, they may not exist yet
+    :param callback: called with the changed filename, from the watcher
+        thread
+    :param interval: seconds between two checks without inotify
+    """
+
+    def __init__(self, filenames, callback, interval=WATCH_INTERVAL):
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        self.callback = callback
+        self.interval = interval
+        self.changes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+
+    def start(self):
+        try:
+            self._inotify = _Inotify()
+            for path in set(os.path.dirname(f) for f in self.filenames):
+                self._inotify.watch(path)
+        except OSError as e:
+            logging.info('config watcher polls every %.0fs, no inotify: %s'
+                         % (self.interval, e))
+            if self._inotify:
+                self._inotify.close()
+            self._inotify = None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _changed(self, filename):
+        self.changes += 1
+        logging.info('config %s changed' % filename)
+        try:
+            self.callback(filename)
+        except Exception as e:
+            logging.error('config change callback failed: %s' % e)
+
+    def run(self):
+        if self._inotify:
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+    def _run_inotify(self):
+        fd = self._inotify.fd
+        while not self._stop.is_set():
+            rlist, _, _ = select.select([fd], [], [], 1.0)
+            if not rlist:
+                continue
+            changed = set()
+            for path, name in self._inotify.read():
+                if path is not None:
+                    changed.add(os.path.join(path, name))
+            for filename in self.filenames:
+                if filename in changed:
+                    self._changed(filename)
+
+    def _mtime(self, filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return None
+
+    def _run_polling(self):
+        mtimes = dict((f, self._mtime(f)) for f in self.filenames)
+        while not self._stop.wait(self.interval):
+            for filename in self.filenames:
+                mtime = self._mtime(filename)
+                if mtime != mtimes[filename]:
+                    mtimes[filename] = mtime
+                    self._changed(filename)
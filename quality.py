@@ -0,0 +1,109 @@
+"""
+Freshness and quality of every sensormap row.
+
+The table is served as a parallel modbus block starting at META_BASE,
+3 registers per sensormap row in sensormap order:
+
+    META_BASE + 3 * i      quality code of row i
+    META_BASE + 3 * i + 1  last good read, unix time high word
+    META_BASE + 3 * i + 2  last good read, unix time low word
+
+so a client can tell fresh values from stale ones without polling more.
+"""
+
+import time
+
+# First register of the quality block, after the max register image
+META_BASE = 1024
+META_REGS = 3
+
+QUALITY_GOOD = 0  # last read succeeded
+QUALITY_STALE = 1  # last read failed, the value is the last good one
+QUALITY_NO_DATA = 2  # never read successfully
+
+
+class QualityTable(object):
+    """
+    :param sensormap: rows of [reg, description, bus, node, addr, size, ...]
+    """
+
+    def __init__(self, sensormap):
+        self.rows = [row[0] for row in sensormap]
+        self.index = dict((reg, i) for i, reg in enumerate(self.rows))
+        self.quality = [QUALITY_NO_DATA] * len(self.rows)
+        self.updated = [0] * len(self.rows)
+        self.failures = [0] * len(self.rows)
+        # when the rows joined, the age of the ones never read
+        self.since = [time.time()] * len(self.rows)
+
+    @property
+    def size(self):
+        """Registers of the quality block"""
+        return len(self.rows) * META_REGS
+
+    def update(self, reg, ok, now=None):
+        """
+        Record the read result of the row at reg, returns the modbus
+        address and the registers to write, or None for unknown rows.
+        """
+        i = self.index.get(reg)
+        if i is None:
+            return None
+        if ok:
+            self.quality[i] = QUALITY_GOOD
+            self.updated[i] = int(time.time() if now is None else now)
+            self.failures[i] = 0
+        else:
+            self.failures[i] += 1
+            if self.quality[i] == QUALITY_GOOD:
+                self.quality[i] = QUALITY_STALE
+        stamp = self.updated[i]
+        return META_BASE + i * META_REGS, \
+            [self.quality[i], (stamp >> 16) & 0xffff, stamp & 0xffff]
+
+    def registers(self):
+        regs = []
+        for i in range(len(self.rows)):
+            stamp = self.updated[i]
+            regs.extend([self.quality[i], (stamp >> 16) & 0xffff,
+                         stamp & 0xffff])
+        return regs
+
+    def carry(self, other):
+        """Keep the state of the rows of other, a previous table"""
+        for i, reg in enumerate(self.rows):
+            j = other.index.get(reg)
+            if j is not None:
+                self.quality[i] = other.quality[j]
+                self.updated[i] = other.updated[j]
+                self.failures[i] = other.failures[j]
+                self.since[i] = other.since[j]
+
+    def load(self, registers):
+        """Restore the table from the registers of its modbus block"""
+        for i in range(len(self.rows)):
+            q, hi, lo = registers[i * META_REGS:(i + 1) * META_REGS]
+            self.quality[i] = q
+            self.updated[i] = (hi << 16) | lo
+
+    def codes(self):
+        return list(self.quality)
+
+    def as_upload(self):
+        """[[reg, quality, last good read], ...] for the upload message"""
+        return [[reg, self.quality[i], self.updated[i]]
+                for i, reg in enumerate(self.rows)]
+
+    def stale(self, max_age, now=None):
+        """
+        Registers of the rows without a good read for max_age seconds,
+        max_age is a number or a callable taking the row register. A row
+        never read is aged from when it joined the table, so it is not
+        stale before its first polls had a chance.
+        """
+        if now is None:
+            now = time.time()
+        if not callable(max_age):
+            max_age = lambda reg, age=max_age: age
+        return [reg for i, reg in enumerate(self.rows)
+                if now - (self.updated[i] or self.since[i]) > max_age(reg)]
@@ -0,0 +1,141 @@
+"""
+Serial I/O reactor for the ext board uart.
+
+A single thread owns both directions of the port: it sleeps in select()
+until the port is readable, a write is queued or it is told to stop, so
+an idle hub burns no CPU and received bytes are delivered at once. All
+commands queued while the port is busy go out in one write.
+
+The firmware upgrader takes the port over with ``raw()``, the reactor
+parks until it is handed back.
+"""
+
+import os
+import fcntl
+import select
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class SerialReactor(object):
+    """
+    :param dev: opened serial.Serial port
+    :param on_read: callable receiving every chunk read from the port
+    """
+
+    def __init__(self, dev, on_read):
+        self._dev = dev
+        self._on_read = on_read
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._raw = False
+        self._parked = threading.Event()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.writes = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def write(self, data):
+        """Queue data, it is sent by the reactor thread"""
+        with self._lock:
+            self._queue.append(data)
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass  # pipe full, the reactor is awake anyway
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 256):
+                pass
+        except OSError:
+            pass
+
+    def _flush_queue(self):
+        with self._lock:
+            if not self._queue:
+                return
+            data = b''.join(self._queue)
+            self._queue.clear()
+        self._dev.write(data)
+        self.bytes_written += len(data)
+        self.writes += 1
+
+    def _read(self):
+        count = self._dev.inWaiting()
+        data = self._dev.read(count or 1)
+        if data:
+            self.bytes_read += len(data)
+            self._on_read(data)
+
+    def run(self):
+        fd = self._dev.fileno()
+        while self._running:
+            if self._raw:
+                self._flush_queue()
+                self._parked.set()
+                select.select([self._wake_r], [], [])
+                self._drain_wakeup()
+                continue
+            with self._lock:
+                pending = bool(self._queue)
+            wlist = [fd] if pending else []
+            try:
+                rlist, wlist, _ = select.select([fd, self._wake_r], wlist, [])
+            except select.error as e:
+                logging.warning('serial reactor select error: %s' % e)
+                continue
+            if self._wake_r in rlist:
+                self._drain_wakeup()
+            if fd in wlist:
+                self._flush_queue()
+            if fd in rlist and not self._raw:
+                self._read()
+        self._parked.set()
+
+    def acquire_raw(self, timeout=5):
+        """Park the reactor and return the port for exclusive raw use"""
+        self._parked.clear()
+        self._raw = True
+        self._wakeup()
+        if self._thread and not self._parked.wait(timeout):
+            self._raw = False
+            raise RuntimeError('serial reactor did not release the port')
+        return self._dev
+
+    def release_raw(self):
+        self._raw = False
+        self._wakeup()
+
+    @contextmanager
+    def raw(self, timeout=5):
+        dev = self.acquire_raw(timeout)
+        try:
+            yield dev
+        finally:
+            self.release_raw()
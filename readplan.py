@@ -0,0 +1,124 @@
+"""
+Read planner for the ext board.
+
+Coalesce SENSORMAP rows that live on the same bus and node into as few
+``read_hold_reg(bus,node,addr,size)`` commands as possible, and split the
+responses back into the modbus holding register offsets of each row.
+"""
+
+# Max registers a single modbus FC3 request can return
+MAX_READ_SIZE = 125
+# Default number of unused sensor registers allowed between two merged rows
+READ_GAP = 4
+# Default seconds between two reads of a sensor
+POLL_INTERVAL = 5.0
+
+
+def row_interval(row, default=POLL_INTERVAL):
+    """Poll interval of a sensormap row, from its optional 7th column"""
+    if len(row) > 6 and row[6]:
+        return row[6]
+    return default
+
+
+class ReadCommand(object):
+    """One serial transaction covering one or more sensormap rows"""
+
+    def __init__(self, bus, node, addr, size, interval=POLL_INTERVAL):
+        self.bus = bus
+        self.node = node
+        self.addr = addr
+        self.size = size
+        self.interval = interval
+        # (reg, offset in response data, size)
+        self.segments = []
+        self.rows = []
+
+    @property
+    def cmdstr(self):
+        return 'read_hold_reg(%d,%d,%d,%d)' % (
+            self.bus, self.node, self.addr, self.size)
+
+    def add_row(self, row):
+        reg, addr, size = row[0], row[4], row[5]
+        end = max(self.addr + self.size, addr + size)
+        self.size = end - self.addr
+        self.segments.append((reg, addr - self.addr, size))
+        self.rows.append(row)
+
+    def split(self, data):
+        """Yield (reg, values) for every row fully covered by data"""
+        for reg, offset, size in self.segments:
+            if offset + size <= len(data):
+                yield reg, data[offset:offset + size]
+
+    def __repr__(self):
+        return '<%s rows=%d>' % (self.cmdstr, len(self.rows))
+
+
+class ReadPlanner(object):
+    """
+    Build the read commands for a sensormap.
+
+    :param sensormap: rows of [reg, description, bus, node, addr, size] and
+        an optional poll interval, only rows polled at the same interval
+        are merged
+    :param max_gap: max unused sensor registers read to join two rows,
+        0 merges contiguous (or overlapping) rows only, a negative value
+        disables merging.
+    :param max_size: max registers per read command
+    :param interval: poll interval of rows without one
+    :param commands: commands planned before for the same sensormap and
+        settings, planned again when None
+    """
+
+    def __init__(self, sensormap, max_gap=READ_GAP, max_size=MAX_READ_SIZE,
+                 interval=POLL_INTERVAL, commands=None):
+        self.sensormap = sensormap
+        self.max_gap = max_gap
+        self.max_size = max_size
+        self.interval = interval
+        self.commands = commands
+        if commands is None:
+            self.plan()
+
+    @property
+    def saved(self):
+        """Serial transactions saved per polling cycle"""
+        return len(self.sensormap) - len(self.commands)
+
+    def group_key(self, row):
+        return row[2], row[3], row_interval(row, self.interval)
+
+    def plan(self):
+        groups = {}
+        for row in self.sensormap:
+            groups.setdefault(self.group_key(row), []).append(row)
+
+        commands = []
+        for key in sorted(groups):
+            cmd = None
+            for row in sorted(groups[key], key=lambda r: (r[4], r[5])):
+                bus, node, addr, size = row[2], row[3], row[4], row[5]
+                if cmd is not None and self.max_gap >= 0:
+                    gap = addr - (cmd.addr + cmd.size)
+                    end = max(cmd.addr + cmd.size, addr + size)
+                    if gap <= self.max_gap and end - cmd.addr <= self.max_size:
+                        cmd.add_row(row)
+                        continue
+                cmd = ReadCommand(bus, node, addr, 0, key[2])
+                cmd.add_row(row)
+                commands.append(cmd)
+        self.commands = commands
+        return commands
+
+    def unmerged(self, cmd):
+        """Single row commands for cmd, used when a merged read fails"""
+        if len(cmd.rows) == 1:
+            return [cmd]
+        commands = []
+        for row in cmd.rows:
+            single = ReadCommand(row[2], row[3], row[4], 0, cmd.interval)
+            single.add_row(row)
+            commands.append(single)
+        return commands
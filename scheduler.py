@@ -0,0 +1,136 @@
+"""
+Deadline based poll scheduler.
+
+Every job has its own interval and is kept in a priority queue keyed by
+its next due time. The earliest job runs when it is due, jobs never run
+closer together than the link spacing, and how late each job ran against
+its target is recorded.
+"""
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+# Min seconds between two serial transactions
+LINK_SPACING = 0.1
+# Seconds between two lateness reports in the log
+REPORT_INTERVAL = 300
+
+
+class Job(object):
+    def __init__(self, name, func, interval, uses_link=True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.uses_link = uses_link
+        self.due = 0
+        self.runs = 0
+        self.skipped = 0
+        self.late_last = 0.0
+        self.late_max = 0.0
+        self.late_total = 0.0
+
+    @property
+    def late_avg(self):
+        return self.late_total / self.runs if self.runs else 0.0
+
+    def as_dict(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'late_last': self.late_last,
+            'late_avg': self.late_avg,
+            'late_max': self.late_max,
+        }
+
+
+class PollScheduler(object):
+    """
+    :param spacing: min seconds between two jobs using the serial link
+    """
+
+    def __init__(self, spacing=LINK_SPACING, report_interval=REPORT_INTERVAL):
+        self.spacing = spacing
+        self.jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._last_link = 0
+        self._stop = threading.Event()
+        if report_interval:
+            self.add('report', self.report, report_interval,
+                     uses_link=False, start=time.time() + report_interval)
+
+    def add(self, name, func, interval, uses_link=True, start=None):
+        job = Job(name, func, interval, uses_link)
+        job.due = time.time() if start is None else start
+        self.jobs[name] = job
+        heapq.heappush(self._heap, (job.due, next(self._seq), job))
+        return job
+
+    def remove(self, name):
+        job = self.jobs.pop(name, None)
+        if job:
+            job.func = None  # dropped when it reaches the queue head
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        if not self._heap:
+            self._stop.wait(1)
+            return None
+        due, _, job = self._heap[0]
+        if job.func is None:
+            heapq.heappop(self._heap)
+            return None
+        start = due
+        if job.uses_link:
+            start = max(start, self._last_link + self.spacing)
+        now = time.time()
+        if start > now:
+            self._stop.wait(start - now)
+            return None  # re-check the queue head, a job may be added
+        heapq.heappop(self._heap)
+
+        late = now - due
+        job.runs += 1
+        job.late_last = late
+        job.late_total += late
+        job.late_max = max(job.late_max, late)
+        try:
+            job.func()
+        except Exception as e:
+            logging.error('job %s failed: %s' % (job.name, e))
+        if job.uses_link:
+            self._last_link = time.time()
+
+        # keep the phase, skip missed periods instead of bursting
+        job.due = due + job.interval
+        now = time.time()
+        if job.due < now:
+            missed = int((now - job.due) // job.interval)
+            job.skipped += missed
+            job.due += missed * job.interval
+        heapq.heappush(self._heap, (job.due, next(self._seq), job))
+        return job
+
+    def run(self):
+        self._stop.clear()
+        while not self._stop.is_set():
+            self.run_once()
+
+    def lateness(self):
+        """Lateness in seconds of every job against its interval"""
+        return dict((name, job.as_dict()) for name, job in self.jobs.items())
+
+    def report(self):
+        for name in sorted(self.jobs):
+            job = self.jobs[name]
+            if not job.uses_link:
+                continue
+            logging.info('%s: every %.1fs, %d runs, %d skipped, late avg '
+                         '%.3fs max %.3fs' % (name, job.interval, job.runs,
+                         job.skipped, job.late_avg, job.late_max))
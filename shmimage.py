@@ -0,0 +1,270 @@
+"""
+Register image shared between processes.
+
+The acquisition process writes its register blocks into a memory mapped
+file, under /dev/shm by default, and the serving and upload processes map
+the same file. Writes are guarded by a sequence lock: the writer makes
+the sequence odd, writes and makes it even again, a reader retries when
+the sequence was odd or moved while it read. Readers never see a torn
+image and never make the writer wait. Registers are stored in modbus
+byte order, so serving a read is a slice of the map.
+
+Layout: header, block table, JSON meta data (cpuid and sensormap, for
+the uploader), register area.
+"""
+
+import os
+import mmap
+import json
+import time
+import struct
+
+from mbserver import SnapshotSlave
+
+# Directory of the shared image files
+SHM_DIR = '/dev/shm'
+MAX_BLOCKS = 16
+META_SIZE = 64 * 1024
+MAX_REGISTERS = 65536
+# Seconds a reader waits for a writer in the middle of a write
+READ_TIMEOUT = 0.5
+
+_MAGIC = b'SHI1'
+_HEADER = struct.Struct('<4sQII')  # magic, sequence, generation, blocks
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = 4
+_LAYOUT = struct.Struct('<II')  # generation, blocks
+_LAYOUT_OFFSET = 12
+_BLOCK = struct.Struct('<III')  # start, size, offset in the register area
+_LENGTH_PREFIX = struct.Struct('<I')
+_TABLE = _HEADER.size
+_META = _TABLE + MAX_BLOCKS * _BLOCK.size
+_REGS = _META + _LENGTH_PREFIX.size + META_SIZE
+_LENGTH = _REGS + MAX_REGISTERS * 2
+
+
+class SharedImage(object):
+    """
+    :param path: backing file
+    :param create: open for writing, creating the file if needed; a
+        restarted writer reuses the file, mapped readers follow it
+    """
+
+    def __init__(self, path, create=False):
+        self.path = path
+        self.writer = create
+        self.retries = 0
+        self._blocks = ()
+        self._meta = {}
+        self._generation = None
+        if create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+        try:
+            if create and os.fstat(fd).st_size != _LENGTH:
+                os.ftruncate(fd, _LENGTH)
+            self._mm = mmap.mmap(fd, _LENGTH, access=mmap.ACCESS_WRITE
+                                 if create else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if create:
+            magic, seq, generation, count = _HEADER.unpack_from(self._mm, 0)
+            if magic != _MAGIC:
+                seq = generation = 0
+            # even and past anything a reader saw, a crash may leave it odd
+            self._seq = (seq | 1) + 1
+            self._generation = generation + 1
+            _HEADER.pack_into(self._mm, 0, _MAGIC, self._seq,
+                              self._generation, 0)
+
+    def _begin(self):
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+    def _end(self):
+        self._seq += 1
+        _SEQ.pack_into(self._mm, _SEQ_OFFSET, self._seq)
+
+    def set_layout(self, blocks, meta=None, images=None):
+        """
+        Writer: define the blocks as [(start, size), ...] and the meta
+        data, a JSON serializable dict. The registers are set to images,
+        the register lists of every block, or cleared.
+        """
+        if len(blocks) > MAX_BLOCKS:
+            raise ValueError('more than %d blocks' % MAX_BLOCKS)
+        if sum(size for start, size in blocks) > MAX_REGISTERS:
+            raise ValueError('more than %d registers' % MAX_REGISTERS)
+        data = json.dumps(meta or {}).encode()
+        if len(data) > META_SIZE:
+            raise ValueError('meta data over %d bytes' % META_SIZE)
+        table = []
+        offset = 0
+        for start, size in blocks:
+            table.append((start, size, offset))
+            offset += size
+        self._begin()
+        for i, block in enumerate(table):
+            _BLOCK.pack_into(self._mm, _TABLE + i * _BLOCK.size, *block)
+        _LENGTH_PREFIX.pack_into(self._mm, _META, len(data))
+        self._mm[_META + 4:_META + 4 + len(data)] = data
+        if images is None:
+            self._mm[_REGS:_REGS + offset * 2] = b'\x00' * (offset * 2)
+        else:
+            for (start, size, pos), image in zip(table, images):
+                struct.pack_into('>%dH' % size, self._mm, _REGS + pos * 2,
+                                 *image)
+        self._generation += 1
+        _LAYOUT.pack_into(self._mm, _LAYOUT_OFFSET, self._generation,
+                          len(table))
+        self._end()
+        self._blocks = tuple(table)
+        self._meta = meta or {}
+
+    def write(self, images):
+        """Writer: store the register lists of every block, in order"""
+        self._begin()
+        for (start, size, offset), image in zip(self._blocks, images):
+            struct.pack_into('>%dH' % size, self._mm, _REGS + offset * 2,
+                             *image)
+        self._end()
+
+    def _load(self, generation, count):
+        self._blocks = tuple(_BLOCK.unpack_from(self._mm, _TABLE +
+                                                i * _BLOCK.size)
+                             for i in range(count))
+        length = _LENGTH_PREFIX.unpack_from(self._mm, _META)[0]
+        try:
+            self._meta = json.loads(
+                self._mm[_META + 4:_META + 4 + length].decode())
+        except ValueError:
+            self._meta = {}  # torn, the sequence check retries
+        self._generation = generation
+
+    def _consistent(self, func):
+        """Call func over a stable image, None when the writer hangs"""
+        deadline = None
+        while True:
+            seq = _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0]
+            if not seq & 1:
+                generation, count = _LAYOUT.unpack_from(self._mm,
+                                                        _LAYOUT_OFFSET)
+                if generation != self._generation:
+                    self._load(generation, count)
+                result = func()
+                if seq == _SEQ.unpack_from(self._mm, _SEQ_OFFSET)[0]:
+                    return result
+                self._generation = None  # the layout may be torn too
+            self.retries += 1
+            now = time.time()
+            if deadline is None:
+                deadline = now + READ_TIMEOUT
+            elif now > deadline:
+                return None
+            time.sleep(0)
+
+    def read(self, address, count):
+        """Packed registers at address, None if unmapped"""
+        def registers():
+            for start, size, offset in self._blocks:
+                if start <= address and address + count <= start + size:
+                    pos = _REGS + (offset + address - start) * 2
+                    return self._mm[pos:pos + count * 2]
+            return None
+        return self._consistent(registers)
+
+    def meta(self):
+        return self._consistent(lambda: self._meta)
+
+    def close(self):
+        self._mm.close()
+
+
+class SharedSlave(SnapshotSlave):
+    """
+    SnapshotSlave publishing into a SharedImage, for the acquisition
+    process.
+
+    :param image: SharedImage opened for writing
+    :param meta: meta data for the readers
+    """
+
+    def __init__(self, image, meta=None):
+        self.image = image
+        self.meta = dict(meta or {})
+        SnapshotSlave.__init__(self)
+
+    def add_block(self, name, block_type, start, size):
+        SnapshotSlave.add_block(self, name, block_type, start, size)
+        self._layout()
+
+    def remove_block(self, name):
+        SnapshotSlave.remove_block(self, name)
+        self._layout()
+
+    def set_meta(self, **meta):
+        self.meta.update(meta)
+        self._layout()
+
+    def _layout(self):
+        with self._lock:
+            blocks = sorted(self._blocks.values())
+            self.image.set_layout([(start, len(image))
+                                   for start, image in blocks], self.meta,
+                                  [image for start, image in blocks])
+
+    def publish(self):
+        with self._lock:
+            self.image.write([image for start, image
+                              in sorted(self._blocks.values())])
+            self.publishes += 1
+
+
+class SharedReader(object):
+    """
+    Read only slave over the shared images of one or more boards, for the
+    serving and upload processes. Files are mapped once they exist.
+
+    :param paths: image files
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.images = {}
+        self.publishes = 0
+
+    def _images(self):
+        for path in self.paths:
+            image = self.images.get(path)
+            if image is None:
+                try:
+                    image = self.images[path] = SharedImage(path)
+                except (OSError, IOError, ValueError):
+                    continue  # the writer did not create it yet
+            yield image
+
+    def read(self, address, count):
+        for image in self._images():
+            data = image.read(address, count)
+            if data is not None:
+                return data
+        return None
+
+    def block_at(self, address, count):
+        return None  # writes belong to the acquisition process
+
+    def get_values(self, block, address, size=1):
+        data = self.read(address, size)
+        if data is None:
+            raise ValueError('register %d+%d is not shared' % (address, size))
+        return struct.unpack('>%dH' % size, data)
+
+    def meta(self):
+        """Meta data of every mapped image"""
+        return [image.meta() or {} for image in self._images()]
+
+    def close(self):
+        for image in self.images.values():
+            image.close()
+        self.images.clear()
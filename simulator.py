@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+'''
+Ext board simulator.
+
+Speaks the ext board text protocol on a pseudo terminal, so SensorManager
+can run on any Linux box:
+
+    get_cpuid_code()              -> {"CPUID": "..."}
+    read_hold_reg(bus,node,a,n)   -> {"data": [...]}
+    get_version()                 -> {"date": "...", "time": "..."}
+    set_frame_mode(1)             -> {"frame": 1}
+
+After set_frame_mode(1) reads are also accepted as binary frames, see
+binframe.py, until set_frame_mode(0) or a reset.
+
+Resetting the board through the GPIO stub starts the bootloader, which
+answers ``C`` with its menu, receives an image by YMODEM after ``1`` and
+starts the application after ``2``, like the real one. For transfer
+benchmarks the bootloader can delay its answers, corrupt blocks and ask
+for YMODEM-g streaming instead.
+
+    python simulator.py --nodes 40 --latency 0.02 --failure-rate 0.01
+'''
+
+from __future__ import division, print_function
+
+import os
+import re
+import sys
+import pty
+import tty
+import json
+import time
+import math
+import random
+import select
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from xmodem import SOH, STX, EOT, ACK, NAK, CAN, CRC, CRG, calc_crc16
+import binframe
+
+EXT_BOARD_RST = 26
+# registers of every simulated sensor node
+NODE_REGISTERS = 64
+
+_COMMAND = re.compile(br'(\w+)\(([^)]*)\)')
+
+
+class GPIOStub(object):
+    '''RPi.GPIO replacement, output callbacks let the simulator see resets'''
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = True
+    LOW = False
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        self._callbacks = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=None):
+        self.pins[pin] = bool(initial) if initial is not None else False
+
+    def output(self, pin, value):
+        old = self.pins.get(pin)
+        self.pins[pin] = bool(value)
+        for func in self._callbacks.get(pin, []):
+            func(old, bool(value))
+
+    def input(self, pin):
+        return self.pins.get(pin, False)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.pins.clear()
+        else:
+            self.pins.pop(pin, None)
+
+    def add_output_callback(self, pin, func):
+        self._callbacks.setdefault(pin, []).append(func)
+
+
+GPIO = GPIOStub()
+
+
+class ExtBoardSimulator(object):
+    '''
+    :param nodes: sensor nodes, spread over bus 1 and 2 from node id 1
+    :param latency: seconds before a node answers, a float or a dict
+        {(bus, node): seconds}
+    :param failure_rate: probability a read gets no answer
+    :param baudrate: emulated line speed, 0 for none
+    :param cpuid: CPUID answered to get_cpuid_code()
+    :param binary: support binary frames, False emulates an older firmware
+    :param reply_latency: seconds the bootloader answers are delayed, as
+        on a link with that round trip
+    :param block_error_rate: probability a YMODEM block is corrupted
+    :param ymodem_g: the bootloader asks for YMODEM-g streaming
+    '''
+
+    def __init__(self, nodes=4, latency=0.01, failure_rate=0.0,
+                 baudrate=115200, cpuid='0123456789ab', seed=None,
+                 binary=True, reply_latency=0.0, block_error_rate=0.0,
+                 ymodem_g=False):
+        self.nodes = {}
+        for i in range(nodes):
+            self.nodes[(i % 2 + 1, i // 2 + 1)] = NODE_REGISTERS
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.baudrate = baudrate
+        self.cpuid = cpuid
+        self.binary = binary
+        self.reply_latency = reply_latency
+        self.block_error_rate = block_error_rate
+        self.ymodem_g = ymodem_g
+        self.block_errors = 0
+        self.frame_mode = 0
+        self.mode = 'app'  # app, boot, ymodem
+        self.images = []
+        self.reads = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._random = random.Random(seed)
+        self._buf = b''
+        self._frames = binframe.FrameReader()
+        self._running = False
+        self._thread = None
+        self._replies = queue.Queue()
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+    def attach_gpio(self, gpio=GPIO, pin=EXT_BOARD_RST):
+        '''Reset into the bootloader on a rising edge of pin'''
+        def on_output(old, new):
+            if new and old is False:
+                self.reset()
+        gpio.add_output_callback(pin, on_output)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        replier = threading.Thread(target=self._send_replies)
+        replier.daemon = True
+        replier.start()
+
+    def stop(self):
+        self._running = False
+        self._replies.put(None)
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def reset(self):
+        self._buf = b''
+        self.frame_mode = 0
+        self._frames.reset()
+        self.mode = 'boot'
+        self.send(b'\r\nBootloader is started\r\n')
+
+    def send(self, data):
+        if self.baudrate:
+            time.sleep(len(data) * 10 / self.baudrate)
+        os.write(self._master, data)
+        self.bytes_out += len(data)
+
+    def reply(self, data):
+        '''Send data reply_latency seconds later, in order'''
+        if self.reply_latency:
+            self._replies.put((time.time() + self.reply_latency, data))
+        else:
+            self.send(data)
+
+    def _send_replies(self):
+        while True:
+            item = self._replies.get()
+            if item is None:
+                return
+            due, data = item
+            time.sleep(max(0, due - time.time()))
+            if self._running:
+                self.send(data)
+
+    def _read(self, timeout):
+        rlist, _, _ = select.select([self._master], [], [], timeout)
+        if not rlist:
+            return b''
+        data = os.read(self._master, 4096)
+        self.bytes_in += len(data)
+        return data
+
+    def run(self):
+        while self._running:
+            data = self._read(0.1)
+            if not data:
+                continue
+            if self.mode == 'app' and self.frame_mode:
+                for ftype, seq, payload in self._frames.feed(data):
+                    if ftype is None:
+                        self._buf += payload
+                    else:
+                        self._frame_command(ftype, seq, payload)
+                self._app_commands()
+            elif self.mode == 'app':
+                self._buf += data
+                self._app_commands()
+            elif self.mode == 'boot':
+                self._boot_menu(data)
+
+    def _app_commands(self):
+        while True:
+            m = _COMMAND.search(self._buf)
+            if m is None:
+                self._buf = self._buf[-256:]
+                return
+            self._buf = self._buf[m.end():]
+            name = m.group(1).decode()
+            try:
+                args = [int(a) for a in m.group(2).split(b',') if a.strip()]
+            except ValueError:
+                continue  # line noise, e.g. the rest of an aborted transfer
+            resp = self.handle(name, args)
+            if resp is not None:
+                self.send(json.dumps(resp).encode())
+
+    def _frame_command(self, ftype, seq, payload):
+        if ftype != binframe.READ:
+            return
+        resp = self.read_hold_reg(*binframe.decode(ftype, seq, payload)['read'])
+        if resp is None:
+            return
+        if 'data' in resp:
+            self.send(binframe.encode_data(seq, resp['data']))
+        else:
+            self.send(binframe.encode_status(seq, resp['status']))
+
+    def handle(self, name, args):
+        if name == 'get_cpuid_code':
+            return {'CPUID': self.cpuid}
+        if name == 'get_version':
+            return {'date': '2018-05-12', 'time': '12:00:00',
+                    'version': 'simulator'}
+        if name == 'read_hold_reg' and len(args) == 4:
+            return self.read_hold_reg(*args)
+        if name == 'set_frame_mode' and self.binary and len(args) == 1:
+            self.frame_mode = 1 if args[0] == 1 else 0
+            self._frames.reset()
+            return {'frame': self.frame_mode}
+        return {'status': -1, 'error': 'unknown command %s' % name}
+
+    def node_latency(self, bus, node):
+        if isinstance(self.latency, dict):
+            return self.latency.get((bus, node), 0)
+        return self.latency
+
+    def read_hold_reg(self, bus, node, addr, size):
+        self.reads += 1
+        time.sleep(self.node_latency(bus, node))
+        if (bus, node) not in self.nodes or \
+                self._random.random() < self.failure_rate:
+            self.failures += 1
+            return None  # 485 timeout, the board stays silent
+        if addr + size > self.nodes[(bus, node)]:
+            return {'status': 2}
+        now = time.time()
+        return {'data': [int(1000 + 500 * math.sin(now / 10 + node + a))
+                         for a in range(addr, addr + size)]}
+
+    def _boot_menu(self, data):
+        for char in bytearray(data):
+            char = bytes(bytearray([char]))
+            if char == b'C':
+                self.send(b'\r\nSelect 1 or 2\r\n1: download image\r\n'
+                          b'2: run application\r\n')
+            elif char == b'1':
+                self.mode = 'ymodem'
+                self._receive_ymodem()
+                self.mode = 'boot'
+                return
+            elif char == b'2':
+                time.sleep(0.5)
+                self.mode = 'app'
+                self._buf = b''
+                self.send(b'Sensor board is ready!\r\n')
+                return
+
+    def _getc(self, size, timeout=10):
+        data = b''
+        deadline = time.time() + timeout
+        while len(data) < size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            rlist, _, _ = select.select([self._master], [], [], remaining)
+            if rlist:
+                chunk = os.read(self._master, size - len(data))
+                if self.baudrate:
+                    time.sleep(len(chunk) * 10 / self.baudrate)
+                self.bytes_in += len(chunk)
+                data += chunk
+        return data
+
+    def _receive_ymodem(self):
+        '''Receive one YMODEM batch, the image is kept in self.images'''
+        crc = calc_crc16
+        ask = CRG if self.ymodem_g else CRC
+        image = b''
+        length = None
+        expect = 0
+        self.reply(ask)
+        while self._running:
+            char = self._getc(1)
+            if char is None:
+                self.reply(ask)
+                continue
+            if char == EOT:
+                if length is not None and len(image) < length:
+                    logging.info('simulator: ymodem image of %d bytes, '
+                                 'short of %d' % (len(image), length))
+                    self.reply(CAN + CAN)
+                    return False
+                self.reply(ACK)
+                self.reply(ask)
+                expect = 0
+                continue
+            if char == CAN:
+                logging.info('simulator: ymodem canceled')
+                return False
+            if char not in (SOH, STX):
+                continue
+            size = 128 if char == SOH else 1024
+            packet = self._getc(size + 4)
+            if packet is not None and \
+                    self._random.random() < self.block_error_rate:
+                self.block_errors += 1
+                packet = None  # hit on the line
+            if packet is not None:
+                seq = bytearray(packet[:2])
+                data = packet[2:2 + size]
+                their = bytearray(packet[-2:])
+                if seq[0] != 0xff - seq[1] or \
+                        crc(data) != (their[0] << 8) + their[1]:
+                    packet = None
+            if packet is None:
+                if self.ymodem_g:
+                    self.reply(CAN + CAN)  # no retransmission in -g
+                    return False
+                self.reply(NAK)
+                continue
+            if seq[0] == 0 and expect == 0:
+                if not data.strip(b'\x00'):
+                    if not self.ymodem_g:
+                        self.reply(ACK)  # empty header, end of batch
+                    if length is not None:
+                        self.images.append(image[:length])
+                    return True
+                length = int(data.split(b'\x00')[1].split(b' ')[0])
+                image = b''
+                expect = 1
+                if not self.ymodem_g:
+                    self.reply(ACK)
+                self.reply(ask)
+                continue
+            if seq[0] == expect & 0xff:
+                image += data
+                expect += 1
+            elif self.ymodem_g:
+                self.reply(CAN + CAN)  # out of sequence, no repeats in -g
+                return False
+            elif seq[0] != (expect - 1) & 0xff:
+                # neither the next block nor a repeat of the last one
+                self.reply(NAK)
+                continue
+            if not self.ymodem_g:
+                self.reply(ACK)  # the repeat of the last block is acked too
+        return False
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [<options>]')
+    parser.add_option('-n', '--nodes', type='int', default=4,
+                      help='simulated sensor nodes [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.01,
+                      help='node answer latency in seconds [default: %default]')
+    parser.add_option('-f', '--failure-rate', type='float', default=0.0,
+                      help='probability of an unanswered read '
+                           '[default: %default]')
+    parser.add_option('-b', '--baudrate', type='int', default=115200,
+                      help='emulated line speed [default: %default]')
+    parser.add_option('--no-binary', action='store_false', dest='binary',
+                      default=True,
+                      help='no binary frames, like an older firmware')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = ExtBoardSimulator(options.nodes, options.latency,
+                            options.failure_rate, options.baudrate,
+                            binary=options.binary)
+    sim.start()
+    print('ext board simulator on %s' % sim.port)
+    try:
+        while True:
+            time.sleep(10)
+            print('reads=%d failures=%d in=%d out=%d' % (
+                  sim.reads, sim.failures, sim.bytes_in, sim.bytes_out))
+    except KeyboardInterrupt:
+        sim.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Process supervisor.
+
+Starts every child process and starts it again when it exits, waiting
+longer after each quick exit so a crashing child does not spin.
+"""
+
+import os
+import time
+import signal
+import logging
+import multiprocessing
+
+# Seconds before the first and the max seconds before a later restart
+RESTART_MIN = 1
+RESTART_MAX = 60
+# A child running this long is healthy, its restart delay is reset
+HEALTHY_RUN = 60
+
+
+class Child(object):
+    def __init__(self, name, target, args, nice):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.nice = nice
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.delay = RESTART_MIN
+        self.due = 0
+
+
+class Supervisor(object):
+    """
+    :param restart_min: seconds before the first restart of a child
+    :param restart_max: max seconds between two restarts
+    """
+
+    def __init__(self, restart_min=RESTART_MIN, restart_max=RESTART_MAX):
+        self.restart_min = restart_min
+        self.restart_max = restart_max
+        self.children = []
+        self._running = False
+
+    def add(self, name, target, args=(), nice=0):
+        """
+        Run target(*args) in a child process, niced by nice so e.g. the
+        uploader gives way to the acquisition on a busy CPU.
+        """
+        child = Child(name, target, args, nice)
+        child.delay = self.restart_min
+        self.children.append(child)
+        return child
+
+    def _start(self, child):
+        child.process = multiprocessing.Process(
+            target=_run_child, args=(child.target, child.args, child.nice),
+            name=child.name)
+        child.process.daemon = True
+        child.process.start()
+        child.started = time.time()
+        logging.info('started %s, pid %d' % (child.name, child.process.pid))
+
+    def start(self):
+        self._running = True
+        for child in self.children:
+            self._start(child)
+
+    def check(self, now=None):
+        """Restart the children which exited, returns the ones restarted"""
+        if now is None:
+            now = time.time()
+        restarted = []
+        for child in self.children:
+            process = child.process
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                process.join()
+                if now - child.started > HEALTHY_RUN:
+                    child.delay = self.restart_min
+                logging.error('%s exited with code %s, restart in %ds' % (
+                              child.name, process.exitcode, child.delay))
+                child.process = None
+                child.due = now + child.delay
+                child.delay = min(child.delay * 2, self.restart_max)
+            if now >= child.due:
+                child.restarts += 1
+                self._start(child)
+                restarted.append(child)
+        return restarted
+
+    def run(self, interval=0.5):
+        if not self._running:
+            self.start()
+        while self._running:
+            time.sleep(interval)
+            self.check()
+
+    def stop(self, timeout=5):
+        self._running = False
+        for child in self.children:
+            if child.process is not None and child.process.is_alive():
+                child.process.terminate()
+        for child in self.children:
+            if child.process is not None:
+                child.process.join(timeout)
+                child.process = None
+        logging.info('every child process is stopped')
+
+
+def _run_child(target, args, nice):
+    if nice:
+        os.nice(nice)
+    target(*args)
+
+
+def ignore_sigint():
+    """Let the supervisor alone handle ^C, called first in every child"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
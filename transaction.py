@@ -0,0 +1,136 @@
+"""
+Request/response matching for the ext board.
+
+The ext board handles one command at a time and answers in order, so a
+single outstanding transaction is kept. The uart reader completes it as
+soon as a response is parsed, and the caller wakes up right away instead
+of sleeping a fixed quantum.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+
+# Number of recent transactions kept for latency percentiles
+LATENCY_WINDOW = 256
+
+
+class Transaction(object):
+    """A command sent to the ext board and its pending response"""
+
+    def __init__(self, cmdstr, timeout, seq=None):
+        self.cmdstr = cmdstr
+        self.timeout = timeout
+        self.seq = seq
+        self.sent = None
+        self.deadline = None
+        self.response = None
+        self.latency = None
+        self._event = threading.Event()
+
+    def start(self):
+        self.sent = time.time()
+        self.deadline = self.sent + self.timeout
+
+    def complete(self, response):
+        self.response = response
+        self.latency = time.time() - self.sent
+        self._event.set()
+
+    def wait(self):
+        remaining = self.deadline - time.time()
+        if remaining > 0:
+            self._event.wait(remaining)
+        return self._event.is_set()
+
+
+class LatencyStats(object):
+    """Latency of completed transactions, in seconds"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self.timeouts = 0
+        self.unexpected = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self._recent = deque(maxlen=window)
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+        self._recent.append(latency)
+
+    def percentile(self, pct):
+        if not self._recent:
+            return None
+        data = sorted(self._recent)
+        idx = min(len(data) - 1, int(round(pct / 100.0 * (len(data) - 1))))
+        return data[idx]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'timeouts': self.timeouts,
+            'unexpected': self.unexpected,
+            'avg': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class TransactionManager(object):
+    """
+    Send commands through write and wait for the matching response.
+
+    :param write: callable writing a command string to the ext board
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._lock = threading.Lock()  # one transaction on the wire
+        self._pending = None
+        self.stats = LatencyStats()
+
+    def request(self, cmdstr, timeout, retry=0, seq=None):
+        """
+        Send cmdstr and return the parsed response, or None when no
+        response arrived before the deadline of every attempt. With a seq
+        only a response carrying the same 'seq' completes the request.
+        """
+        with self._lock:
+            for _ in range(retry + 1):
+                trans = Transaction(cmdstr, timeout, seq)
+                trans.start()
+                self._pending = trans
+                self._write(cmdstr)
+                done = trans.wait()
+                self._pending = None
+                if done:
+                    self.stats.add(trans.latency)
+                    return trans.response
+                self.stats.timeouts += 1
+                logging.debug('transaction %s timeout after %.3fs',
+                              cmdstr, timeout)
+        return None
+
+    def complete(self, response):
+        """Called by the reader thread with every parsed response"""
+        trans = self._pending
+        if trans is None or trans._event.is_set() or \
+                (trans.seq is not None and response.get('seq') != trans.seq):
+            # late answer of a timed out request, or unsolicited message
+            self.stats.unexpected += 1
+            return False
+        trans.complete(response)
+        return True
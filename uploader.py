@@ -0,0 +1,282 @@
+"""
+Pooled HTTP uploader.
+
+Uploads go over persistent keep-alive connections, so the TCP handshake
+and the DNS lookup are paid once per connection instead of once per
+sample, which counts over 4G. Up to window requests of a batch are in
+flight at once. A failed request is retried after an exponential,
+jittered backoff, a request failing on a reused connection the server
+closed meanwhile is sent again at once on a new one.
+
+The uploader is the send callable of an UploadFlusher: it returns how
+many payloads from the head of a batch were delivered. A payload after
+a failed one may have been delivered too and is sent again with the
+rest, uploads are at least once.
+"""
+
+import time
+import socket
+import random
+import logging
+import threading
+from collections import deque
+
+try:
+    import httplib
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Requests of a batch in flight at once, and connections kept open
+UPLOAD_WINDOW = 4
+# Seconds before a request without an answer fails
+UPLOAD_TIMEOUT = 10
+# Retries of a failed request before its batch gives up
+UPLOAD_RETRIES = 2
+# Backoff seconds of the first retry and max backoff, before the jitter
+RETRY_MIN = 0.5
+RETRY_MAX = 30
+# Seconds a resolved server address is used
+DNS_TTL = 300
+# Number of recent uploads kept for latency percentiles
+LATENCY_WINDOW = 1024
+
+
+class UploadError(IOError):
+    pass
+
+
+class _Connection(httplib.HTTPConnection):
+    """Keep-alive connection to the cached address of the server"""
+
+    def __init__(self, host, port, timeout, resolve):
+        httplib.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self._resolve = resolve
+
+    def connect(self):
+        self.sock = socket.create_connection(self._resolve(), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _Batch(object):
+    def __init__(self, count):
+        self.done = [False] * count
+        self.failed = False
+        self.pending = count
+        self.finished = threading.Event()
+
+
+class HTTPUploader(object):
+    """
+    :param url: http URL payloads are posted to
+    :param window: max requests in flight and connections kept
+    :param timeout: seconds before a request fails
+    :param retries: retries of a failed request
+    :param headers: headers of every request
+    :param latency: optional histogram observing upload seconds
+    :param failures: optional counter of failed requests
+    """
+
+    def __init__(self, url, window=UPLOAD_WINDOW, timeout=UPLOAD_TIMEOUT,
+                 retries=UPLOAD_RETRIES, retry_min=RETRY_MIN,
+                 retry_max=RETRY_MAX, headers=None, latency=None,
+                 failures=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('cannot upload to %s' % url)
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.headers = dict(headers or {})
+        self.headers.setdefault('Connection', 'keep-alive')
+        self.latency = latency
+        self.failures = failures
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.connections = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._address = None
+        self._resolved = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._workers = []
+        self._closed = False
+
+    def _resolve(self):
+        now = time.time()
+        if self._address is None or now - self._resolved > DNS_TTL:
+            info = socket.getaddrinfo(self.host, self.port, 0,
+                                      socket.SOCK_STREAM)
+            self._address = info[0][4][:2]
+            self._resolved = now
+        return self._address
+
+    def _connection(self):
+        """(connection, reused), an idle one when there is one"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections += 1
+        if self.https:
+            return httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=self.timeout), False
+        return _Connection(self.host, self.port, self.timeout,
+                           self._resolve), False
+
+    def _release(self, conn):
+        with self._lock:
+            if not self._closed and len(self._idle) < self.window:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def post(self, body, headers=None):
+        """
+        Post body once, returns the response body, raises UploadError or
+        IOError when it failed
+        """
+        all_headers = self.headers
+        if headers:
+            all_headers = dict(self.headers, **headers)
+        while True:
+            conn, reused = self._connection()
+            start = time.time()
+            try:
+                conn.request('POST', self.path, body, all_headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    self._resolved = 0  # the server may have moved too
+                    continue  # closed by the server while idle
+                raise UploadError('upload to %s failed: %s' % (self.host, e))
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if not 200 <= resp.status < 300:
+                raise UploadError('upload to %s failed: %d %s' % (
+                                  self.host, resp.status, resp.reason))
+            elapsed = time.time() - start
+            self._latencies.append(elapsed)
+            if self.latency is not None:
+                self.latency.observe(elapsed)
+            self.sent += 1
+            return data
+
+    def backoff(self, attempt):
+        """Jittered seconds to wait before retry attempt, from 0"""
+        delay = min(self.retry_max, self.retry_min * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def _post_retry(self, body, batch):
+        for attempt in range(self.retries + 1):
+            if batch.failed or self._closed:
+                return False
+            try:
+                self.post(body)
+                return True
+            except (UploadError, IOError) as e:
+                self.failed += 1
+                if self.failures is not None:
+                    self.failures.inc()
+                logging.info('%s, attempt %d' % (e, attempt + 1))
+            if attempt < self.retries:
+                self.retried += 1
+                time.sleep(self.backoff(attempt))
+        return False
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            batch, index, body = job
+            ok = False
+            try:
+                ok = self._post_retry(body, batch)
+            except Exception as e:
+                logging.error('upload worker: %s' % e)
+            with self._lock:
+                batch.done[index] = ok
+                if not ok:
+                    batch.failed = True  # the later ones would fail too
+                batch.pending -= 1
+                if batch.pending == 0:
+                    batch.finished.set()
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.window:
+                worker = threading.Thread(target=self._work,
+                                          name='uploader')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def send(self, payloads):
+        """
+        Post payloads, window at a time, returns how many from the head
+        were delivered
+        """
+        if not payloads:
+            return 0
+        if self.window == 1 or len(payloads) == 1:
+            batch = _Batch(len(payloads))
+            for count, body in enumerate(payloads):
+                if not self._post_retry(body, batch):
+                    return count
+            return len(payloads)
+        self._start_workers()
+        batch = _Batch(len(payloads))
+        for index, body in enumerate(payloads):
+            self._jobs.put((batch, index, body))
+        batch.finished.wait()
+        for count, done in enumerate(batch.done):
+            if not done:
+                return count
+        return len(payloads)
+
+    __call__ = send
+
+    def stats(self):
+        data = sorted(self._latencies)
+
+        def pct(p):
+            if not data:
+                return None
+            return data[min(len(data) - 1, int(round(p / 100.0 *
+                                                     (len(data) - 1))))]
+        return {'sent': self.sent, 'failed': self.failed,
+                'retried': self.retried, 'connections': self.connections,
+                'p50': pct(50), 'p99': pct(99)}
+
+    def close(self):
+        self._closed = True
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
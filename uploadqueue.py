@@ -0,0 +1,384 @@
+"""
+Durable store-and-forward queue for uploads.
+
+Samples are appended to segment files in a spool directory and a
+background flusher drains them to the server in batches, so nothing is
+lost while the 4G link is down. Appending costs one buffered write; a
+torn record left by a crash is detected by its CRC and cut off at the
+next start. When the spool exceeds its size cap the oldest segment is
+evicted.
+
+Record layout: length (4 bytes), crc32 (4 bytes), timestamp (double),
+payload. The read position is kept in the ``cursor`` file.
+"""
+
+import os
+import time
+import random
+import struct
+import logging
+import zlib
+import threading
+
+# Max bytes of a segment file before starting a new one
+SEGMENT_SIZE = 256 * 1024
+# Max bytes kept in the spool, the oldest segments are evicted above it
+MAX_BYTES = 32 * 1024 * 1024
+# Seconds between two flushes of the buffered segment to disk
+SYNC_INTERVAL = 5
+# Records waiting before the producer is slowed down
+HIGH_WATER = 1000
+
+_HEADER = struct.Struct('>IId')
+_CURSOR = struct.Struct('>QQ')
+_SUFFIX = '.seg'
+
+
+def _crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class SegmentQueue(object):
+    """
+    :param path: spool directory, created when missing
+    :param segment_size: max bytes of one segment file
+    :param max_bytes: size cap of the spool
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_bytes=MAX_BYTES):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._segments = []  # [seq, bytes, records, oldest timestamp]
+        self._writer = None
+        self._cursor = (0, 0)  # (segment seq, offset)
+        self._peeked = None  # cursor at the last peek
+        self._depth = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recover()
+
+    def _segment_file(self, seq):
+        return os.path.join(self.path, '%016d%s' % (seq, _SUFFIX))
+
+    def _scan(self, seq, start=0):
+        """Return (valid bytes, records, oldest timestamp) of a segment"""
+        offset = start
+        records = 0
+        oldest = None
+        with open(self._segment_file(seq), 'rb') as f:
+            f.seek(start)
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                size, crc, stamp = _HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size or _crc(data) != crc:
+                    break
+                if oldest is None:
+                    oldest = stamp
+                offset += _HEADER.size + size
+                records += 1
+        return offset, records, oldest
+
+    def _recover(self):
+        seqs = sorted(int(f[:-len(_SUFFIX)]) for f in os.listdir(self.path)
+                      if f.endswith(_SUFFIX))
+        cursor = os.path.join(self.path, 'cursor')
+        if os.path.exists(cursor):
+            with open(cursor, 'rb') as f:
+                data = f.read()
+            if len(data) == _CURSOR.size:
+                self._cursor = _CURSOR.unpack(data)
+        for seq in seqs:
+            if seq < self._cursor[0]:
+                os.unlink(self._segment_file(seq))
+                continue
+            start = self._cursor[1] if seq == self._cursor[0] else 0
+            size, records, oldest = self._scan(seq, start)
+            if size < os.path.getsize(self._segment_file(seq)):
+                logging.warning('upload queue: truncate torn segment %d at %d'
+                                % (seq, size))
+                with open(self._segment_file(seq), 'r+b') as f:
+                    f.truncate(size)
+            self._segments.append([seq, size, records, oldest])
+            self._depth += records
+        if self._segments and self._cursor[0] < self._segments[0][0]:
+            self._cursor = (self._segments[0][0], 0)
+        logging.info('upload queue %s: %d records, %d bytes backlog' % (
+                     self.path, self._depth, self.backlog))
+
+    def _open_writer(self):
+        if self._segments:
+            seq = self._segments[-1][0] + 1
+        else:
+            seq = self._cursor[0] + 1
+            self._cursor = (seq, 0)
+        self._segments.append([seq, 0, 0, None])
+        self._writer = open(self._segment_file(seq), 'ab')
+
+    def put(self, data, stamp=None):
+        """Append one record (bytes)"""
+        if stamp is None:
+            stamp = time.time()
+        record = _HEADER.pack(len(data), _crc(data), stamp) + data
+        with self._lock:
+            if self._writer is None or \
+                    self._segments[-1][1] + len(record) > self.segment_size:
+                self._roll()
+            self._writer.write(record)
+            seg = self._segments[-1]
+            seg[1] += len(record)
+            seg[2] += 1
+            if seg[3] is None:
+                seg[3] = stamp
+            self._depth += 1
+            if self.backlog > self.max_bytes:
+                self._evict()
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._open_writer()
+
+    def _evict(self):
+        while len(self._segments) > 1 and self.backlog > self.max_bytes:
+            seq, size, records, _ = self._segments.pop(0)
+            if seq == self._cursor[0]:
+                # part of it was sent already
+                records = self._count_from(seq, self._cursor[1])
+            os.unlink(self._segment_file(seq))
+            self._depth -= records
+            self.evicted += records
+            self._cursor = (self._segments[0][0], 0)
+            logging.warning('upload queue full, evicted segment %d '
+                            '(%d records)' % (seq, records))
+        self._save_cursor()
+
+    def _count_from(self, seq, offset):
+        return self._scan(seq, offset)[1]
+
+    def _count_between(self, start, end):
+        """Records from position start to position end"""
+        records = 0
+        for seg in self._segments:
+            seq = seg[0]
+            if seq < start[0] or seq > end[0]:
+                continue
+            offset = start[1] if seq == start[0] else 0
+            stop = end[1] if seq == end[0] else seg[1]
+            with open(self._segment_file(seq), 'rb') as f:
+                f.seek(offset)
+                while offset < stop:
+                    size = _HEADER.unpack(f.read(_HEADER.size))[0]
+                    f.seek(size, 1)
+                    offset += _HEADER.size + size
+                    records += 1
+        return records
+
+    def sync(self):
+        """Flush the buffered segment to disk"""
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+
+    def peek(self, count):
+        """
+        Return up to count (timestamp, data) records from the head of the
+        queue, and the position to commit once they are delivered.
+        """
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+            records = []
+            seq, offset = self._peeked = self._cursor
+            for seg in self._segments:
+                if seg[0] < seq:
+                    continue
+                if seg[0] > seq:
+                    seq, offset = seg[0], 0
+                with open(self._segment_file(seq), 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < count and offset < seg[1]:
+                        size, crc, stamp = _HEADER.unpack(f.read(_HEADER.size))
+                        records.append((stamp, f.read(size)))
+                        offset += _HEADER.size + size
+                if len(records) >= count:
+                    break
+            return records, (seq, offset)
+
+    def commit(self, position, records):
+        """Drop the records up to position, returned by peek"""
+        with self._lock:
+            seq, offset = position
+            if self._segments and seq < self._segments[0][0]:
+                return  # evicted meanwhile, already accounted for
+            if self._cursor != self._peeked:
+                # an eviction moved the cursor into the batch, its head
+                # is accounted for already
+                records = self._count_between(self._cursor, position)
+            while self._segments and self._segments[0][0] < seq:
+                done = self._segments.pop(0)[0]
+                os.unlink(self._segment_file(done))
+            if self._segments and self._segments[0][0] == seq and \
+                    offset >= self._segments[0][1] and len(self._segments) > 1:
+                os.unlink(self._segment_file(seq))
+                self._segments.pop(0)
+                seq, offset = self._segments[0][0], 0
+            self._cursor = (seq, offset)
+            self._depth -= records
+            if self._segments and self._segments[0][0] == seq:
+                self._segments[0][3] = self._oldest_from(seq, offset)
+            self._save_cursor()
+
+    def _oldest_from(self, seq, offset):
+        with open(self._segment_file(seq), 'rb') as f:
+            f.seek(offset)
+            header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+        return _HEADER.unpack(header)[2]
+
+    def _save_cursor(self):
+        tmp = os.path.join(self.path, 'cursor.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(_CURSOR.pack(*self._cursor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, os.path.join(self.path, 'cursor'))
+
+    @property
+    def depth(self):
+        """Records waiting for upload"""
+        return self._depth
+
+    @property
+    def backlog(self):
+        """Bytes waiting for upload"""
+        total = sum(seg[1] for seg in self._segments)
+        if self._segments and self._segments[0][0] == self._cursor[0]:
+            total -= self._cursor[1]
+        return total
+
+    @property
+    def age(self):
+        """Seconds since the oldest record waiting for upload was queued"""
+        for seg in self._segments:
+            if seg[3] is not None and seg[2]:
+                if seg[0] == self._cursor[0] and self._cursor[1] >= seg[1]:
+                    continue
+                return time.time() - seg[3]
+        return 0.0
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush()
+                os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._writer = None
+
+
+class UploadFlusher(object):
+    """
+    Drain a SegmentQueue in batches.
+
+    :param queue: SegmentQueue to drain
+    :param send: callable taking a list of record payloads, returns how
+        many of them, from the head, were delivered
+    :param batch: max records per batch
+    :param high_water: records waiting before accept() thins the samples
+    """
+
+    def __init__(self, queue, send, batch=50, retry_min=5, retry_max=300,
+                 high_water=HIGH_WATER):
+        self.queue = queue
+        self.send = send
+        self.batch = batch
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.high_water = high_water
+        self.sent = 0
+        self.failures = 0
+        self.thinned = 0
+        self._accepted = 0
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.queue.close()
+
+    def notify(self):
+        """Wake the flusher up after new records are queued"""
+        self._wakeup.set()
+
+    def accept(self, interval, now=None):
+        """
+        Backpressure: whether a producer queueing a sample every interval
+        seconds should queue one now. Above high_water the samples are
+        spaced by interval times depth / high_water, so a long outage
+        stretches the sampling instead of evicting the oldest ones.
+        """
+        if now is None:
+            now = time.time()
+        depth = self.queue.depth
+        if self.high_water and depth >= self.high_water and \
+                now - self._accepted < interval * (depth / float(
+                    self.high_water) - 0.5):
+            self.thinned += 1
+            return False
+        self._accepted = now
+        return True
+
+    def run(self):
+        retry = self.retry_min
+        last_sync = time.time()
+        while self._running:
+            if time.time() - last_sync >= SYNC_INTERVAL:
+                self.queue.sync()
+                last_sync = time.time()
+            records, position = self.queue.peek(self.batch)
+            if not records:
+                self._wakeup.wait(SYNC_INTERVAL)
+                self._wakeup.clear()
+                continue
+            try:
+                done = self.send([data for _, data in records])
+            except Exception as e:
+                logging.error('upload batch error: %s' % e)
+                done = 0
+            if done == len(records):
+                self.queue.commit(position, done)
+            elif done:
+                # commit the delivered head only
+                part, position = self.queue.peek(done)
+                self.queue.commit(position, len(part))
+            self.sent += done
+            if done < len(records):
+                self.failures += 1
+                if done:
+                    retry = self.retry_min  # the link works, retry soon
+                # jittered, the hubs of a site do not retry in lockstep
+                delay = retry * random.uniform(0.5, 1.5)
+                logging.info('upload queue: %d records pending, retry in '
+                             '%.0fs' % (self.queue.depth, delay))
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                retry = min(retry * 2, self.retry_max)
+            else:
+                retry = self.retry_min
@@ -6,10 +6,9 @@
 .. $Id$
 
 This is a literal implementation of XMODEM.TXT_, XMODEM1K.TXT_ and
-XMODMCRC.TXT_, support for YMODEM and ZMODEM is pending. YMODEM should
-be fairly easy to implement as it is a hack on top of the XMODEM
-protocol using sequence bytes ``0x00`` for sending file names (and some
-meta data).
+XMODMCRC.TXT_, with YMODEM batches on top of it, which use sequence bytes
+``0x00`` for sending file names (and some meta data). ZMODEM is a
+separate ``ZMODEM`` class, over the same ``getc`` and ``putc``.
 
 .. _XMODEM.TXT: doc/XMODEM.TXT
 .. _XMODEM1K.TXT: doc/XMODEM1K.TXT
@@ -115,11 +114,22 @@ __copyright__ = ['Copyright (c) 2010 Wijnand Modderman',
 __license__ = 'MIT'
 __version__ = '0.4.5'
 
-import platform
-import logging
-import time
+import os
+import re
 import sys
+import time
+import struct
+import logging
+import binascii
+from binascii import crc32
+from array import array
 from functools import partial
+from collections import deque
+
+try:
+    from binascii import crc_hqx
+except ImportError:
+    crc_hqx = None
 
 # Protocol bytes
 NUL = b'\x00'
@@ -131,6 +141,22 @@ DLE = b'\x10'
 NAK = b'\x15'
 CAN = b'\x18'
 CRC = b'C'
+CRG = b'G'
+
+# Errors with blocks in flight before a windowed send goes stop-and-wait
+WINDOW_ERRORS = 3
+
+try:
+    buffer
+except NameError:
+    def _view(data, start=0, end=None):
+        '''data[start:end] without a copy'''
+        return memoryview(data)[start:end]
+else:
+    def _view(data, start=0, end=None):
+        '''data[start:end] without a copy, a buffer, py2 APIs take those'''
+        end = len(data) if end is None else end
+        return buffer(data, start, end - start)
 
 
 class XMODEM(object):
@@ -160,7 +186,8 @@ class XMODEM(object):
     :param putc: Function to transmit bytes to a stream. The function takes the
         bytes to be written and a timeout in seconds as parameters. It must
         return the number of bytes written to the stream, or ``None`` in case of
-        a timeout.
+        a timeout. Data packets are views (memoryview, or buffer on py2) of a
+        buffer which is reused once putc returned.
     :type putc: callable
     :param mode: XMODEM protocol mode
     :type mode: string
@@ -224,7 +251,8 @@ class XMODEM(object):
         for _ in range(count):
             self.putc(CAN, timeout)
 
-    def send(self, stream, retry=16, timeout=60, quiet=False, callback=None):
+    def send(self, stream, retry=16, timeout=60, quiet=False, callback=None,
+             window=1):
         '''
         Send a stream via the XMODEM protocol.
 
@@ -235,8 +263,9 @@ class XMODEM(object):
         Returns ``True`` upon successful transmission or ``False`` in case of
         failure.
 
-        :param stream: The stream object to send data from.
-        :type stream: stream (file, etc.)
+        :param stream: The stream object to send data from, read into the
+                       packet buffer when it has readinto.
+        :type stream: stream (file, mmap, etc.)
         :param retry: The maximum number of times to try to resend a failed
                       packet before failing.
         :type retry: int
@@ -252,6 +281,12 @@ class XMODEM(object):
                          Expected callback signature:
                          def callback(total_packets, success_count, error_count)
         :type callback: callable
+        :param window: Blocks sent ahead of their ACK. On the first error the
+                       blocks not acknowledged are sent again one at a time,
+                       as with the default 1 (stop-and-wait). A receiver
+                       asking for ``G`` (YMODEM-g) gets every block at once
+                       and acknowledges none, it cancels on an error.
+        :type window: int
         '''
 
         # initialize protocol
@@ -268,6 +303,7 @@ class XMODEM(object):
         self.log.debug('Begin start sequence, packet_size=%d', packet_size)
         error_count = 0
         crc_mode = 0
+        streaming = False
         cancel = 0
         while True:
             char = self.getc(1)
@@ -280,6 +316,11 @@ class XMODEM(object):
                     self.log.debug('16-bit CRC requested (CRC).')
                     crc_mode = 1
                     break
+                elif char == CRG:
+                    self.log.debug('16-bit CRC streaming requested (G).')
+                    crc_mode = 1
+                    streaming = True
+                    break
                 elif char == CAN:
                     if not quiet:
                         print('received CAN', file=sys.stderr)
@@ -302,93 +343,51 @@ class XMODEM(object):
                 return False
 
         # send data
-        error_count = 0
         success_count = 0
-        total_packets = 0
         if self.mode == 'ymodem':
-            sequence = 0
+            # send packet sequence 0 containing:
+            #  Filename Length [Modification-Date [Mode [Serial-Number]]]
+            # 'stream' is actually the filename
+            import os
             filenames = stream
-        else:
-            sequence = 1
-        while True:
-            # build packet
-            if self.mode == 'ymodem' and success_count == 0:
-                # send packet sequence 0 containing:
-                #  Filename Length [Modification-Date [Mode [Serial-Number]]]
-                # 'stream' is actually the filename
-                import os
-                if len(filenames):
-                    filename = filenames.pop()
-                    stream = open(filename, 'rb')
-                    stat = os.stat(filename)
-                    data = os.path.basename(filename).encode() + NUL + str(stat.st_size).encode()
-                    self.log.debug('ymodem sending : "%s" len:%d', filename, stat.st_size)
-                else:
-                    # empty file name packet terminates transmission
-                    filename = ''
-                    data = ''.encode()
-                    stream = None
-                    self.log.debug('ymodem done, sending empty header.')
-                if len(data) <= 128:
-                    header_size = 128
-                else:
-                    header_size = 1024
-
-                header = self._make_send_header(header_size, sequence)
-                data = data.ljust(header_size, NUL)
-                checksum = self._make_send_checksum(crc_mode, data)
+            if len(filenames):
+                filename = filenames.pop()
+                stream = open(filename, 'rb')
+                stat = os.stat(filename)
+                data = os.path.basename(filename).encode() + NUL + str(stat.st_size).encode()
+                self.log.debug('ymodem sending : "%s" len:%d', filename, stat.st_size)
             else:
-                # happens after sending ymodem empty filename
-                if not stream:
-                    return True
-                # normal data packet
-                data = stream.read(packet_size)
-                if not data:
-                    # end of stream
-                    self.log.debug('send: at EOF')
-                    break
-                total_packets += 1
-
-                header = self._make_send_header(packet_size, sequence)
-                data = data.ljust(packet_size, self.pad)
-                checksum = self._make_send_checksum(crc_mode, data)
-
-            # emit packet & get ACK
-            while True:
-                self.log.debug('send: block %d', sequence)
-                self.putc(header + data + checksum)
-                char = self.getc(1, timeout)
-                if char == ACK:
-                    success_count += 1
-                    if callable(callback):
-                        callback(total_packets, success_count, error_count)
-                    error_count = 0
-                    if self.mode == 'ymodem' and success_count == 1 and len(filename):
-                        char = self.getc(1, timeout)
-                        if char == DLE: # dunno why
-                            char = self.getc(1, timeout)
-                        if char == CRC:
-                            break
-                        self.log.error('send error: ymodem expected CRC; got %r for block %d',
-                                       char, sequence)
-                    else:
-                        break
-
-                self.log.error('send error: expected ACK; got %r for block %d',
-                               char, sequence)
-                error_count += 1
-                if callable(callback):
-                    callback(total_packets, success_count, error_count)
-                if error_count > retry:
-                    # excessive amounts of retransmissions requested,
-                    # abort transfer
-                    self.log.error('send error: NAK received %d times, '
-                                   'aborting.', error_count)
-                    self.abort(timeout=timeout)
-                    return False
+                # empty file name packet terminates transmission
+                filename = ''
+                data = ''.encode()
+                stream = None
+                self.log.debug('ymodem done, sending empty header.')
+            if len(data) <= 128:
+                header_size = 128
+            else:
+                header_size = 1024
 
-            # keep track of sequence
-            sequence = (sequence + 1) % 0x100
+            header = self._make_send_header(header_size, 0)
+            data = data.ljust(header_size, NUL)
+            checksum = self._make_send_checksum(crc_mode, data)
+            if not self._send_header(header + data + checksum, len(filename),
+                                     streaming, retry, timeout, callback):
+                return False
+            # happens after sending ymodem empty filename
+            if not stream:
+                return True
+            success_count = 1
+
+        if streaming:
+            sent = self._send_streaming(stream, packet_size, crc_mode,
+                                        callback)
+        else:
+            sent = self._send_window(stream, packet_size, crc_mode, window,
+                                     success_count, retry, timeout, callback)
+        if not sent:
+            self.abort(timeout=timeout)
+            return False
+        error_count = 0
 
         # emit EOT and get corresponding ACK
         while True:
@@ -400,6 +399,9 @@ class XMODEM(object):
             char = self.getc(1, timeout)
             if char == ACK:
                 break
+            elif char == CAN:
+                self.log.info('Transmission canceled: received CAN for EOT')
+                return False
             else:
                 self.log.error('send error: expected ACK; got %r', char)
                 error_count += 1
@@ -413,9 +415,224 @@ class XMODEM(object):
             # YMODEM - recursively send next file
             # or empty filename header to end the xfer batch.
             stream.close()
-            return self.send(filenames, retry, timeout, quiet, callback)
+            return self.send(filenames, retry, timeout, quiet, callback,
+                             window)
         return True
 
+    def _send_header(self, packet, named, streaming, retry, timeout,
+                     callback):
+        '''
+        Send the YMODEM header block until the receiver asks for the data,
+        a YMODEM-g receiver asks with G and may not ACK it.
+        '''
+        error_count = 0
+        while True:
+            self.log.debug('send: block 0')
+            self.putc(packet)
+            if streaming and not named:
+                return True  # end of batch, nothing follows
+            char = self.getc(1, timeout)
+            if char == ACK and named:
+                char = self.getc(1, timeout)
+                if char == DLE:  # dunno why
+                    char = self.getc(1, timeout)
+            if char == ACK and not named:
+                return True
+            if named and char == (CRG if streaming else CRC):
+                if callable(callback):
+                    callback(0, 1, error_count)
+                return True
+            self.log.error('send error: ymodem expected %s; got %r for '
+                           'block 0', 'G' if streaming else 'ACK, CRC', char)
+            error_count += 1
+            if callable(callback):
+                callback(0, 0, error_count)
+            if error_count > retry:
+                self.log.error('send error: NAK received %d times, '
+                               'aborting.', error_count)
+                self.abort(timeout=timeout)
+                return False
+
+    def _send_window(self, stream, packet_size, crc_mode, window,
+                     success_count, retry, timeout, callback):
+        '''
+        Send the stream in blocks, up to window of them sent ahead of their
+        ACK. ACKs come in block order and carry no sequence: on a NAK the
+        line is purged of the answers to all the blocks in flight, which the
+        receiver discarded, for their line time plus the longest round trip
+        seen, before they are sent again from the oldest one. After
+        WINDOW_ERRORS such errors, or a missed or garbled ACK meaning the
+        receiver does not take blocks ahead, the transfer goes on in
+        stop-and-wait.
+        '''
+        window = max(1, min(window, 0xff))
+        window_errors = 0
+        spacing = 0.0  # longest time between two ACKs, a block line time
+        round_trip = 0.0  # longest time from sending a block to its ACK
+        last_ack = None
+        sequence = 1
+        error_count = 0
+        total_packets = 0
+        # [sequence, buffer, packet, time sent] sent or to send, not
+        # acknowledged
+        pending = deque()
+        free = []  # buffers of acknowledged packets
+        in_flight = 0
+        eof = False
+        while True:
+            while not eof and len(pending) < window:
+                buf = free.pop() if free else self._packet_buffer(packet_size)
+                packet = self._fill_packet(buf, stream, packet_size,
+                                           sequence, crc_mode)
+                if packet is None:
+                    # end of stream
+                    self.log.debug('send: at EOF')
+                    eof = True
+                    break
+                total_packets += 1
+                pending.append([sequence, buf, packet, None])
+                # keep track of sequence
+                sequence = (sequence + 1) % 0x100
+            if not pending:
+                return True
+            while in_flight < min(window, len(pending)):
+                self.log.debug('send: block %d', pending[in_flight][0])
+                self.putc(pending[in_flight][2])
+                pending[in_flight][3] = time.time()
+                in_flight += 1
+
+            char = self.getc(1, timeout)
+            if char == ACK:
+                now = time.time()
+                if last_ack is not None:
+                    spacing = max(spacing, now - last_ack)
+                last_ack = now
+                round_trip = max(round_trip, now - pending[0][3])
+                free.append(pending.popleft()[1])
+                in_flight -= 1
+                success_count += 1
+                if callable(callback):
+                    callback(total_packets, success_count, error_count)
+                error_count = 0
+                continue
+
+            self.log.error('send error: expected ACK; got %r for block %d',
+                           char, pending[0][0])
+            if char is not None:
+                round_trip = max(round_trip, time.time() - pending[0][3])
+            error_count += 1
+            if callable(callback):
+                callback(total_packets, success_count, error_count)
+            if error_count > retry:
+                # excessive amounts of retransmissions requested,
+                # abort transfer
+                self.log.error('send error: NAK received %d times, '
+                               'aborting.', error_count)
+                return False
+            if in_flight > 1:
+                # the answer to the last block in flight comes at most a
+                # round trip after the line time of the blocks ahead of it,
+                # the line is quiet after it; before any answer wait as
+                # long as for one
+                stale = self._purge(
+                    min(timeout, max(0.1, 2 * spacing)),
+                    in_flight * (spacing or round_trip) + round_trip
+                    if round_trip else timeout)
+                window_errors += 1
+                if char != NAK or window_errors >= WINDOW_ERRORS:
+                    self.log.info('send: falling back to stop-and-wait at '
+                                  'block %d', pending[0][0])
+                    window = 1
+                if char not in (None, NAK) and ACK in stale:
+                    # a garbled ACK: the receiver took the oldest block and
+                    # the later ones up to the last acknowledged, their
+                    # answers come in order after it
+                    taken = min(in_flight, stale.rfind(ACK) + 2)
+                    self.log.info('send: blocks %d to %d were received',
+                                  pending[0][0], pending[taken - 1][0])
+                    for _ in range(taken):
+                        free.append(pending.popleft()[1])
+                    success_count += taken
+                    if callable(callback):
+                        callback(total_packets, success_count, error_count)
+            in_flight = 0
+            last_ack = None
+
+    def _send_streaming(self, stream, packet_size, crc_mode, callback):
+        '''
+        Send the stream in blocks without waiting (YMODEM-g), the receiver
+        only answers to cancel
+        '''
+        sequence = 1
+        total_packets = 0
+        buf = self._packet_buffer(packet_size)
+        while True:
+            packet = self._fill_packet(buf, stream, packet_size, sequence,
+                                       crc_mode)
+            if packet is None:
+                self.log.debug('send: at EOF')
+                break
+            total_packets += 1
+            self.log.debug('send: block %d', sequence)
+            self.putc(packet)
+            if callable(callback):
+                callback(total_packets, total_packets, 0)
+            char = self.getc(1, 0)
+            if char == CAN and self.getc(1, 1) == CAN:
+                self.log.info('Transmission canceled: received 2xCAN '
+                              'at block %d', sequence)
+                return False
+            sequence = (sequence + 1) % 0x100
+        self._purge(0)
+        return True
+
+    def _purge(self, timeout=1, least=0):
+        '''
+        Discard input until the line was quiet for timeout, and for at least
+        least seconds. Returns the bytes discarded.
+        '''
+        deadline = time.time() + least
+        stale = bytearray()
+        while True:
+            char = self.getc(1, max(timeout, deadline - time.time()))
+            if char is None:
+                return bytes(stale)
+            stale += char
+
+    def _packet_buffer(self, packet_size):
+        '''Buffer of a packet of packet_size data bytes, for _fill_packet'''
+        return bytearray(3 + packet_size + 2)
+
+    def _fill_packet(self, buf, stream, packet_size, sequence, crc_mode):
+        '''
+        Read the next block of stream into the packet buffer buf, readinto
+        when the stream has it. Returns the packet, a view of buf, or
+        ``None`` at the end of the stream.
+        '''
+        view = memoryview(buf)
+        data = view[3:3 + packet_size]
+        readinto = getattr(stream, 'readinto', None)
+        if readinto is not None:
+            count = readinto(data) or 0
+        else:
+            chunk = stream.read(packet_size)
+            count = len(chunk)
+            data[:count] = chunk
+        if not count:
+            return None
+        if count < packet_size:
+            data[count:] = self.pad * (packet_size - count)
+        buf[0] = 0x01 if packet_size == 128 else 0x02  # SOH, STX
+        buf[1] = sequence
+        buf[2] = 0xff - sequence
+        if crc_mode:
+            crc = self.calc_crc(data)
+            buf[3 + packet_size] = crc >> 8
+            buf[4 + packet_size] = crc & 0xff
+            return _view(buf, 0, 5 + packet_size)
+        buf[3 + packet_size] = self.calc_checksum(data)
+        return _view(buf, 0, 4 + packet_size)
+
     def _make_send_header(self, packet_size, sequence):
         assert packet_size in (128, 1024), packet_size
         _bytes = []
@@ -447,8 +664,9 @@ class XMODEM(object):
         Returns the number of bytes received on success or ``None`` in case of
         failure.
 
-        :param stream: The stream object to write data to.
-        :type stream: stream (file, etc.)
+        :param stream: The stream object to write data to, written views
+                       of the received blocks.
+        :type stream: stream (file, mmap, etc.)
         :param crc_mode: XMODEM CRC mode
         :type crc_mode: int
         :param retry: The maximum number of times to try to resend a failed
@@ -558,46 +776,21 @@ class XMODEM(object):
                         self.abort()
                         return None
 
-            # read sequence
+            # read sequence, data and checksum in one go
             error_count = 0
             cancel = 0
             self.log.debug('recv: data block %d', sequence)
-            seq1 = self.getc(1, timeout)
-            if seq1 is None:
-                self.log.warn('getc failed to get first sequence byte')
-                seq2 = None
-            else:
-                seq1 = ord(seq1)
-                seq2 = self.getc(1, timeout)
-                if seq2 is None:
-                    self.log.warn('getc failed to get second sequence byte')
-                else:
-                    # second byte is the same as first as 1's complement
-                    seq2 = 0xff - ord(seq2)
-
-            if not (seq1 == seq2 == sequence):
-                # consume data anyway ... even though we will discard it,
-                # it is not the sequence we expected!
-                self.log.error('expected sequence %d, '
-                               'got (seq1=%r, seq2=%r), '
-                               'receiving next block, will NAK.',
-                               sequence, seq1, seq2)
-                self.getc(packet_size + 1 + crc_mode)
-            else:
-                # sequence is ok, read packet
-                # packet_size + checksum
-                data = self.getc(packet_size + 1 + crc_mode, timeout)
-                valid, data = self._verify_recv_checksum(crc_mode, data)
-
-                # valid data, append chunk
-                if valid:
-                    income_size += len(data)
-                    stream.write(data)
-                    self.putc(ACK)
-                    sequence = (sequence + 1) % 0x100
-                    # get next start-of-header byte
-                    char = self.getc(1, timeout)
-                    continue
+            data = self._recv_block(packet_size, crc_mode, sequence, timeout)
+
+            # valid data, append chunk
+            if data is not None:
+                income_size += len(data)
+                stream.write(data)
+                self.putc(ACK)
+                sequence = (sequence + 1) % 0x100
+                # get next start-of-header byte
+                char = self.getc(1, timeout)
+                continue
 
             # something went wrong, request retransmission
             self.log.warn('recv error: purge, requesting retransmission (NAK)')
@@ -618,6 +811,26 @@ class XMODEM(object):
             char = self.getc(1, timeout)
             continue
 
+    def _recv_block(self, packet_size, crc_mode, sequence, timeout):
+        '''
+        Read the rest of a block after its SOH or STX in one getc. Returns
+        its data, a view of the frame read, or ``None`` if it is not the
+        good block.
+        '''
+        frame = self.getc(packet_size + 3 + crc_mode, timeout)
+        if frame is None:
+            self.log.warn('getc failed to get block %d', sequence)
+            return None
+        seq = bytearray(frame[:2])
+        if not (seq[0] == 0xff - seq[1] == sequence):
+            # not the sequence we expected, the block is discarded
+            self.log.error('expected sequence %d, '
+                           'got (seq1=%r, seq2=%r), will NAK.',
+                           sequence, seq[0], 0xff - seq[1])
+            return None
+        valid, data = self._verify_recv_checksum(crc_mode, _view(frame, 2))
+        return data if valid else None
+
     def _verify_recv_checksum(self, crc_mode, data):
         if crc_mode:
             _checksum = bytearray(data[-2:])
@@ -631,7 +844,7 @@ class XMODEM(object):
                               '(theirs=%04x, ours=%04x), ',
                               their_sum, our_sum)
         else:
-            _checksum = bytearray([data[-1]])
+            _checksum = bytearray(data[-1:])
             their_sum = _checksum[0]
             data = data[:-1]
 
@@ -654,10 +867,7 @@ class XMODEM(object):
             '0x3c'
 
         '''
-        if platform.python_version_tuple() >= ('3', '0', '0'):
-            return (sum(data) + checksum) % 256
-        else:
-            return (sum(map(ord, data)) + checksum) % 256
+        return calc_checksum8(data, checksum)
 
     def calc_crc(self, data, crc=0):
         '''
@@ -670,16 +880,686 @@ class XMODEM(object):
             '0xd5e3'
 
         '''
-        for char in bytearray(data):
-            crctbl_idx = ((crc >> 8) ^ char) & 0xff
-            crc = ((crc << 8) ^ self.crctable[crctbl_idx]) & 0xffff
-        return crc & 0xffff
+        return calc_crc16(data, crc)
+
+
+def calc_checksum8(data, checksum=0):
+    '''8 bit sum of data, continuing checksum'''
+    return (sum(bytearray(data)) + checksum) & 0xff
+
+
+def crc16_bytewise(data, crc=0):
+    '''CRC-CCITT of data, continuing crc, a table lookup per byte'''
+    table = XMODEM.crctable
+    for char in bytearray(data):
+        crc = ((crc << 8) ^ table[((crc >> 8) ^ char) & 0xff]) & 0xffff
+    return crc & 0xffff
+
+
+_word_table = None
+
+
+def crc16_table(data, crc=0):
+    '''
+    CRC-CCITT of data, continuing crc, a lookup per 16 bit word: the CRC
+    register is 16 bits wide, shifting a word in replaces all of it, so
+    the next register is the entry of register ^ word.
+    '''
+    global _word_table
+    table = _word_table
+    if table is None:
+        low = XMODEM.crctable
+        table = _word_table = array('H', [
+            ((low[i >> 8] << 8) ^ low[((low[i >> 8] >> 8) ^ i) & 0xff])
+            & 0xffff for i in range(0x10000)])
+    crc &= 0xffff
+    data = bytearray(data)
+    end = len(data) & ~1
+    words = array('H', bytes(data[:end]))
+    if sys.byteorder == 'little':
+        words.byteswap()
+    for word in words:
+        crc = table[crc ^ word]
+    if end < len(data):
+        crc = ((crc << 8) ^ XMODEM.crctable[((crc >> 8) ^ data[end]) & 0xff]) \
+            & 0xffff
+    return crc
+
+
+def crc16_binascii(data, crc=0):
+    '''CRC-CCITT of data, continuing crc, computed in C'''
+    return crc_hqx(data, crc & 0xffff)
+
+
+# CRC-CCITT engines by name, all give the same results
+CRC_ENGINES = {'bytewise': crc16_bytewise, 'table': crc16_table}
+if crc_hqx is not None:
+    CRC_ENGINES['binascii'] = crc16_binascii
+# Engine of calc_crc16, the fastest one available, chosen at import
+CRC_ENGINE = 'binascii' if crc_hqx is not None else 'table'
+calc_crc16 = CRC_ENGINES[CRC_ENGINE]
+
+
+class SerialTransport(object):
+    '''
+    getc and putc of XMODEM over a serial port. getc blocks in the port
+    read until the requested bytes arrived or the timeout expired, so an
+    ACK is seen as soon as it arrives. Bytes of a read that timed out are
+    dropped: after a timeout XMODEM waits for a fresh control byte, which
+    a stale part of a frame would be taken for.
+
+    >>> port = serial.Serial('/dev/ttyUSB0')
+    >>> transport = SerialTransport(port)
+    >>> modem = XMODEM(transport.getc, transport.putc)
+
+    :param port: serial.Serial, or any object with read(size), write(data)
+        and a timeout attribute in seconds; its timeout is changed
+    '''
+
+    def __init__(self, port):
+        self.port = port
+
+    def getc(self, size, timeout=1):
+        deadline = time.time() + timeout
+        if self.port.timeout != timeout:
+            self.port.timeout = timeout  # a termios call, only when new
+        data = b''
+        while True:
+            data += self.port.read(size - len(data))
+            remaining = deadline - time.time()
+            if len(data) >= size or remaining <= 0:
+                break
+            self.port.timeout = remaining  # woken early, e.g. by EINTR
+        if len(data) < size:
+            return None
+        return data
+
+    def putc(self, data, timeout=1):
+        return self.port.write(data) or None
 
 
 XMODEM1k = partial(XMODEM, mode='xmodem1k')
 YMODEM = partial(XMODEM, mode='ymodem')
 
 
+# ZMODEM frame bytes
+ZPAD = b'*'
+ZDLE = b'\x18'
+ZBIN = b'A'
+ZHEX = b'B'
+ZBIN32 = b'C'
+XON = b'\x11'
+
+# ZMODEM frame types
+(ZRQINIT, ZRINIT, ZSINIT, ZACK, ZFILE, ZSKIP, ZNAK, ZABORT, ZFIN, ZRPOS,
+ ZDATA, ZEOF, ZFERR, ZCRC, ZCHALLENGE, ZCOMPL, ZCAN, ZFREECNT, ZCOMMAND,
+ ZSTDERR) = range(20)
+
+# ZMODEM data subpacket ends: frame ends, goes on, goes on and ZACK,
+# ends and ZACK
+ZCRCE = b'h'
+ZCRCG = b'i'
+ZCRCQ = b'j'
+ZCRCW = b'k'
+
+# ZRINIT flags: full duplex, receive while writing, CRC-32
+CANFDX = 0x01
+CANOVIO = 0x02
+CANFC32 = 0x20
+# ZFILE conversion options: binary, resume an interrupted file
+ZCBIN = 1
+ZCRESUM = 3
+
+# Largest data subpacket accepted
+ZMAX_SUBPACKET = 8192
+
+# Bytes ZDLE escaped: ZDLE, DLE, XON, XOFF with and without the high bit,
+# and CR after @, which telnet eats
+_ZESCAPE = re.compile(b'[\x10\x11\x13\x18\x90\x91\x93]|(?<=[@\xc0])[\r\x8d]')
+_ZESCAPES = dict((struct.pack('B', c), struct.pack('BB', 0x18, c ^ 0x40))
+                 for c in (0x10, 0x11, 0x13, 0x18, 0x90, 0x91, 0x93, 0x0d,
+                           0x8d))
+_ZFLOW = (0x11, 0x13, 0x91, 0x93)
+# _zdl() values of the subpacket ends
+_ZEND = 0x100
+
+
+class ZMODEMError(IOError):
+    pass
+
+
+class _ZTimeout(ZMODEMError):
+    pass
+
+
+class _ZCancel(ZMODEMError):
+    pass
+
+
+def _zescape(data):
+    return _ZESCAPE.sub(lambda m: _ZESCAPES[m.group()], bytes(data))
+
+
+def _zpos(pos):
+    '''Header bytes of a file position'''
+    return struct.pack('<I', pos & 0xffffffff)
+
+
+def _zflags(f0, f1=0, f2=0, f3=0):
+    '''Header bytes of flags, ZF0 is the last one'''
+    return struct.pack('BBBB', f3, f2, f1, f0)
+
+
+def _zcrc32(data, crc=0):
+    return crc32(data, crc) & 0xffffffff
+
+
+class ZMODEM(object):
+    '''
+    ZMODEM protocol handler, over the getc and putc callables of XMODEM.
+
+    File data goes out as one stream of CRC-32 (or CRC-16) checked
+    subpackets, without waiting for acknowledgements. A receiver hitting a
+    bad subpacket answers ZRPOS with the offset of the last good byte and
+    the sender goes on from there, so does a transfer started again over a
+    partly received file:
+
+    >>> modem = ZMODEM(getc, putc)
+    >>> modem.send(['image.bin'], resume=True)
+    >>> modem.recv(open('image.bin', 'ab'), resume=True)
+
+    :param getc: Function to retrieve bytes from a stream, see ``XMODEM``
+    :type getc: callable
+    :param putc: Function to transmit bytes to a stream, see ``XMODEM``
+    :type putc: callable
+    :param block_size: Data bytes per subpacket
+    :type block_size: int
+    :param ack_interval: Subpackets between two acknowledgement requests,
+                         which only tell the sender how far the receiver is
+    :type ack_interval: int
+    '''
+
+    def __init__(self, getc, putc, block_size=1024, ack_interval=32):
+        self.getc = getc
+        self.putc = putc
+        self.block_size = min(block_size, ZMAX_SUBPACKET)
+        self.ack_interval = ack_interval
+        self.crc32 = False  # binary headers and data with CRC-32
+        self.resent = 0  # bytes sent again after a ZRPOS
+        self.log = logging.getLogger('xmodem.ZMODEM')
+
+    def abort(self):
+        '''Send the cancel sequence'''
+        self.putc(CAN * 8 + b'\x08' * 10)
+
+    # frames out
+
+    def _send_hex_header(self, ftype, data):
+        header = struct.pack('B', ftype) + data
+        frame = ZPAD + ZPAD + ZDLE + ZHEX + binascii.hexlify(
+            header + struct.pack('>H', calc_crc16(header))) + b'\r\x8a'
+        if ftype not in (ZACK, ZFIN):
+            frame += XON
+        self.putc(frame)
+
+    def _bin_header(self, ftype, data):
+        header = struct.pack('B', ftype) + data
+        if self.crc32:
+            return ZPAD + ZDLE + ZBIN32 + _zescape(
+                header + struct.pack('<I', _zcrc32(header)))
+        return ZPAD + ZDLE + ZBIN + _zescape(
+            header + struct.pack('>H', calc_crc16(header)))
+
+    def _subpacket(self, data, end):
+        if self.crc32:
+            crc = struct.pack('<I', _zcrc32(end, _zcrc32(data)))
+        else:
+            crc = struct.pack('>H', calc_crc16(end, calc_crc16(data)))
+        return _zescape(data) + ZDLE + end + _zescape(crc)
+
+    # frames in
+
+    def _raw(self, timeout):
+        char = self.getc(1, timeout)
+        if char is None:
+            raise _ZTimeout('timeout')
+        return ord(char)
+
+    def _zdl(self, timeout):
+        '''Next unescaped byte, or _ZEND | the end of a subpacket'''
+        char = self._raw(timeout)
+        while char in _ZFLOW:
+            char = self._raw(timeout)
+        if char != 0x18:
+            return char
+        cancels = 1
+        while True:
+            char = self._raw(timeout)
+            if char == 0x18:
+                cancels += 1
+                if cancels >= 5:
+                    raise _ZCancel('canceled by the other end')
+            elif char in (0x68, 0x69, 0x6a, 0x6b):
+                return _ZEND | char
+            elif char == 0x6c:
+                return 0x7f
+            elif char == 0x6d:
+                return 0xff
+            elif char & 0x60 == 0x40:
+                return char ^ 0x40
+            elif char not in _ZFLOW:
+                return None  # bad escape
+
+    def _read_header(self, timeout, char=None):
+        '''
+        (type, 4 header bytes, CRC-32) of the next good header, bytes before
+        it skipped
+        '''
+        cancels = 0
+        while True:
+            if char is None:
+                char = self._raw(timeout)
+            if char == 0x18:
+                cancels += 1
+                if cancels >= 5:
+                    raise _ZCancel('canceled by the other end')
+                char = None
+                continue
+            cancels = 0
+            if char != 0x2a:
+                char = None
+                continue
+            char = self._raw(timeout)
+            while char == 0x2a:
+                char = self._raw(timeout)
+            if char != 0x18:
+                continue
+            kind = self._raw(timeout)
+            char = None
+            if kind == 0x42:
+                header = self._read_hex_header(timeout)
+                is32 = False
+            elif kind in (0x41, 0x43):
+                is32 = kind == 0x43
+                header = self._read_bin_header(is32, timeout)
+            else:
+                continue
+            if header is None:
+                self.log.warn('recv error: bad header CRC')
+                continue
+            return header[0], header[1:], is32
+
+    def _read_hex_header(self, timeout):
+        digits = self.getc(14, timeout)
+        if digits is None:
+            raise _ZTimeout('timeout')
+        try:
+            header = binascii.unhexlify(digits.lower())
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        # CR LF, the XON after them is skipped as flow control
+        if self._raw(timeout) in (0x0d, 0x8d):
+            self.getc(1, timeout)
+        header = bytearray(header)
+        if calc_crc16(header[:5]) != (header[5] << 8 | header[6]):
+            return None
+        return header[:5]
+
+    def _read_bin_header(self, is32, timeout):
+        header = bytearray()
+        for _ in range(9 if is32 else 7):
+            char = self._zdl(timeout)
+            if char is None or char & _ZEND:
+                return None
+            header.append(char)
+        if is32:
+            ok = _zcrc32(bytes(header[:5])) == \
+                struct.unpack('<I', bytes(header[5:]))[0]
+        else:
+            ok = calc_crc16(header[:5]) == (header[5] << 8 | header[6])
+        return header[:5] if ok else None
+
+    def _read_subpacket(self, is32, timeout):
+        '''(data, end), (None, None) for a bad one'''
+        data = bytearray()
+        zdl = self._zdl
+        while True:
+            char = zdl(timeout)
+            if char is None or len(data) > ZMAX_SUBPACKET:
+                return None, None
+            if char & _ZEND:
+                break
+            data.append(char)
+        end = struct.pack('B', char & 0xff)
+        crc = bytearray()
+        for _ in range(4 if is32 else 2):
+            char = zdl(timeout)
+            if char is None or char & _ZEND:
+                return None, None
+            crc.append(char)
+        data = bytes(data)
+        if is32:
+            ok = _zcrc32(end, _zcrc32(data)) == \
+                struct.unpack('<I', bytes(crc))[0]
+        else:
+            ok = calc_crc16(end, calc_crc16(data)) == (crc[0] << 8 | crc[1])
+        if not ok:
+            return None, None
+        return data, end
+
+    # sender
+
+    def send(self, files, retry=16, timeout=10, callback=None, resume=False):
+        '''
+        Send a batch of files via the ZMODEM protocol.
+
+        Returns ``True`` when the receiver got every file or ``False`` in
+        case of failure.
+
+        :param files: File names, sent in order
+        :type files: list
+        :param retry: The maximum number of errors in a row before failing
+        :type retry: int
+        :param timeout: Seconds to wait for an answer
+        :type timeout: int
+        :param callback: Called as callback(filename, offset, size) as the
+                         data goes out
+        :type callback: callable
+        :param resume: Ask the receiver to go on with the files it already
+                       has part of
+        :type resume: bool
+        '''
+        try:
+            self.putc(b'rz\r')
+            self._send_hex_header(ZRQINIT, _zpos(0))
+            header = self._expect((ZRINIT,), retry, timeout,
+                                  lambda: self._send_hex_header(
+                                      ZRQINIT, _zpos(0)))
+            flags = header[1][3]
+            self.crc32 = bool(flags & CANFC32)
+            self.log.debug('ZRINIT flags %02x', flags)
+            for filename in files:
+                if not self._send_file(filename, retry, timeout, callback,
+                                       resume):
+                    self.abort()
+                    return False
+            self._send_hex_header(ZFIN, _zpos(0))
+            self._expect((ZFIN,), retry, timeout,
+                         lambda: self._send_hex_header(ZFIN, _zpos(0)))
+            self.putc(b'OO')
+        except ZMODEMError as e:
+            self.log.error('send error: %s', e)
+            if not isinstance(e, _ZCancel):
+                self.abort()
+            return False
+        self.log.info('Transmission successful (ZFIN received).')
+        return True
+
+    def _expect(self, ftypes, retry, timeout, resend):
+        '''Header of one of ftypes, resend() after a timeout'''
+        errors = 0
+        while True:
+            try:
+                header = self._read_header(timeout)
+            except _ZTimeout:
+                errors += 1
+                if errors > retry:
+                    raise ZMODEMError('no answer')
+                resend()
+                continue
+            if header[0] in ftypes:
+                return header
+            if header[0] in (ZABORT, ZFERR, ZCAN):
+                raise _ZCancel('aborted by the other end (%d)' % header[0])
+            self.log.debug('ignored header %d', header[0])
+
+    def _send_file(self, filename, retry, timeout, callback, resume):
+        stat = os.stat(filename)
+        size = stat.st_size
+        info = os.path.basename(filename).encode() + NUL + (
+            '%d %o %o 0' % (size, int(stat.st_mtime), stat.st_mode)
+        ).encode() + NUL
+        flags = _zflags(ZCRESUM if resume else ZCBIN)
+        with open(filename, 'rb') as stream:
+            def send_info():
+                self.putc(self._bin_header(ZFILE, flags) +
+                          self._subpacket(info, ZCRCW))
+            send_info()
+            while True:
+                header = self._expect((ZRPOS, ZSKIP, ZNAK, ZCRC), retry,
+                                      timeout, send_info)
+                ftype, data = header[0], bytes(header[1])
+                if ftype == ZSKIP:
+                    self.log.info('receiver skipped %s', filename)
+                    return True
+                if ftype == ZNAK:
+                    send_info()
+                elif ftype == ZCRC:
+                    # the receiver checks the part it has before resuming
+                    count = struct.unpack('<I', data)[0] or size
+                    stream.seek(0)
+                    crc = 0
+                    while count > 0:
+                        chunk = stream.read(min(count, 65536))
+                        if not chunk:
+                            break
+                        crc = _zcrc32(chunk, crc)
+                        count -= len(chunk)
+                    self._send_hex_header(ZCRC, _zpos(crc))
+                else:
+                    offset = struct.unpack('<I', data)[0]
+                    break
+            self.log.debug('zmodem sending "%s" len:%d from %d', filename,
+                           size, offset)
+            return self._send_data(stream, filename, size, offset, retry,
+                                   timeout, callback)
+
+    def _send_data(self, stream, filename, size, offset, retry, timeout,
+                   callback):
+        '''
+        Stream the file from offset in ZDATA frames, until the receiver
+        took its ZEOF. Each ZRPOS restarts the stream at its offset.
+        '''
+        errors = 0
+        asked = offset
+        while True:
+            stream.seek(offset)
+            frame = self._bin_header(ZDATA, _zpos(offset))
+            count = 0
+            restart = None
+            while restart is None:
+                data = stream.read(self.block_size)
+                count += 1
+                if offset + len(data) >= size or not data:
+                    end = ZCRCE
+                elif count % self.ack_interval == 0:
+                    end = ZCRCQ
+                else:
+                    end = ZCRCG
+                self.putc(frame + self._subpacket(data, end))
+                frame = b''
+                offset += len(data)
+                if callable(callback):
+                    callback(filename, offset, size)
+                if end == ZCRCE:
+                    break
+                # the receiver only talks to report an error or progress
+                char = self.getc(1, 0)
+                if char in (ZPAD, ZDLE):
+                    header = self._read_header(timeout, ord(char))
+                    restart = self._on_data_header(header, offset)
+
+            if restart is None:
+                # end of file
+                self.putc(self._bin_header(ZEOF, _zpos(offset)))
+                header = self._expect((ZRINIT, ZRPOS, ZSKIP), retry, timeout,
+                                      lambda: self.putc(self._bin_header(
+                                          ZEOF, _zpos(offset))))
+                if header[0] in (ZRINIT, ZSKIP):
+                    return True
+                restart = self._on_data_header(header, offset)
+            if restart is True:
+                return True  # skipped
+            # errors in a row, the ones after some progress are new ones
+            errors = errors + 1 if restart <= asked else 1
+            asked = restart
+            if errors > retry:
+                raise ZMODEMError('too many errors, last at %d' % restart)
+            self.resent += offset - restart
+            self.log.info('send: receiver asks for offset %d', restart)
+            offset = restart
+
+    def _on_data_header(self, header, offset):
+        '''
+        New offset asked by a header seen while streaming, True to skip the
+        file, None to go on
+        '''
+        ftype = header[0]
+        if ftype == ZRPOS:
+            # drop what the receiver will not take
+            self._purge()
+            return struct.unpack('<I', bytes(header[1]))[0]
+        if ftype == ZSKIP:
+            return True
+        if ftype in (ZABORT, ZFERR, ZCAN):
+            raise _ZCancel('aborted by the other end (%d)' % ftype)
+        return None  # ZACK
+
+    def _purge(self):
+        while self.getc(1, 0) is not None:
+            pass
+
+    # receiver
+
+    def recv(self, stream, retry=16, timeout=10, callback=None,
+             resume=False):
+        '''
+        Receive files via the ZMODEM protocol.
+
+        Returns the number of bytes received on success or ``None`` in case
+        of failure.
+
+        :param stream: Stream to write the file to, or callable taking the
+                       file name and size and returning the stream to write
+                       it to, ``None`` to skip it
+        :type stream: stream (file, etc.) or callable
+        :param retry: The maximum number of errors in a row before failing
+        :type retry: int
+        :param timeout: Seconds to wait for the sender
+        :type timeout: int
+        :param callback: Called as callback(filename, offset, size) as the
+                         data comes in
+        :type callback: callable
+        :param resume: Go on from the end of the streams, as when the
+                       sender asks for it
+        :type resume: bool
+        '''
+        total = 0
+        rinit = _zflags(CANFDX | CANOVIO | CANFC32)
+        try:
+            self._send_hex_header(ZRINIT, rinit)
+            while True:
+                ftype, data, is32 = self._expect(
+                    (ZRQINIT, ZSINIT, ZFILE, ZFIN, ZEOF, ZDATA), retry,
+                    timeout, lambda: self._send_hex_header(ZRINIT, rinit))
+                if ftype == ZFIN:
+                    self._send_hex_header(ZFIN, _zpos(0))
+                    self.getc(2, 1)  # OO
+                    self.log.info('Transmission complete, %d bytes', total)
+                    return total
+                if ftype == ZSINIT:
+                    self._read_subpacket(is32, timeout)
+                    self._send_hex_header(ZACK, _zpos(0))
+                    continue
+                if ftype != ZFILE:
+                    self._send_hex_header(ZRINIT, rinit)
+                    continue
+                info, end = self._read_subpacket(is32, timeout)
+                if info is None:
+                    self._send_hex_header(ZNAK, _zpos(0))
+                    continue
+                fields = info.split(NUL)
+                filename = fields[0].decode('utf-8', 'replace')
+                attrs = fields[1].split() if len(fields) > 1 else []
+                size = int(attrs[0]) if attrs else None
+                out = stream(filename, size) if callable(stream) else stream
+                if out is None:
+                    self._send_hex_header(ZSKIP, _zpos(0))
+                    continue
+                offset = 0
+                if resume or data[3] == ZCRESUM:
+                    out.seek(0, 2)
+                    offset = out.tell()
+                received = self._recv_data(out, filename, size, offset,
+                                           retry, timeout, callback)
+                total += received
+                self.log.info('received %s, %d bytes from %d', filename,
+                              received, offset)
+                self._send_hex_header(ZRINIT, rinit)
+        except ZMODEMError as e:
+            self.log.error('recv error: %s', e)
+            if not isinstance(e, _ZCancel):
+                self.abort()
+            return None
+
+    def _recv_data(self, out, filename, size, offset, retry, timeout,
+                   callback):
+        '''Write the file data from offset, returns the bytes written'''
+        start = asked = offset
+        errors = 0
+        self._send_hex_header(ZRPOS, _zpos(offset))
+        while True:
+            try:
+                ftype, data, is32 = self._read_header(timeout)
+            except _ZTimeout:
+                ftype = None
+            if ftype == ZEOF:
+                if struct.unpack('<I', bytes(data))[0] == offset:
+                    out.flush()
+                    return offset - start
+                continue  # sent before our ZRPOS got there
+            if ftype == ZFILE:
+                self._read_subpacket(is32, timeout)  # missed our ZRPOS
+            elif ftype in (ZABORT, ZFERR, ZCAN, ZFIN):
+                raise _ZCancel('aborted by the other end (%d)' % ftype)
+            elif ftype == ZDATA and \
+                    struct.unpack('<I', bytes(data))[0] == offset:
+                offset, ok = self._recv_frame(out, filename, offset, size,
+                                              is32, timeout, callback)
+                if ok:
+                    errors = 0
+                    continue
+            elif ftype is not None and ftype != ZDATA:
+                continue
+            errors = errors + 1 if offset <= asked else 1
+            asked = offset
+            if errors > retry:
+                raise ZMODEMError('too many errors, last at %d' % offset)
+            self.log.warn('recv error: asking again from %d', offset)
+            self._send_hex_header(ZRPOS, _zpos(offset))
+
+    def _recv_frame(self, out, filename, offset, size, is32, timeout,
+                    callback):
+        '''
+        Subpackets of a ZDATA frame, returns (offset, False) after a bad one
+        '''
+        while True:
+            try:
+                data, end = self._read_subpacket(is32, timeout)
+            except _ZTimeout:
+                return offset, False
+            if data is None:
+                return offset, False
+            out.write(data)
+            offset += len(data)
+            if callable(callback):
+                callback(filename, offset, size)
+            if end in (ZCRCQ, ZCRCW):
+                self._send_hex_header(ZACK, _zpos(offset))
+            if end in (ZCRCE, ZCRCW):
+                return offset, True
+
+
 def run():
     import optparse
     import subprocess
@@ -687,10 +1567,13 @@ def run():
     parser = optparse.OptionParser(
         usage='%prog [<options>] <send|recv> filename filename')
     parser.add_option('-m', '--mode', default='xmodem',
-                      help='XMODEM mode (xmodem, xmodem1k, ymodem)')
+                      help='XMODEM mode (xmodem, xmodem1k, ymodem, zmodem)')
+    parser.add_option('-r', '--resume', action='store_true',
+                      help='go on with a partly received file (zmodem)')
 
     options, args = parser.parse_args()
-    if options.mode != 'ymodem' and len(args) != 3:
+    batch = options.mode in ('ymodem', 'zmodem')
+    if not batch and len(args) != 3:
         parser.error('invalid arguments')
         return 1
     elif len(args) < 2:
@@ -707,10 +1590,19 @@ def run():
         print(('so', so))
 
         def getc(size, timeout=3):
-            read_ready, _, _ = select.select([so], [], [], timeout)
-            if read_ready:
-                data = so.read(size)
-            else:
+            # os.read, select does not see what a file object buffered
+            data = b''
+            deadline = time.time() + timeout
+            while len(data) < size:
+                read_ready, _, _ = select.select(
+                    [so], [], [], max(0, deadline - time.time()))
+                if not read_ready:
+                    break
+                chunk = os.read(so.fileno(), size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            if len(data) < size:
                 data = None
 
             print(('getc(', repr(data), ')'))
@@ -736,7 +1628,22 @@ def run():
                                 stdin=subprocess.PIPE)
         return pipe.stdout, pipe.stdin
 
-    if args[0] == 'recv':
+    if options.mode == 'zmodem':
+        if args[0] == 'recv':
+            getc, putc = _func(*_pipe('sz', args[2]))
+            stream = open(args[1], 'ab' if options.resume else 'wb')
+            zmodem = ZMODEM(getc, putc)
+            status = zmodem.recv(stream, retry=8, resume=options.resume)
+            assert status is not None, ('Transfer failed, status is', status)
+            stream.close()
+        else:
+            getc, putc = _func(*_pipe('rz', '--resume') if options.resume
+                               else _pipe('rz'))
+            zmodem = ZMODEM(getc, putc)
+            sent = zmodem.send(args[1:], retry=8, resume=options.resume)
+            assert sent, ('Transfer failed, sent is', sent)
+
+    elif args[0] == 'recv':
         getc, putc = _func(*_pipe('sz', '--xmodem', args[2]))
         stream = open(args[1], 'wb')
         xmodem = XMODEM(getc, putc, mode=options.mode)